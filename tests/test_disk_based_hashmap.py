@@ -1,8 +1,15 @@
+import asyncio
+import gc
 import sys
 import os
 import inspect
 import shutil
 import random
+import subprocess
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 from pympler.asizeof import asizeof
 
@@ -18,6 +25,13 @@ sys.path.append(
 )
 
 from disk_based_hashmap_util.disk_based_hashmap import DiskBasedHashMap
+from disk_based_hashmap_util.async_disk_based_hashmap import AsyncDiskBasedHashMap
+from disk_based_hashmap_util.concurrent_disk_based_hashmap import (
+    ConcurrentDiskBasedHashMap,
+)
+from disk_based_hashmap_util.codec import Codec
+from disk_based_hashmap_util.memory_budget import MemoryBudget
+from disk_based_hashmap_util.memory_pressure import sample_memory
 
 package_root = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "packages", "test_disk_based_hashmap")
@@ -520,6 +534,1987 @@ def test_complicated_object_usage():
     _clean_up(test_case_package)
 
 
+def test_bucket_file_handles_are_pooled():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    with DiskBasedHashMap(
+        bucket_num=8, memory_threshold=0, work_dir=test_case_package, max_open_files=2
+    ) as disk_map:
+        for i in range(100):
+            disk_map[i] = i * 2
+            assert len(disk_map._file_handle_pool) <= 2
+        for i in range(100):
+            assert disk_map[i] == i * 2
+            assert len(disk_map._file_handle_pool) <= 2
+        disk_map.compact()
+        assert sorted(disk_map.items()) == [(i, i * 2) for i in range(100)]
+    assert len(disk_map._file_handle_pool) == 0
+
+    # handles are reopened lazily after close
+    assert disk_map[10] == 20
+
+    _clean_up(test_case_package)
+
+
+def test_mmap_read_mode():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    comp_dict = {}
+    disk_map = DiskBasedHashMap(
+        bucket_num=4, memory_threshold=128, work_dir=test_case_package, use_mmap=True
+    )
+    for _ in range(2000):
+        key, value = random.randint(1, 100), random.randint(1, 1000)
+        weight_index = random.randint(1, 10)
+        if weight_index <= 5:
+            disk_map[key] = value
+            comp_dict[key] = value
+        elif weight_index <= 8:
+            assert comp_dict.get(key, None) == disk_map.get(key, None)
+        elif weight_index <= 9:
+            assert comp_dict.pop(key, None) == disk_map.pop(key, None)
+        else:
+            disk_map.compact()
+    assert sorted(comp_dict.items()) == sorted(disk_map.items())
+
+    disk_map.clear()
+    assert list(disk_map) == []
+    disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_reopen_persistent_map():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    comp_dict = {}
+    with DiskBasedHashMap(
+        bucket_num=4, memory_threshold=256, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        for i in range(200):
+            disk_map["key_{}".format(i)] = [i] * (i % 5)
+            comp_dict["key_{}".format(i)] = [i] * (i % 5)
+        for i in range(0, 200, 3):
+            del disk_map["key_{}".format(i)]
+            del comp_dict["key_{}".format(i)]
+
+    # bucket number is restored from manifest
+    disk_map = DiskBasedHashMap(
+        bucket_num=1, memory_threshold=256, work_dir=test_case_package, persistent=True
+    )
+    assert disk_map._bucket_num == 4
+    assert sorted(disk_map.items()) == sorted(comp_dict.items())
+    disk_map["key_0"] = "again"
+    comp_dict["key_0"] = "again"
+    disk_map.compact()
+    disk_map.close()
+
+    # recovery scan when manifest is missing
+    os.remove(os.path.join(test_case_package, DiskBasedHashMap.MANIFEST_FILENAME))
+    with DiskBasedHashMap(
+        memory_threshold=256, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        assert sorted(disk_map.items()) == sorted(comp_dict.items())
+
+    # non persistent map always starts from scratch
+    disk_map = DiskBasedHashMap(memory_threshold=256, work_dir=test_case_package)
+    assert list(disk_map) == []
+
+    _clean_up(test_case_package)
+
+
+def test_reopen_in_another_process_keeps_records():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    with DiskBasedHashMap(
+        bucket_num=8, memory_threshold=0, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        for i in range(500):
+            disk_map["key_{}".format(i)] = ("value_{}".format(i), i)
+            disk_map[b"bytes_%d" % i] = i
+
+    # string hash is randomized differently in another process, keys are still in
+    # their buckets, so that reopen only reads checkpoints and never moves records
+    script = """
+import sys
+sys.path[:0] = {path!r}
+from bucket import Bucket
+from disk_based_hashmap import DiskBasedHashMap
+reads, read_record = [], Bucket.read_record
+Bucket.read_record = lambda bucket, address: reads.append(address) or read_record(
+    bucket, address
+)
+disk_map = DiskBasedHashMap(memory_threshold=0, work_dir={work_dir!r}, persistent=True)
+assert len(reads) == len(disk_map._buckets) == 8
+assert len(disk_map) == 1000
+disk_map.close()
+""".format(
+        path=sys.path, work_dir=test_case_package
+    )
+    for seed in ("1", "2"):
+        subprocess.check_call(
+            [sys.executable, "-c", script], env=dict(os.environ, PYTHONHASHSEED=seed)
+        )
+
+    with DiskBasedHashMap(
+        memory_threshold=0, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        assert disk_map["key_7"] == ("value_7", 7)
+        assert disk_map[b"bytes_9"] == 9
+        assert len(disk_map) == 1000
+
+    _clean_up(test_case_package)
+
+
+def test_lookup_only_loads_matching_key():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    disk_map = DiskBasedHashMap(
+        bucket_num=1, memory_threshold=0, work_dir=test_case_package
+    )
+    for i in range(50):
+        disk_map[i] = i * 3
+
+    # count disk loads of the only bucket
+    bucket, load_count = disk_map._buckets[0], [0]
+    load_value = bucket.load_value
+
+    def counting_load_value(address):
+        load_count[0] += 1
+        return load_value(address)
+
+    bucket.load_value = counting_load_value
+
+    # one load for matched key and one load for its value
+    assert disk_map[49] == 147
+    assert load_count[0] == 2
+
+    # miss never touch disk
+    load_count[0] = 0
+    assert disk_map.get(100, None) is None
+    assert load_count[0] == 0
+
+    _clean_up(test_case_package)
+
+
+def test_bucket_split_with_max_load_factor():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    comp_dict = {}
+    disk_map = DiskBasedHashMap(
+        bucket_num=1,
+        memory_threshold=1024,
+        work_dir=test_case_package,
+        max_load_factor=2,
+        persistent=True,
+    )
+    for i in range(1000):
+        disk_map[i] = str(i)
+        comp_dict[i] = str(i)
+        assert len(disk_map) <= 2 * len(disk_map._buckets)
+    # linear hashing adds one bucket at a time
+    assert len(disk_map._buckets) == 500
+    assert max(len(bucket.linked_list) for bucket in disk_map._buckets) <= 4
+    for i in range(0, 1000, 2):
+        assert disk_map.pop(i) == comp_dict.pop(i)
+    assert sorted(disk_map.items()) == sorted(comp_dict.items())
+    disk_map.close()
+
+    with DiskBasedHashMap(
+        memory_threshold=1024, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        assert len(disk_map._buckets) == 500
+        assert sorted(disk_map.items()) == sorted(comp_dict.items())
+
+    _clean_up(test_case_package)
+
+
+def test_split_defers_checkpoints_of_persistent_map():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    comp_dict = {i: str(i) for i in range(20)}
+    with DiskBasedHashMap(
+        bucket_num=1,
+        memory_threshold=0,
+        work_dir=test_case_package,
+        max_load_factor=2,
+        persistent=True,
+    ) as disk_map:
+        disk_map.update(comp_dict)
+
+    disk_map = DiskBasedHashMap(
+        memory_threshold=0,
+        work_dir=test_case_package,
+        max_load_factor=2,
+        persistent=True,
+    )
+    bucket_num = len(disk_map._buckets)
+    manifest_writes = [0]
+    write_manifest = disk_map._write_manifest
+
+    def counting_write_manifest():
+        manifest_writes[0] += 1
+        write_manifest()
+
+    disk_map._write_manifest = counting_write_manifest
+    for i in range(20, 200):
+        disk_map[i] = str(i)
+    assert len(disk_map._buckets) > bucket_num
+    assert manifest_writes[0] == 0
+
+    # crash before next checkpoint, manifest still matches bucket files
+    for bucket in disk_map._buckets:
+        bucket.close()
+    disk_map = DiskBasedHashMap(
+        memory_threshold=0,
+        work_dir=test_case_package,
+        max_load_factor=2,
+        persistent=True,
+    )
+    assert len(disk_map._buckets) == bucket_num
+    assert sorted(disk_map.items()) == sorted(comp_dict.items())
+
+    # split buckets are saved together before a bucket file is rewritten
+    for i in range(20, 200):
+        disk_map[i] = comp_dict[i] = str(i)
+    disk_map.compact()
+    for bucket in disk_map._buckets:
+        bucket.close()
+    with DiskBasedHashMap(
+        memory_threshold=0, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        assert sorted(disk_map.items()) == sorted(comp_dict.items())
+
+    _clean_up(test_case_package)
+
+
+def test_pluggable_sizer():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    sizer_calls = [0]
+
+    def counting_sizer(value):
+        sizer_calls[0] += 1
+        return 16
+
+    disk_map = DiskBasedHashMap(
+        bucket_num=4,
+        memory_threshold=160,
+        work_dir=test_case_package,
+        sizer=counting_sizer,
+    )
+    for i in range(100):
+        disk_map[i] = i
+    for _ in range(5):
+        for i in range(100):
+            assert disk_map[i] == i
+            assert disk_map._in_memory_objects.memory_usage <= 160
+    # sizes are cached, loading spilled objects back doesn't compute them again
+    assert sizer_calls[0] == 200
+    disk_map[0] = -1
+    assert sizer_calls[0] == 201
+
+    for sizer in ("asizeof", "getsizeof", "pickle", "fixed"):
+        disk_map = DiskBasedHashMap(
+            bucket_num=4, memory_threshold=256, work_dir=test_case_package, sizer=sizer
+        )
+        for i in range(100):
+            disk_map[i] = [i] * 10
+            assert disk_map._in_memory_objects.memory_usage <= 256
+        assert all(disk_map[i] == [i] * 10 for i in range(100))
+
+    try:
+        DiskBasedHashMap(work_dir=test_case_package, sizer="unknown")
+        assert False
+    except Exception as e:
+        assert isinstance(e, ValueError)
+
+    _clean_up(test_case_package)
+
+
+def test_key_value_pair_is_single_lru_unit():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    disk_map = DiskBasedHashMap(
+        bucket_num=4, memory_threshold=512, work_dir=test_case_package
+    )
+    for i in range(100):
+        disk_map[i] = i
+    in_memory_objects, disk_objects = (
+        disk_map._in_memory_objects,
+        disk_map._disk_objects,
+    )
+    assert len(in_memory_objects) > 0 and len(disk_objects) > 0
+    assert len(in_memory_objects) + len(disk_objects) == len(disk_map) == 100
+    # key and value of an entry are always in memory or on disk together
+    for bucket in disk_map._buckets:
+        for node in bucket.linked_list:
+            bucket_entry = node.value
+            assert bucket_entry.key.is_in_memory() == bucket_entry.value.is_in_memory()
+            assert (bucket_entry.lru_node.owner is disk_objects) != (
+                bucket_entry.is_in_memory()
+            )
+
+    # in-memory hit only moves its entry to the tail
+    memory_usage = in_memory_objects.memory_usage
+    first_key = in_memory_objects.victim().key.value
+    assert disk_map[first_key] == first_key
+    assert in_memory_objects._lru_list.peek_last().value.key.value == first_key
+    assert in_memory_objects.victim().key.value != first_key
+    assert in_memory_objects.memory_usage == memory_usage
+
+    _clean_up(test_case_package)
+
+
+def test_eviction_policies():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    for eviction_policy in ("lru", "clock", "2q", "arc", "lfu"):
+        comp_dict = {}
+        disk_map = DiskBasedHashMap(
+            bucket_num=4,
+            memory_threshold=1024,
+            work_dir=test_case_package,
+            eviction_policy=eviction_policy,
+        )
+        gets = 0
+        for _ in range(3000):
+            key, value = random.randint(1, 100), random.randint(1, 1000)
+            weight_index = random.randint(1, 10)
+            if weight_index <= 4:
+                disk_map[key] = value
+                comp_dict[key] = value
+            elif weight_index <= 8:
+                gets += int(key in comp_dict)
+                assert comp_dict.get(key, None) == disk_map.get(key, None)
+            elif weight_index <= 9:
+                # pop gets value before deleting it
+                gets += int(key in comp_dict)
+                assert comp_dict.pop(key, None) == disk_map.pop(key, None)
+            else:
+                # full scan is streamed, it's neither a hit nor a miss
+                assert sorted(comp_dict.items()) == sorted(disk_map.items())
+            assert disk_map._in_memory_objects.memory_usage <= 1024
+            assert len(disk_map) == len(comp_dict)
+        policy = disk_map.eviction_policy
+        assert policy.hits > 0 and policy.misses > 0
+        assert policy.hits + policy.misses == gets
+
+    try:
+        DiskBasedHashMap(work_dir=test_case_package, eviction_policy="mru")
+        assert False
+    except Exception as e:
+        assert isinstance(e, ValueError)
+
+    _clean_up(test_case_package)
+
+
+def test_record_codecs():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    values = [
+        b"raw bytes",
+        "unicode \u4e2d\u6587 \ud800",
+        -(1 << 63),
+        1 << 100,
+        3.25,
+        True,
+        bytearray(range(256)) * 100,
+        {"nested": [1, 2.0, "3"]},
+        Point(3, 4),
+    ]
+    for use_mmap in (False, True):
+        disk_map = DiskBasedHashMap(
+            bucket_num=4,
+            memory_threshold=0,
+            work_dir=test_case_package,
+            use_mmap=use_mmap,
+            codecs=[PointCodec()],
+        )
+        for index, value in enumerate(values):
+            disk_map[index] = value
+        for index, value in enumerate(values):
+            assert disk_map[index] == value
+            assert type(disk_map[index]) is type(value)
+        # codec tag is written in record header
+        for bucket in disk_map._buckets:
+            for node in bucket.linked_list:
+                value_object = node.value.value
+                tag, _ = bucket.read_record(value_object.value)
+                assert (tag == PointCodec.tag) == (node.value.key.load_value() == 8)
+        disk_map.close()
+
+    try:
+        DiskBasedHashMap(
+            work_dir=test_case_package, codecs=[PointCodec(), PointCodec()]
+        )
+        assert False
+    except Exception as e:
+        assert isinstance(e, ValueError)
+
+    _clean_up(test_case_package)
+
+
+def test_compressed_records():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    def bucket_file_size(disk_map):
+        disk_map.close()
+        return sum(os.path.getsize(bucket.filepath) for bucket in disk_map._buckets)
+
+    def json_like(i):
+        return str([{"id": i, "name": "name_{}".format(i), "tags": ["a", "b"]}] * 20)
+
+    raw_map = DiskBasedHashMap(memory_threshold=0, work_dir=test_case_package)
+    for i in range(200):
+        raw_map[i] = json_like(i)
+    raw_size = bucket_file_size(raw_map)
+
+    for compression in ("zlib", "bz2", "lzma"):
+        for block_size in (None, 4096):
+            for use_mmap in (False, True):
+                disk_map = DiskBasedHashMap(
+                    bucket_num=2,
+                    memory_threshold=2048,
+                    work_dir=test_case_package,
+                    use_mmap=use_mmap,
+                    max_load_factor=8,
+                    compression=compression,
+                    compression_block_size=block_size,
+                )
+                comp_dict = dict()
+                for _ in range(600):
+                    key = random.randint(0, 199)
+                    op = random.randint(0, 9)
+                    if op < 5:
+                        # small values stay below compression threshold
+                        value = json_like(key) if op < 4 else key
+                        disk_map[key] = value
+                        comp_dict[key] = value
+                    elif op < 9:
+                        assert comp_dict.get(key) == disk_map.get(key)
+                    else:
+                        assert comp_dict.pop(key, None) == disk_map.pop(key, None)
+                assert sorted(comp_dict.items()) == sorted(disk_map.items())
+                disk_map.compact()
+                assert sorted(comp_dict.items()) == sorted(disk_map.items())
+
+                for i in range(200):
+                    disk_map[i] = json_like(i)
+                assert bucket_file_size(disk_map) * 3 < raw_size
+                for i in range(200):
+                    assert disk_map[i] == json_like(i)
+                disk_map.close()
+
+    # blocks and compressed records are readable after reopen
+    disk_map = DiskBasedHashMap(
+        memory_threshold=0,
+        work_dir=test_case_package,
+        persistent=True,
+        compression="zlib",
+        compression_block_size=4096,
+    )
+    for i in range(100):
+        disk_map[i] = json_like(i)
+    disk_map.close()
+    disk_map = DiskBasedHashMap(
+        memory_threshold=0,
+        work_dir=test_case_package,
+        persistent=True,
+        compression="zlib",
+        compression_block_size=4096,
+    )
+    assert len(disk_map) == 100
+    for i in range(100):
+        assert disk_map[i] == json_like(i)
+    disk_map.close()
+
+    try:
+        DiskBasedHashMap(work_dir=test_case_package, compression="snappy")
+        assert False
+    except Exception as e:
+        assert isinstance(e, ValueError)
+
+    _clean_up(test_case_package)
+
+
+def test_background_compaction():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    def live_size(bucket):
+        size = 0
+        for node in bucket.linked_list:
+            for bucket_object in (node.value.key, node.value.value):
+                # loaded values keep their clean disk copies
+                if bucket_object.record_address() is not None:
+                    size += bucket_object.record_address().size
+        return size
+
+    # every byte of bucket file is either live or garbage
+    disk_map = DiskBasedHashMap(
+        bucket_num=4, memory_threshold=512, work_dir=test_case_package
+    )
+    comp_dict = dict()
+    for _ in range(2000):
+        key = random.randint(0, 99)
+        op = random.randint(0, 2)
+        if op == 0:
+            disk_map[key] = comp_dict[key] = "value_{}".format(random.random())
+        elif op == 1:
+            assert comp_dict.get(key) == disk_map.get(key)
+        else:
+            assert comp_dict.pop(key, None) == disk_map.pop(key, None)
+    for bucket in disk_map._buckets:
+        assert live_size(bucket) + bucket.garbage_size == bucket._offset
+    disk_map.compact()
+    for bucket in disk_map._buckets:
+        assert bucket.garbage_size == 0
+        assert live_size(bucket) == bucket._offset
+    disk_map.close()
+
+    for persistent in (False, True):
+        _clean_up(test_case_package)
+        disk_map = DiskBasedHashMap(
+            bucket_num=4,
+            memory_threshold=512,
+            work_dir=test_case_package,
+            persistent=persistent,
+            compaction_garbage_ratio=0.5,
+        )
+        comp_dict = dict()
+        for _ in range(3000):
+            key = random.randint(0, 99)
+            if random.randint(0, 1) == 0:
+                disk_map[key] = comp_dict[key] = "value_{}".format(random.random())
+            else:
+                assert comp_dict.get(key) == disk_map.get(key)
+        # compactor catches up once writes stop
+        for _ in range(100):
+            if all(bucket.garbage_ratio < 0.5 for bucket in disk_map._buckets):
+                break
+            time.sleep(0.1)
+        assert all(bucket.garbage_ratio < 0.5 for bucket in disk_map._buckets)
+        assert sorted(comp_dict.items()) == sorted(disk_map.items())
+        disk_map.close()
+
+        if persistent:
+            # compactor waits until reopened map is restored
+            disk_map = DiskBasedHashMap(
+                memory_threshold=512,
+                work_dir=test_case_package,
+                persistent=True,
+                compaction_garbage_ratio=0.5,
+            )
+            assert sorted(comp_dict.items()) == sorted(disk_map.items())
+
+            # crash right after compaction swaps a bucket file
+            crash_package = test_case_package + "_crash"
+            bucket = disk_map._buckets[0]
+            bucket_swap = bucket.swap
+
+            def crashing_swap(other):
+                bucket_swap(other)
+                if os.path.exists(crash_package):
+                    shutil.rmtree(crash_package)
+                shutil.copytree(test_case_package, crash_package)
+
+            bucket.swap = crashing_swap
+            disk_map.compact()
+            disk_map.close()
+            with DiskBasedHashMap(
+                memory_threshold=512, work_dir=crash_package, persistent=True
+            ) as recovered_map:
+                assert sorted(comp_dict.items()) == sorted(recovered_map.items())
+            shutil.rmtree(crash_package)
+
+    # a failed compaction doesn't stop compactor
+    _clean_up(test_case_package)
+    disk_map = ConcurrentDiskBasedHashMap(
+        bucket_num=4,
+        memory_threshold=512,
+        work_dir=test_case_package,
+        segment_size=512,
+        compaction_garbage_ratio=0.5,
+    )
+    compact_buckets = disk_map._compact_buckets
+    failures = []
+
+    def failing_compact_buckets(buckets, garbage_ratio=None):
+        if not failures:
+            failures.append(1)
+            raise IOError("Disk is gone")
+        compact_buckets(buckets, garbage_ratio)
+
+    disk_map._compact_buckets = failing_compact_buckets
+    comp_dict = dict()
+    for _ in range(3000):
+        key = random.randint(0, 99)
+        disk_map[key] = comp_dict[key] = "value_{}".format(random.random())
+    for _ in range(100):
+        if all(bucket.garbage_ratio < 0.5 for bucket in disk_map._buckets):
+            break
+        time.sleep(0.1)
+    assert failures
+    assert all(bucket.garbage_ratio < 0.5 for bucket in disk_map._buckets)
+    assert sorted(comp_dict.items()) == sorted(disk_map.items())
+    disk_map.close()
+
+    # compactor doesn't keep a map alive, its thread exits once map is collected
+    _clean_up(test_case_package)
+    disk_map = DiskBasedHashMap(
+        bucket_num=4,
+        memory_threshold=512,
+        work_dir=test_case_package,
+        compaction_garbage_ratio=0.5,
+    )
+    for i in range(1000):
+        disk_map[i % 100] = "value_{}".format(i)
+    thread = disk_map._compactor._thread
+    assert thread is not None
+    map_reference = weakref.ref(disk_map)
+    del disk_map
+    # map is referenced by compactor only while it compacts a bucket
+    for _ in range(100):
+        gc.collect()
+        if map_reference() is None:
+            break
+        time.sleep(0.05)
+    assert map_reference() is None
+    thread.join(5)
+    assert not thread.is_alive()
+
+    _clean_up(test_case_package)
+
+
+def test_concurrent_map():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    def worker(disk_map, thread_index, results):
+        # every thread owns its keys, so that it could check them with its own dict
+        comp_dict = dict()
+        for _ in range(1000):
+            key = (thread_index, random.randint(0, 99))
+            op = random.randint(0, 4)
+            if op < 2:
+                value = "value_{}".format(random.random())
+                disk_map[key] = comp_dict[key] = value
+            elif op < 4:
+                assert comp_dict.get(key) == disk_map.get(key)
+            else:
+                assert comp_dict.pop(key, None) == disk_map.pop(key, None)
+        results[thread_index] = comp_dict
+
+    for kwargs in (
+        dict(),
+        dict(max_load_factor=4, compaction_garbage_ratio=0.5),
+        dict(compression="zlib", compression_block_size=1024),
+    ):
+        disk_map = ConcurrentDiskBasedHashMap(
+            bucket_num=2,
+            memory_threshold=1024,
+            work_dir=test_case_package,
+            lock_stripes=4,
+            **kwargs
+        )
+        results = dict()
+        threads = [
+            threading.Thread(target=worker, args=(disk_map, thread_index, results))
+            for thread_index in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 8
+        comp_dict = dict()
+        for thread_comp_dict in results.values():
+            comp_dict.update(thread_comp_dict)
+        assert len(disk_map) == len(comp_dict)
+        assert sorted(comp_dict.items()) == sorted(disk_map.items())
+        assert disk_map._in_memory_objects.memory_usage <= 1024
+        disk_map.close()
+
+    # records are read without stripes locked, either by lookups, updates or loads
+    disk_map = ConcurrentDiskBasedHashMap(
+        bucket_num=2, memory_threshold=1024, work_dir=test_case_package, lock_stripes=4
+    )
+    comp_dict = dict()
+    for key in range(200):
+        disk_map[key] = comp_dict[key] = "value_{}".format(key)
+    locked_reads = []
+    for bucket in disk_map._buckets:
+
+        def load_value(disk_address, bucket_load_value=bucket.load_value):
+            locked_reads.append(any(stripe.locked() for stripe in disk_map._stripes))
+            return bucket_load_value(disk_address)
+
+        bucket.load_value = load_value
+    for key in range(0, 200, 2):
+        disk_map[key] = comp_dict[key] = "new_value_{}".format(key)
+    for key in range(1, 200, 4):
+        del disk_map[key]
+        del comp_dict[key]
+    # freed memory is taken by entries loaded back from disk
+    assert all(disk_map[key] == value for key, value in comp_dict.items())
+    assert len(locked_reads) > 0 and not any(locked_reads)
+    assert sorted(comp_dict.items()) == sorted(disk_map.items())
+    disk_map.close()
+
+    # entries being written by a spill are still counted by other threads
+    disk_map = ConcurrentDiskBasedHashMap(
+        bucket_num=2, memory_threshold=1024, work_dir=test_case_package, lock_stripes=4
+    )
+    comp_dict, lengths = dict(), []
+    spill_entries = disk_map._spill_entries
+
+    def counted_spill_entries(bucket_entries):
+        thread = threading.Thread(
+            target=lambda: lengths.append((len(comp_dict), len(disk_map)))
+        )
+        thread.start()
+        thread.join()
+        spill_entries(bucket_entries)
+
+    disk_map._spill_entries = counted_spill_entries
+    for key in range(200):
+        comp_dict[key] = "value_{}".format(key)
+        disk_map[key] = comp_dict[key]
+    assert len(lengths) > 0
+    assert all(expected == length for expected, length in lengths)
+    disk_map.close()
+
+    # lock-free lookups reopening bucket files never pin a file replaced by compaction
+    disk_map = ConcurrentDiskBasedHashMap(
+        bucket_num=2,
+        memory_threshold=512,
+        work_dir=test_case_package,
+        lock_stripes=4,
+        compaction_garbage_ratio=0.3,
+    )
+    comp_dict = dict()
+    for key in range(200):
+        disk_map[key] = comp_dict[key] = "value_{}".format(key)
+    pool_close = disk_map._file_handle_pool.close
+    bucket_filepaths = set(bucket.filepath for bucket in disk_map._buckets)
+
+    def close(filepath):
+        closed = pool_close(filepath)
+        # a lock-free read leases bucket file right after its handle is closed
+        if filepath in bucket_filepaths:
+            with disk_map._file_handle_pool.lease(filepath):
+                pass
+        return closed
+
+    disk_map._file_handle_pool.close = close
+    stopped = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            while not stopped.is_set():
+                disk_map.get(random.randint(0, 199))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for index in range(2000):
+            key = random.randint(0, 199)
+            disk_map[key] = comp_dict[key] = "value_{}_{}".format(key, index)
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+    assert not errors
+    # records are read through reopened handles
+    disk_map._file_handle_pool.close = pool_close
+    disk_map._file_handle_pool.close_all()
+    assert all(disk_map[key] == value for key, value in comp_dict.items())
+    disk_map.close()
+
+    try:
+        ConcurrentDiskBasedHashMap(work_dir=test_case_package, use_mmap=True)
+        assert False
+    except Exception as e:
+        assert isinstance(e, ValueError)
+
+    _clean_up(test_case_package)
+
+
+def test_async_map():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    executor = CountingExecutor(max_workers=4)
+    async_map = AsyncDiskBasedHashMap(
+        executor=executor, memory_threshold=256, work_dir=test_case_package
+    )
+
+    async def scenario():
+        comp_dict = dict()
+        for _ in range(500):
+            key = random.randint(0, 49)
+            op = random.randint(0, 3)
+            if op < 2:
+                value = "value_{}".format(random.random())
+                await async_map.set(key, value)
+                comp_dict[key] = value
+            elif op < 3:
+                assert comp_dict.get(key) == await async_map.get(key)
+            elif key in comp_dict:
+                await async_map.delete(key)
+                del comp_dict[key]
+        keys = list(range(60))
+        assert [comp_dict.get(key) for key in keys] == await async_map.get_many(keys)
+        assert len(async_map) == len(comp_dict)
+
+        # in-memory hit never goes to executor
+        await async_map.set("hot", "value")
+        submit_num = executor.submit_num
+        assert await async_map.get("hot") == "value"
+        assert executor.submit_num == submit_num
+
+        # concurrent gets of a spilled key share one disk read
+        await async_map.set("cold", "value")
+        for key in range(100, 120):
+            await async_map.set(key, key)
+        assert not async_map.disk_based_hashmap._get_in_memory("cold")[0]
+        submit_num = executor.submit_num
+        assert await async_map.get_many(["cold"] * 10) == ["value"] * 10
+        assert executor.submit_num == submit_num + 1
+
+        # event loop never waits for LRU lock held by a spilling thread
+        await async_map.set("warm", "value")
+        lru_lock = async_map.disk_based_hashmap._lru_lock
+        locked, released = threading.Event(), threading.Event()
+
+        def hold_lru_lock():
+            with lru_lock:
+                locked.set()
+                # blocked event loop could never release it
+                released.wait(1)
+
+        thread = threading.Thread(target=hold_lru_lock)
+        thread.start()
+        locked.wait()
+        tasks = [
+            asyncio.ensure_future(async_map.get("warm")),
+            asyncio.ensure_future(async_map.set("warm", "new_value")),
+        ]
+        await asyncio.sleep(0.05)
+        assert not any(task.done() for task in tasks)
+        released.set()
+        # both of them went to executor, get could run after set there
+        assert (await asyncio.gather(*tasks))[0] in ("value", "new_value")
+        assert await async_map.get("warm") == "new_value"
+        thread.join()
+        await async_map.close()
+
+    # logged updates never append to log on event loop
+    async def logged_scenario():
+        logged_map = AsyncDiskBasedHashMap(
+            executor=executor,
+            work_dir=test_case_package,
+            persistent=True,
+            durability="periodic",
+        )
+        append = logged_map.disk_based_hashmap._write_ahead_log.append
+        append_threads = []
+
+        def recording_append(record):
+            append_threads.append(threading.current_thread())
+            return append(record)
+
+        logged_map.disk_based_hashmap._write_ahead_log.append = recording_append
+        await logged_map.set("hot", "value")
+        assert append_threads and threading.main_thread() not in append_threads
+        assert await logged_map.get("hot") == "value"
+        await logged_map.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(scenario())
+        _clean_up(test_case_package)
+        loop.run_until_complete(logged_scenario())
+    finally:
+        loop.close()
+    executor.shutdown()
+
+    _clean_up(test_case_package)
+
+
+def test_get_many_and_set_many():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    for disk_map_class in (DiskBasedHashMap, ConcurrentDiskBasedHashMap):
+        disk_map = disk_map_class(
+            bucket_num=4, memory_threshold=512, work_dir=test_case_package
+        )
+        comp_dict = dict()
+        for _ in range(20):
+            items = [
+                (random.randint(0, 199), "value_{}".format(random.random()))
+                for _ in range(random.randint(0, 30))
+            ]
+            if random.randint(0, 1) == 0:
+                disk_map.set_many(items)
+            else:
+                disk_map.set_many(dict(items))
+            comp_dict.update(items)
+            keys = [random.randint(0, 249) for _ in range(50)]
+            assert disk_map.get_many(keys, "missing") == [
+                comp_dict.get(key, "missing") for key in keys
+            ]
+            assert disk_map._in_memory_objects.memory_usage <= 512
+        assert sorted(comp_dict.items()) == sorted(disk_map.items())
+
+        # records of a bucket are read by one sweep in file order, balance runs once
+        # per batch and reuses values of the batch instead of reading them again
+        read_ranges, balance_calls = [], []
+        for bucket in disk_map._buckets:
+            pread = bucket._pread
+            bucket._pread = lambda segment, address, length, bucket=bucket, pread=pread: (
+                read_ranges.append((bucket, address, address + length))
+                or pread(segment, address, length)
+            )
+        balance = disk_map._balance
+        disk_map._balance = lambda: balance_calls.append(len(read_ranges)) or balance()
+        disk_entries = len(disk_map._disk_objects)
+        keys = list(comp_dict)
+        random.shuffle(keys)
+        assert disk_map.get_many(keys) == [comp_dict[key] for key in keys]
+        assert len(balance_calls) == 1 and balance_calls[0] > 0
+        assert len(read_ranges) == balance_calls[0]
+        assert len(read_ranges) < disk_entries
+        for bucket in disk_map._buckets:
+            assert len([read for read in read_ranges if read[0] is bucket]) <= 1
+        disk_map.close()
+
+    # concurrent batches read records without stripes locked, in-memory hits of other
+    # threads never wait for them
+    _clean_up(test_case_package)
+    disk_map = ConcurrentDiskBasedHashMap(
+        bucket_num=4, memory_threshold=512, work_dir=test_case_package, lock_stripes=4
+    )
+    comp_dict = dict()
+    for key in range(200):
+        disk_map[key] = comp_dict[key] = "value_{}".format(key)
+    locked_reads = []
+    for bucket in disk_map._buckets:
+        pread = bucket._pread
+
+        def locked_pread(segment, address, length, pread=pread):
+            locked_reads.append(any(stripe.locked() for stripe in disk_map._stripes))
+            return pread(segment, address, length)
+
+        bucket._pread = locked_pread
+    keys = list(comp_dict)
+    random.shuffle(keys)
+    assert disk_map.get_many(keys) == [comp_dict[key] for key in keys]
+    items = {key: "new_value_{}".format(key) for key in range(0, 250, 3)}
+    disk_map.set_many(items)
+    comp_dict.update(items)
+    assert len(locked_reads) > 0 and not any(locked_reads)
+    assert sorted(comp_dict.items()) == sorted(disk_map.items())
+
+    # records moved by other threads during the sweep are looked up again
+    moved_keys = [key for key in keys if not disk_map._get_in_memory(key)[0]][:20]
+    for bucket in disk_map._buckets:
+        load_values = bucket.load_values
+
+        def moving_load_values(disk_addresses, load_values=load_values):
+            values = load_values(disk_addresses)
+            for key in moved_keys[:5]:
+                disk_map[key] = comp_dict[key] = "moved_{}".format(key)
+            return values
+
+        bucket.load_values = moving_load_values
+    assert disk_map.get_many(moved_keys) == [comp_dict[key] for key in moved_keys]
+
+    # a failed sweep doesn't fail records of it, they are read again one by one
+    disk_keys = [key for key in keys if not disk_map._get_in_memory(key)[0]][:20]
+    for bucket in disk_map._buckets:
+
+        def failing_load_values(disk_addresses):
+            raise IOError("Disk is busy")
+
+        bucket.load_values = failing_load_values
+    assert disk_map.get_many(disk_keys) == [comp_dict[key] for key in disk_keys]
+    disk_keys = [key for key in keys if not disk_map._get_in_memory(key)[0]][:20]
+    items = {key: "failed_sweep_{}".format(key) for key in disk_keys + [1000]}
+    disk_map.set_many(items)
+    comp_dict.update(items)
+    assert sorted(comp_dict.items()) == sorted(disk_map.items())
+    disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_streaming_scan():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    for disk_map_class, kwargs in (
+        (DiskBasedHashMap, {}),
+        (DiskBasedHashMap, {"compression": "zlib", "compression_block_size": 256}),
+        (ConcurrentDiskBasedHashMap, {}),
+    ):
+        disk_map = disk_map_class(
+            bucket_num=4, memory_threshold=512, work_dir=test_case_package, **kwargs
+        )
+        comp_dict = dict()
+        for _ in range(2000):
+            key = random.randint(0, 299)
+            if random.randint(1, 10) <= 8:
+                disk_map[key] = "value_{}".format(random.random())
+                comp_dict[key] = disk_map[key]
+            elif key in comp_dict:
+                del disk_map[key]
+                del comp_dict[key]
+        assert len(disk_map._disk_objects) > 0
+
+        # scan neither loads entries nor reorders eviction policy
+        in_memory_objects = disk_map._in_memory_objects
+        hits, misses = in_memory_objects.hits, in_memory_objects.misses
+        memory_usage = in_memory_objects.memory_usage
+        lru_order = [node.value for node in in_memory_objects._lru_list]
+        disk_order = [node.value for node in disk_map._disk_objects]
+        assert sorted(disk_map) == sorted(comp_dict)
+        assert sorted(disk_map.keys()) == sorted(comp_dict)
+        assert sorted(disk_map.values()) == sorted(comp_dict.values())
+        assert sorted(disk_map.items()) == sorted(comp_dict.items())
+        assert (in_memory_objects.hits, in_memory_objects.misses) == (hits, misses)
+        assert in_memory_objects.memory_usage == memory_usage
+        assert [node.value for node in in_memory_objects._lru_list] == lru_order
+        assert [node.value for node in disk_map._disk_objects] == disk_order
+
+        # unfinished scan doesn't block map
+        items = iter(disk_map.items())
+        key, value = next(items)
+        assert comp_dict[key] == value
+        disk_map[key] = "updated"
+        assert disk_map[key] == "updated"
+        del items
+        disk_map.close()
+
+    # segments compacted away during a scan, segment 0 included, stay readable by it
+    _clean_up(test_case_package)
+    disk_map = DiskBasedHashMap(
+        bucket_num=1,
+        memory_threshold=512,
+        work_dir=test_case_package,
+        segment_size=512,
+        compaction_garbage_ratio=0.5,
+    )
+    comp_dict = dict()
+    for key in range(100):
+        disk_map[key] = comp_dict[key] = "value_{}".format(key)
+    values = iter(disk_map.values())
+    scanned_values = [next(values)]
+    for key in range(100):
+        disk_map[key] = "new_value_{}".format(key)
+    disk_map.compact()
+    assert not os.path.exists(disk_map._buckets[0].filepath + ".1")
+    scanned_values.extend(values)
+    assert sorted(scanned_values) == sorted(comp_dict.values())
+    assert sorted(disk_map.values()) == sorted(
+        "new_value_{}".format(key) for key in range(100)
+    )
+    disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_pinned_keys():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    for disk_map_class in (DiskBasedHashMap, ConcurrentDiskBasedHashMap):
+        _clean_up(test_case_package)
+        disk_map = disk_map_class(
+            bucket_num=2,
+            memory_threshold=512,
+            work_dir=test_case_package,
+            max_load_factor=8,
+            pin_keys=True,
+            persistent=True,
+        )
+        comp_dict = dict()
+        for _ in range(3000):
+            key = "key_{}".format(random.randint(0, 299))
+            weight_index = random.randint(1, 10)
+            if weight_index <= 5:
+                disk_map[key] = random.random()
+                comp_dict[key] = disk_map[key]
+            elif weight_index <= 8:
+                assert comp_dict.get(key) == disk_map.get(key)
+            elif key in comp_dict:
+                del disk_map[key]
+                del comp_dict[key]
+            assert disk_map._in_memory_objects.memory_usage <= 512
+        disk_map.compact()
+        assert len(disk_map._disk_objects) > 0
+        for node in disk_map._disk_objects:
+            assert node.value.key.is_in_memory()
+
+        # keys are answered from memory, a get reads one value record
+        reads = []
+        for bucket in disk_map._buckets:
+            load_value = bucket.load_value
+            bucket.load_value = lambda disk_address, load_value=load_value: (
+                reads.append(disk_address) or load_value(disk_address)
+            )
+            bucket.stream_values = None
+        assert sorted(disk_map) == sorted(comp_dict)
+        assert len(disk_map) == len(comp_dict)
+        assert all(key in disk_map for key in comp_dict)
+        assert "missing" not in disk_map
+        assert reads == []
+        disk_key = disk_map._disk_objects.peek_first().value.key.value
+        disk_map._balance = lambda: None
+        assert disk_map[disk_key] == comp_dict[disk_key]
+        assert len(reads) == 1
+        disk_map.close()
+
+        # checkpoint is readable with or without key directory mode
+        for pin_keys in (False, True):
+            disk_map = disk_map_class(
+                memory_threshold=512,
+                work_dir=test_case_package,
+                pin_keys=pin_keys,
+                persistent=True,
+            )
+            assert sorted(comp_dict.items()) == sorted(disk_map.items())
+            for key in list(comp_dict)[:50]:
+                disk_map[key] = comp_dict[key] = "updated"
+            disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_contains_and_peek():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    for disk_map_class in (DiskBasedHashMap, ConcurrentDiskBasedHashMap):
+        disk_map = disk_map_class(
+            bucket_num=4, memory_threshold=512, work_dir=test_case_package
+        )
+        comp_dict = dict()
+        for _ in range(1000):
+            key = random.randint(0, 199)
+            disk_map[key] = comp_dict[key] = "value_{}".format(random.random())
+        assert len(disk_map._disk_objects) > 0
+
+        # neither lookup promotes, loads or spills any entry
+        in_memory_objects = disk_map._in_memory_objects
+        hits, misses = in_memory_objects.hits, in_memory_objects.misses
+        memory_usage = in_memory_objects.memory_usage
+        lru_order = [node.value for node in in_memory_objects._lru_list]
+        disk_order = [node.value for node in disk_map._disk_objects]
+        offsets = [bucket._offset for bucket in disk_map._buckets]
+        for key in range(250):
+            assert (key in disk_map) == (key in comp_dict)
+            assert disk_map.peek(key, "missing") == comp_dict.get(key, "missing")
+        assert disk_map.peek(-1) is None
+        assert (in_memory_objects.hits, in_memory_objects.misses) == (hits, misses)
+        assert in_memory_objects.memory_usage == memory_usage
+        assert [node.value for node in in_memory_objects._lru_list] == lru_order
+        assert [node.value for node in disk_map._disk_objects] == disk_order
+        assert [bucket._offset for bucket in disk_map._buckets] == offsets
+        disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_clean_eviction():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    for disk_map_class in (DiskBasedHashMap, ConcurrentDiskBasedHashMap):
+        disk_map = disk_map_class(
+            bucket_num=4, memory_threshold=1024, work_dir=test_case_package
+        )
+        comp_dict = dict()
+        for key in range(200):
+            disk_map[key] = comp_dict[key] = "value_{}".format(random.random())
+        for key in range(200):
+            assert disk_map[key] == comp_dict[key]
+
+        # read-only churn reloads and evicts entries without writing any record
+        offsets = [bucket._offset for bucket in disk_map._buckets]
+        for _ in range(2000):
+            key = random.randint(0, 199)
+            assert disk_map[key] == comp_dict[key]
+        assert [bucket._offset for bucket in disk_map._buckets] == offsets
+
+        # updated value is dirty, its old record is garbage
+        garbage_size = sum(bucket.garbage_size for bucket in disk_map._buckets)
+        for _ in range(500):
+            key = random.randint(0, 199)
+            if random.randint(0, 1) == 0:
+                disk_map[key] = comp_dict[key] = "value_{}".format(random.random())
+            else:
+                assert disk_map[key] == comp_dict[key]
+        assert sum(bucket.garbage_size for bucket in disk_map._buckets) > garbage_size
+        disk_map.compact()
+        assert sum(bucket.garbage_size for bucket in disk_map._buckets) == 0
+        for _ in range(2000):
+            key = random.randint(0, 199)
+            assert disk_map[key] == comp_dict[key]
+        assert sorted(comp_dict.items()) == sorted(disk_map.items())
+        for key in range(0, 200, 2):
+            del disk_map[key]
+            del comp_dict[key]
+        disk_map.compact()
+        assert sorted(comp_dict.items()) == sorted(disk_map.items())
+        disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_watermarks():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    for disk_map_class, kwargs in (
+        (DiskBasedHashMap, {}),
+        (DiskBasedHashMap, {"compression": "zlib", "compression_block_size": 256}),
+        (ConcurrentDiskBasedHashMap, {"lock_stripes": 1}),
+    ):
+        disk_map = disk_map_class(
+            bucket_num=4,
+            memory_threshold=4096,
+            low_watermark=0.5,
+            work_dir=test_case_package,
+            **kwargs
+        )
+        # count spill writes, one call per bucket and batch
+        write_calls, written_values = [], []
+        for bucket in disk_map._buckets:
+            persist_values = bucket.persist_values
+            bucket.persist_values = lambda values, persist_values=persist_values: (
+                write_calls.append(len(values))
+                or written_values.extend(values)
+                or persist_values(values)
+            )
+        comp_dict = dict()
+        for _ in range(3000):
+            key = random.randint(0, 499)
+            weight_index = random.randint(1, 10)
+            disk_object_num = len(disk_map._disk_objects)
+            if weight_index <= 6:
+                disk_map[key] = comp_dict[key] = "value_{}".format(random.random())
+            elif weight_index <= 9:
+                assert comp_dict.get(key) == disk_map.get(key)
+            elif key in comp_dict:
+                del disk_map[key]
+                del comp_dict[key]
+            new_memory_usage = disk_map._in_memory_objects.memory_usage
+            assert new_memory_usage <= 4096
+            # spill only starts above high watermark, and goes down to low watermark
+            if len(disk_map._disk_objects) > disk_object_num:
+                assert new_memory_usage <= 2048
+        assert sorted(comp_dict.items()) == sorted(disk_map.items())
+        assert len(write_calls) > 0
+        assert len(write_calls) * 4 < len(written_values)
+        disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_key_filter():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+
+    for disk_map_class, key_filter_capacity in (
+        (DiskBasedHashMap, 1000),
+        (DiskBasedHashMap, 16),
+        (ConcurrentDiskBasedHashMap, 1000),
+    ):
+        _clean_up(test_case_package)
+        disk_map = disk_map_class(
+            bucket_num=2,
+            memory_threshold=512,
+            work_dir=test_case_package,
+            persistent=True,
+            key_filter_capacity=key_filter_capacity,
+        )
+        comp_dict = dict()
+        for _ in range(3000):
+            key = random.randint(0, 299)
+            weight_index = random.randint(1, 10)
+            if weight_index <= 5:
+                disk_map[key] = comp_dict[key] = random.random()
+            elif weight_index <= 8:
+                assert comp_dict.get(key) == disk_map.get(key)
+                assert (key in comp_dict) == (key in disk_map)
+            else:
+                assert comp_dict.pop(key, None) == disk_map.pop(key, None)
+        assert sorted(comp_dict.items()) == sorted(disk_map.items())
+        # a full filter is disabled instead of giving false negatives
+        assert disk_map._key_filter.enabled == (key_filter_capacity == 1000)
+
+        # misses don't read spilled keys, filter holds hashes so that a miss whose hash
+        # collides still compares keys
+        balance, disk_map._balance = disk_map._balance, lambda: None
+        reads = []
+        for bucket in disk_map._buckets:
+            load_value = bucket.load_value
+            bucket.load_value = lambda disk_address, load_value=load_value: (
+                reads.append(disk_address) or load_value(disk_address)
+            )
+        missing_keys = [key + 300 for key in comp_dict]
+        for key in missing_keys:
+            assert key not in disk_map
+            assert disk_map.get(key) is None
+        assert disk_map.get_many(missing_keys) == [None] * len(missing_keys)
+        assert reads == []
+        disk_map._balance = balance
+        disk_map.close()
+
+        # filter is rebuilt on reopen
+        disk_map = disk_map_class(
+            memory_threshold=512,
+            work_dir=test_case_package,
+            persistent=True,
+            key_filter_capacity=key_filter_capacity,
+        )
+        assert len(disk_map._key_filter) == (
+            len(comp_dict) if key_filter_capacity == 1000 else 0
+        )
+        for key in range(600):
+            assert comp_dict.get(key) == disk_map.get(key)
+        disk_map.clear()
+        assert disk_map._key_filter.enabled
+
+        # equal keys share a hash but not a pickled form, unequal keys could share one
+        disk_map[1] = "a"
+        assert disk_map[1.0] == "a" and True in disk_map
+        disk_map[True] = "b"
+        assert len(disk_map) == 1 and list(disk_map.items()) == [(1, "b")]
+        disk_map[-1] = disk_map[-2] = "c"
+        del disk_map[-1]
+        assert disk_map[-2] == "c" and -1 not in disk_map
+        del disk_map[1.0]
+        assert len(disk_map) == 1 and 1 not in disk_map
+        disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_record_checksums():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    # varint length supports records of any size
+    disk_map = DiskBasedHashMap(
+        bucket_num=1, memory_threshold=0, work_dir=test_case_package
+    )
+    values = [b"", b"x" * 127, b"y" * 128, os.urandom(100000)]
+    for index, value in enumerate(values):
+        disk_map[index] = value
+    for index, value in enumerate(values):
+        assert disk_map[index] == value
+    assert disk_map.verify() == {}
+    disk_map.close()
+
+    comp_dict = {}
+    with DiskBasedHashMap(
+        bucket_num=2, memory_threshold=256, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        for i in range(200):
+            disk_map["key_{}".format(i)] = comp_dict["key_{}".format(i)] = i
+    filepath = disk_map._buckets[0].filepath
+    file_size = os.path.getsize(filepath)
+
+    # crash leaves a torn record, it's truncated when map is recovered
+    os.remove(os.path.join(test_case_package, DiskBasedHashMap.MANIFEST_FILENAME))
+    with open(filepath, "ab") as f:
+        f.write(bytes((0xB2, 0, 0, 0, 0, 0, 0, 100)) + b"torn")
+    with DiskBasedHashMap(
+        memory_threshold=256, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        assert os.path.getsize(filepath) == file_size
+        assert disk_map.verify() == {}
+        assert sorted(disk_map.items()) == sorted(comp_dict.items())
+
+    # zero-filled tail is no record, it's cut at the last intact one
+    file_size = os.path.getsize(filepath)
+    with open(filepath, "ab") as f:
+        f.write(bytes(96))
+    with DiskBasedHashMap(
+        memory_threshold=256, work_dir=test_case_package, persistent=True
+    ) as disk_map:
+        assert disk_map.verify() == {0: (0, file_size)}
+        assert disk_map._buckets[0].verify(truncate=True) == (0, file_size)
+        assert os.path.getsize(filepath) == file_size
+        assert disk_map.verify() == {}
+        assert sorted(disk_map.items()) == sorted(comp_dict.items())
+
+    # flipped byte is caught by checksum
+    disk_map = DiskBasedHashMap(
+        memory_threshold=256, work_dir=test_case_package, persistent=True
+    )
+    disk_addresses = list(disk_map._buckets[0].record_addresses())
+    disk_address = disk_addresses[len(disk_addresses) // 2]
+    with open(filepath, "r+b") as f:
+        f.seek(disk_address.address + disk_address.size - 1)
+        byte = f.read(1)
+        f.seek(disk_address.address + disk_address.size - 1)
+        f.write(bytes((byte[0] ^ 0xFF,)))
+    assert disk_map.verify() == {0: (0, disk_address.address)}
+    try:
+        disk_map._buckets[0].load_value(disk_address)
+        assert False
+    except Exception as e:
+        assert type(e).__name__ == "CorruptRecordError"
+    disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_durability():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    crash_package = test_case_package + "_crash"
+
+    for map_class, durability in (
+        (DiskBasedHashMap, "group"),
+        (DiskBasedHashMap, "periodic"),
+        (ConcurrentDiskBasedHashMap, "group"),
+    ):
+        _clean_up(test_case_package)
+        comp_dict = {}
+        disk_map = map_class(
+            bucket_num=2,
+            memory_threshold=1024,
+            max_load_factor=4,
+            work_dir=test_case_package,
+            persistent=True,
+            durability=durability,
+            sync_interval=0.01,
+        )
+        for round in range(2):
+            for _ in range(300):
+                key = random.randint(0, 200)
+                if random.random() < 0.2:
+                    disk_map.pop(key, None)
+                    comp_dict.pop(key, None)
+                else:
+                    disk_map[key] = comp_dict[key] = random.randint(0, 1000000)
+            items = {random.randint(0, 200): round for _ in range(20)}
+            disk_map.set_many(items)
+            comp_dict.update(items)
+            if round == 0:
+                # updates after a full checkpoint are replayed on top of it
+                disk_map.compact()
+        if durability == "periodic":
+            time.sleep(0.2)
+
+        # crash, files are copied as they are without closing map
+        if os.path.exists(crash_package):
+            shutil.rmtree(crash_package)
+        shutil.copytree(test_case_package, crash_package)
+        with map_class(
+            memory_threshold=1024,
+            work_dir=crash_package,
+            persistent=True,
+            durability=durability,
+        ) as recovered_map:
+            assert dict(recovered_map.items()) == comp_dict
+        disk_map.close()
+        assert os.path.getsize(disk_map._write_ahead_log.filepath) == 0
+
+    # crash right after compactor swaps a bucket file, compaction doesn't wake
+    # compactor again by its checkpoints
+    for map_class, durability in (
+        (DiskBasedHashMap, "periodic"),
+        (ConcurrentDiskBasedHashMap, "group"),
+    ):
+        _clean_up(test_case_package)
+        if os.path.exists(crash_package):
+            shutil.rmtree(crash_package)
+        comp_dict = {}
+        disk_map = map_class(
+            bucket_num=2,
+            memory_threshold=1024,
+            max_load_factor=2,
+            work_dir=test_case_package,
+            persistent=True,
+            durability=durability,
+            sync_interval=0.01,
+            compaction_garbage_ratio=0.5,
+        )
+        compact_bucket = disk_map._compact_bucket
+        compaction_nums = []
+        armed, crashed = threading.Event(), threading.Event()
+
+        def crashing_compact_bucket(bucket, garbage_ratio=None):
+            compact_bucket(bucket, garbage_ratio)
+            compaction_nums.append(1)
+            if armed.is_set() and not crashed.is_set():
+                shutil.copytree(test_case_package, crash_package)
+                crashed.set()
+
+        disk_map._compact_bucket = crashing_compact_bucket
+        for key in range(400):
+            disk_map[key] = comp_dict[key] = "value_{}".format(key)
+        for key in range(0, 400, 3):
+            disk_map[key] = comp_dict[key] = "new_value_{}".format(key)
+        if durability == "periodic":
+            time.sleep(0.2)
+        # same values are written again until compactor runs
+        armed.set()
+        for _ in range(100):
+            for key in random.sample(range(400), 50):
+                disk_map[key] = comp_dict[key]
+            if crashed.wait(0.05):
+                break
+        assert crashed.is_set()
+        with map_class(
+            memory_threshold=1024,
+            work_dir=crash_package,
+            persistent=True,
+            durability=durability,
+        ) as recovered_map:
+            assert dict(recovered_map.items()) == comp_dict
+        # compactor goes idle once writes stop
+        time.sleep(0.5)
+        compaction_num = len(compaction_nums)
+        time.sleep(0.5)
+        assert len(compaction_nums) == compaction_num
+        disk_map.close()
+
+    # log is reset by a full checkpoint once it exceeds max log size
+    for map_class, durability in (
+        (DiskBasedHashMap, "periodic"),
+        (ConcurrentDiskBasedHashMap, "group"),
+    ):
+        _clean_up(test_case_package)
+        if os.path.exists(crash_package):
+            shutil.rmtree(crash_package)
+        comp_dict = {}
+        disk_map = map_class(
+            bucket_num=2,
+            memory_threshold=1024,
+            work_dir=test_case_package,
+            persistent=True,
+            durability=durability,
+            sync_interval=0.01,
+            max_log_size=16 * 1024,
+        )
+        log_sizes = []
+        for index in range(5000):
+            key = random.randint(0, 49)
+            disk_map[key] = comp_dict[key] = "value_{}".format(index)
+            log_sizes.append(os.path.getsize(disk_map._write_ahead_log.filepath))
+        assert max(log_sizes) < 17 * 1024
+        assert log_sizes[-1] < max(log_sizes)
+        if durability == "periodic":
+            time.sleep(0.2)
+        shutil.copytree(test_case_package, crash_package)
+        with map_class(
+            memory_threshold=1024,
+            work_dir=crash_package,
+            persistent=True,
+            durability=durability,
+        ) as recovered_map:
+            assert dict(recovered_map.items()) == comp_dict
+        disk_map.close()
+
+    # concurrent writers share one fsync, map is unlocked while they wait for it
+    for map_class in (DiskBasedHashMap, ConcurrentDiskBasedHashMap):
+        _clean_up(test_case_package)
+        disk_map = map_class(
+            work_dir=test_case_package, persistent=True, durability="group"
+        )
+        write_ahead_log = disk_map._write_ahead_log
+        bucket_sync = write_ahead_log._bucket.sync
+        sync_nums = []
+
+        def slow_sync(bucket_sync=bucket_sync, sync_nums=sync_nums):
+            sync_nums.append(1)
+            time.sleep(0.005)
+            bucket_sync()
+
+        write_ahead_log._bucket.sync = slow_sync
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda key: disk_map.__setitem__(key, key), range(400)))
+        assert 0 < len(sync_nums) < 400
+        assert write_ahead_log._synced == write_ahead_log._appended == 400
+        disk_map.close()
+
+    # writers don't wait for periodic fsync of log
+    _clean_up(test_case_package)
+    disk_map = DiskBasedHashMap(
+        work_dir=test_case_package,
+        persistent=True,
+        durability="periodic",
+        sync_interval=0.01,
+    )
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        time.sleep(0.2)
+        fsync(fd)
+
+    os.fsync = slow_fsync
+    try:
+        latencies, deadline = [], time.time() + 0.6
+        key = 0
+        while time.time() < deadline:
+            start = time.time()
+            disk_map[key] = key
+            latencies.append(time.time() - start)
+            key += 1
+            time.sleep(0.001)
+    finally:
+        os.fsync = fsync
+    assert max(latencies) < 0.1
+    disk_map.close()
+
+    for durability, persistent in (("fsync", True), ("group", False)):
+        try:
+            DiskBasedHashMap(
+                work_dir=test_case_package, persistent=persistent, durability=durability
+            )
+            assert False
+        except ValueError:
+            pass
+
+    shutil.rmtree(crash_package)
+    _clean_up(test_case_package)
+
+
+def test_segmented_buckets():
+    def segment_filepaths():
+        prefix = os.path.join(test_case_package, "bucket_0.txt.")
+        return sorted(
+            (
+                os.path.join(test_case_package, name)
+                for name in os.listdir(test_case_package)
+                if name.startswith("bucket_0.txt.")
+            ),
+            key=lambda filepath: int(filepath[len(prefix) :]),
+        )
+
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    segment_size = 1024
+    comp_dict = {}
+    disk_map = DiskBasedHashMap(
+        bucket_num=1,
+        memory_threshold=0,
+        work_dir=test_case_package,
+        persistent=True,
+        segment_size=segment_size,
+    )
+    for i in range(300):
+        disk_map[i] = comp_dict[i] = "value_{}".format(i) * 4
+    # sealed segments exceed size cap by at most one record
+    assert len(segment_filepaths()) > 5
+    for filepath in segment_filepaths()[:-1]:
+        assert segment_size <= os.path.getsize(filepath) < segment_size + 64
+    assert disk_map._buckets[0].garbage_ratio == 0.0
+
+    # mostly dead segments are merged into active one and dropped
+    for i in range(250):
+        del disk_map[i]
+        del comp_dict[i]
+    assert disk_map._buckets[0].garbage_ratio > 0.8
+    file_num = len(segment_filepaths())
+    disk_map._compact_bucket(disk_map._buckets[0], 0.8)
+    disk_map._checkpoint_rewritten(disk_map._buckets)
+    assert len(segment_filepaths()) < file_num
+    assert disk_map._buckets[0].garbage_ratio < 0.8
+    assert dict(disk_map.items()) == comp_dict
+
+    for i in range(100):
+        key = random.randint(0, 300)
+        disk_map[key] = comp_dict[key] = i
+    disk_map.compact()
+    assert disk_map.verify() == {}
+    disk_map.close()
+
+    with DiskBasedHashMap(
+        memory_threshold=0,
+        work_dir=test_case_package,
+        persistent=True,
+        segment_size=segment_size,
+    ) as disk_map:
+        assert dict(disk_map.items()) == comp_dict
+
+    _clean_up(test_case_package)
+
+
+def test_new_buckets_never_list_work_dir(monkeypatch):
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    disk_map = DiskBasedHashMap(
+        bucket_num=2,
+        memory_threshold=0,
+        work_dir=test_case_package,
+        persistent=True,
+        max_load_factor=1,
+        segment_size=256,
+    )
+    listed = []
+    listdir = os.listdir
+    monkeypatch.setattr(
+        os, "listdir", lambda path: listed.append(path) or listdir(path)
+    )
+    # split targets are new buckets, they have no segments to discover
+    for i in range(50):
+        disk_map[i] = "value_{}".format(i) * 8
+    assert len(disk_map._buckets) > 2
+    assert listed == []
+    bucket_num = len(disk_map._buckets)
+    disk_map.close()
+
+    # reopen lists work_dir once for segments of all buckets
+    with DiskBasedHashMap(
+        memory_threshold=0,
+        work_dir=test_case_package,
+        persistent=True,
+        max_load_factor=1,
+        segment_size=256,
+    ) as disk_map:
+        assert len(listed) == 1
+        assert len(disk_map._buckets) == bucket_num
+        assert dict(disk_map.items()) == {
+            i: "value_{}".format(i) * 8 for i in range(50)
+        }
+
+    _clean_up(test_case_package)
+
+
+def test_memory_budget():
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    # fixed sizer charges 128 bytes per entry, budget holds 100 entries
+    entry_size = 128
+    budget = MemoryBudget(100 * entry_size, low_watermark=0.5)
+    hot_map = DiskBasedHashMap(
+        work_dir=os.path.join(test_case_package, "hot"),
+        sizer="fixed",
+        memory_budget=budget,
+    )
+    cold_map = DiskBasedHashMap(
+        work_dir=os.path.join(test_case_package, "cold"),
+        sizer="fixed",
+        memory_budget=budget,
+    )
+    reserved_map = ConcurrentDiskBasedHashMap(
+        work_dir=os.path.join(test_case_package, "reserved"),
+        sizer="fixed",
+        memory_budget=budget,
+        memory_reservation=20 * entry_size,
+    )
+    maps = [hot_map, cold_map, reserved_map]
+    comp_dicts = [{}, {}, {}]
+    for disk_map, comp_dict in zip([reserved_map, cold_map], comp_dicts[2:0:-1]):
+        for i in range(40):
+            disk_map[i] = comp_dict[i] = "value_{}".format(i)
+    # per-map threshold doesn't apply, nothing is spilled within budget
+    assert budget.memory_usage == 80 * entry_size
+    assert len(cold_map._disk_objects) == 0
+
+    # hot map grows over budget, older entries of other maps are spilled first
+    for i in range(60):
+        hot_map[i] = comp_dicts[0][i] = i
+        assert budget.memory_usage <= budget.memory_threshold
+    assert len(hot_map._disk_objects) == 0
+    assert cold_map.eviction_policy.memory_usage < 40 * entry_size
+    assert reserved_map.eviction_policy.memory_usage >= 20 * entry_size
+
+    for _ in range(1000):
+        index = random.randint(0, 2)
+        key = random.randint(0, 80)
+        if random.random() < 0.7:
+            assert maps[index].get(key) == comp_dicts[index].get(key)
+        else:
+            maps[index][key] = comp_dicts[index][key] = random.random()
+        assert budget.memory_usage <= budget.memory_threshold
+    assert reserved_map.eviction_policy.memory_usage >= 20 * entry_size
+    for disk_map, comp_dict in zip(maps, comp_dicts):
+        assert dict(disk_map.items()) == comp_dict
+
+    # maps dropping out release their share
+    budget.unregister(cold_map)
+    assert budget.memory_usage == sum(
+        disk_map.eviction_policy.memory_usage for disk_map in (hot_map, reserved_map)
+    )
+    for disk_map in maps:
+        disk_map.close()
+
+    _clean_up(test_case_package)
+
+
+def test_adaptive_threshold():
+    def wait_until(condition):
+        deadline = time.time() + 5
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.01)
+
+    test_case_package = os.path.join(
+        package_root, inspect.currentframe().f_code.co_name
+    )
+    _clean_up(test_case_package)
+
+    rss, available, total = sample_memory()
+    if sys.platform.startswith("linux"):
+        assert rss > 0 and 0 < available <= total
+
+    # host memory is faked, rss of 1 byte gives map the whole headroom
+    host = {"available": 1000 * 1024, "total": 1000 * 1024}
+    entry_size = 128
+    floor, ceiling = 10 * entry_size, 100 * entry_size
+    comp_dict = {}
+    disk_map = DiskBasedHashMap(
+        work_dir=test_case_package,
+        memory_threshold=floor,
+        memory_ceiling=ceiling,
+        memory_sample_interval=0.01,
+        sizer="fixed",
+    )
+    disk_map._adaptive_threshold._sampler = lambda: (
+        1,
+        host["available"],
+        host["total"],
+    )
+    # sampling starts with first balance, threshold grows while host has headroom
+    disk_map[-1] = comp_dict[-1] = -1
+    wait_until(lambda: disk_map._memory_threshold == ceiling)
+    for i in range(90):
+        disk_map[i] = comp_dict[i] = i
+    assert len(disk_map._disk_objects) == 0
+
+    # host is under pressure, map gives back the deficit without being used
+    memory_usage = disk_map.eviction_policy.memory_usage
+    host["available"] = 100 * 1024 - 40 * entry_size
+    wait_until(
+        lambda: disk_map.eviction_policy.memory_usage <= memory_usage - 40 * entry_size
+    )
+    assert len(disk_map._disk_objects) > 0
+    host["available"] = 0
+    wait_until(lambda: disk_map.eviction_policy.memory_usage <= floor)
+    assert disk_map._memory_threshold == floor
+    assert dict(disk_map.items()) == comp_dict
+
+    # unknown host memory keeps threshold, closed map stops sampling
+    host["available"] = None
+    disk_map.close()
+    assert disk_map._adaptive_threshold._thread is None
+    for i in range(90):
+        disk_map[i] = comp_dict[i] = -i
+    assert disk_map._memory_threshold == floor
+    assert dict(disk_map.items()) == comp_dict
+    disk_map.close()
+
+    # sampling thread doesn't keep a map alive, it exits once map is collected
+    disk_map = DiskBasedHashMap(
+        work_dir=test_case_package,
+        memory_threshold=floor,
+        memory_ceiling=ceiling,
+        memory_sample_interval=0.01,
+    )
+    disk_map[0] = 0
+    thread = disk_map._adaptive_threshold._thread
+    assert thread is not None
+    map_reference = weakref.ref(disk_map)
+    del disk_map
+    gc.collect()
+    assert map_reference() is None
+    thread.join(5)
+    assert not thread.is_alive()
+
+    try:
+        DiskBasedHashMap(
+            work_dir=test_case_package,
+            memory_ceiling=ceiling,
+            memory_budget=MemoryBudget(ceiling),
+        )
+        assert False
+    except Exception as e:
+        assert isinstance(e, ValueError)
+
+    _clean_up(test_case_package)
+
+
 def _clean_up(test_case_package):
     if os.path.exists(test_case_package):
         shutil.rmtree(test_case_package)
@@ -544,6 +2539,20 @@ class Point(object):
         return self.x * 31 + self.y
 
 
+class PointCodec(Codec):
+    tag = 200
+
+    def can_encode(self, value):
+        return type(value) is Point
+
+    def encode(self, value):
+        return [str(value.x).encode(), b",", str(value.y).encode()]
+
+    def decode(self, data):
+        x, y = bytes(data).split(b",")
+        return Point(int(x), int(y))
+
+
 class Element(object):
     def __init__(self, name, cnt):
         self.name = name
@@ -551,3 +2560,13 @@ class Element(object):
 
     def __hash__(self):
         return hash(self.name) * 31 + self.cnt
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers=None):
+        super().__init__(max_workers=max_workers)
+        self.submit_num = 0
+
+    def submit(self, *args, **kwargs):
+        self.submit_num += 1
+        return super().submit(*args, **kwargs)
@@ -0,0 +1,94 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from concurrent_disk_based_hashmap import ConcurrentDiskBasedHashMap
+
+# marks a missing key in results of executor reads
+_MISSING = object()
+
+
+class AsyncDiskBasedHashMap(object):
+    """asyncio front-end of ConcurrentDiskBasedHashMap. In-memory hits and misses are
+       answered on event loop right away, disk loads, spill writes and bucket splits run
+       in a thread pool, so do all updates of a map with a write-ahead log. Concurrent
+       gets of the same spilled key share one disk read
+
+       Keyword arguments other than executor and max_workers are passed to the map
+    """
+
+    def __init__(self, executor=None, max_workers=4, **kwargs):
+        self._map = ConcurrentDiskBasedHashMap(**kwargs)
+        # executor is shut down on close only if it's created here
+        self._own_executor = executor is None
+        self._executor = (
+            ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="DiskBasedHashMap"
+            )
+            if executor is None
+            else executor
+        )
+        # key -> future of in-flight disk read
+        self._pending_reads = {}
+
+    def __len__(self):
+        return len(self._map)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def disk_based_hashmap(self):
+        """Underlying thread safe map, its blocking methods should not be called on
+           event loop
+        """
+        return self._map
+
+    async def get(self, key, default=None):
+        found, value = self._map._get_in_memory(key)
+        if found is None:
+            value = await self._read(key)
+            found = value is not _MISSING
+        return value if found else default
+
+    async def get_many(self, keys, default=None):
+        """Return values of keys in order, disk reads of different keys run concurrently"""
+        return await asyncio.gather(*[self.get(key, default) for key in keys])
+
+    async def set(self, key, value):
+        # a read started before this set must not be shared by later gets
+        self._pending_reads.pop(key, None)
+        if self._map._set_in_memory(key, value):
+            if self._map._needs_balance():
+                await self._run(self._map._grow_and_balance)
+        else:
+            await self._run(self._map.__setitem__, key, value)
+
+    async def delete(self, key):
+        """Delete key, raise KeyError if it doesn't exist"""
+        self._pending_reads.pop(key, None)
+        await self._run(self._map.__delitem__, key)
+
+    async def close(self):
+        await self._run(self._map.close)
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def _read(self, key):
+        """Return a future of the value of key, it's shared by concurrent readers"""
+        future = self._pending_reads.get(key)
+        if future is None:
+            future = self._run(self._map.get, key, _MISSING)
+            self._pending_reads[key] = future
+            future.add_done_callback(lambda _: self._forget_read(key, future))
+        # a cancelled reader must not cancel the read of others
+        return asyncio.shield(future)
+
+    def _forget_read(self, key, future):
+        if self._pending_reads.get(key) is future:
+            del self._pending_reads[key]
+
+    def _run(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
@@ -1,20 +1,148 @@
-import pickle
+from contextlib import ExitStack
+import mmap
+import os
+import struct
+import threading
+import zlib
 
+from codec import CodecRegistry
+from compression import NO_COMPRESSION, compress, decompress, resolve_compression
 from doubly_linkedlist import DoublyLinkedList
+from file_handle_pool import FileHandlePool
+from synchronization import synchronized
+
+# flag in record header, record is a block of several records compressed together
+BLOCK_FLAG = 0x80
+# block layout is record number, (codec tag, length) of every record and their data
+_BLOCK_COUNT = struct.Struct("<I")
+_BLOCK_ENTRY = struct.Struct("<BI")
+# record header v2 is magic and version byte, codec tag, flags, CRC32 of tag, flags and
+# data, then varint data length
+RECORD_MAGIC = 0xB2
+_HEADER = struct.Struct("<BBBI")
+# varint of a 64 bits length takes at most 10 bytes
+MAX_HEADER_SIZE = _HEADER.size + 10
+# bytes read together with record header, small records need a single read
+_READ_AHEAD = 4096
+# records of a batch load are read together while the gap between them is at most
+# read ahead, and the whole sweep is at most this size
+_SWEEP_SIZE = 1024 * 1024
+
+
+class CorruptRecordError(Exception):
+    """Record is torn or its checksum doesn't match"""
+
+    pass
+
+
+def segment_filepath(filepath, segment):
+    """Segment 0 is bucket file itself, so a single file bucket is its only segment"""
+    return filepath if segment == 0 else "{}.{}".format(filepath, segment)
+
+
+def existing_segments(directory):
+    """Return bucket filepath -> sorted segments of it on disk for every segmented
+       bucket file in directory, segment 0 always comes first
+    """
+    segments = {}
+    for name in os.listdir(directory or os.curdir):
+        filepath, _, segment = name.rpartition(".")
+        if filepath and segment.isdigit():
+            segments.setdefault(os.path.join(directory, filepath), [0]).append(
+                int(segment)
+            )
+    for filepath_segments in segments.values():
+        filepath_segments.sort()
+    return segments
 
 
 class Bucket(object):
-    def __init__(self, filepath):
+    def __init__(
+        self,
+        filepath,
+        file_handle_pool=None,
+        use_mmap=False,
+        truncate=True,
+        codec_registry=None,
+        compression=None,
+        compression_threshold=256,
+        block_size=None,
+        positional_io=False,
+        segment_size=None,
+        segments=None,
+    ):
         self._filepath = filepath
-        # create a new file or overwrite it
-        open(self._filepath, "wb").close()
-        self._offset = 0
-        # linked list node's value is key-value pair, key and value are BucketObject
+        # records are appended to active segment, it's sealed and never written again
+        # once it exceeds segment size. `None` means bucket is a single file
+        self._segment_size = segment_size
+        # create a new file or overwrite it, existing segments are kept when reopening.
+        # A new bucket has no segments on disk, segments of a reopened one are given
+        # by caller or found by listing directory once
+        if truncate:
+            segments = [0]
+        elif segments is None:
+            segments = [0] if segment_size is None else self._existing_segments()
+        if truncate or not os.path.exists(self._filepath):
+            open(self._filepath, "wb").close()
+        # long-lived handles shared with other buckets, avoid open/close per record
+        self._file_handle_pool = (
+            FileHandlePool(max_open_files=1)
+            if file_handle_pool is None
+            else file_handle_pool
+        )
+        # sealed segment -> its size, active segment is the last one
+        self._sealed_sizes = {
+            segment: os.path.getsize(segment_filepath(self._filepath, segment))
+            for segment in segments[:-1]
+        }
+        self._segment = segments[-1]
+        self._offset = os.path.getsize(segment_filepath(self._filepath, self._segment))
+        # segment -> bytes of records which are no longer referenced, every record of
+        # a reopened file is garbage until it's retained by restored map
+        self._segment_garbage = dict(self._sealed_sizes)
+        self._segment_garbage[self._segment] = self._offset
+        self._garbage_size = sum(self._segment_garbage.values())
+        # segments compacted away, they are dropped once no checkpoint refers to them
+        self._retired_segments = []
+        # sealed segments written since last sync
+        self._unsynced_segments = set()
+        # address of the latest checkpoint record, it's live until next checkpoint
+        self._checkpoint_address = None
+        # superseded checkpoints of active segment, counted once segment is sealed
+        self._stale_checkpoints = []
+        # codecs shared with other buckets, tag in record header tells which one is used
+        self._codec_registry = (
+            CodecRegistry() if codec_registry is None else codec_registry
+        )
+        # records shorter than threshold are written raw, compression doesn't pay off
+        self._compression = resolve_compression(compression)
+        self._compression_threshold = compression_threshold
+        # in block mode records are buffered and written as one block once buffered
+        # data exceeds block size, pending records are readable from buffer
+        self._block_size = block_size
+        self._pending_block = []
+        self._pending_size = 0
+        # addresses of pending records and released ones, sized once block is written
+        self._pending_addresses = []
+        self._pending_released = []
+        # the last decompressed block, ((segment, address), records), sequential reads
+        # hit it
+        self._block_cache = None
+        # read spilled records through memory mappings of segments instead of
+        # seek + read, segment -> mapping
+        self._use_mmap = use_mmap
+        self._mmaps = {}
+        # records are read and written by os.pread and os.pwrite on a leased handle, so
+        # that records could be read by several threads without locking bucket
+        self._positional_io = positional_io
+        # guard appends, pending block and garbage accounting
+        self._lock = threading.RLock()
+        # linked list node's value is BucketEntry
         self._linked_list = DoublyLinkedList()
 
     def __str__(self):
-        return "(filepath: {}, offset: {}, linked_list: {})".format(
-            self._filepath, self._offset, self._linked_list
+        return "(filepath: {}, segment: {}, offset: {}, linked_list: {})".format(
+            self._filepath, self._segment, self._offset, self._linked_list
         )
 
     @property
@@ -25,63 +153,818 @@ class Bucket(object):
     def linked_list(self):
         return self._linked_list
 
+    @property
+    def checkpoint_address(self):
+        """DiskAddress of the latest checkpoint record, `None` if there is none"""
+        return self._checkpoint_address
+
+    @property
+    def garbage_size(self):
+        return self._garbage_size
+
+    @property
+    @synchronized
+    def garbage_ratio(self):
+        """Ratio of dead bytes in bucket file, compaction reclaims them. Only sealed
+           segments are compacted, so it's the ratio of the most dead one if bucket is
+           segmented. Segments are rolled over and retired by other threads meanwhile
+        """
+        if self._segment_size is not None:
+            return max(
+                (
+                    self._segment_garbage_ratio(segment)
+                    for segment in self._sealed_sizes
+                ),
+                default=0.0,
+            )
+        size = self._offset + sum(self._sealed_sizes.values())
+        return self._garbage_size / size if size > 0 else 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def persist_value(self, value):
-        with open(self.filepath, "ab") as f:
-            pickle_value = pickle.dumps(value)
-            # final byte array need to be flushed
-            byte_array = self._integer_to_byte_array(len(pickle_value)) + pickle_value
-            assert f.write(byte_array) == len(byte_array)
-            address = self._offset
-            self._offset += len(byte_array)
-            return DiskAddress(address)
+        tag, chunks = self._codec_registry.encode(value)
+        return self.append_record(tag, chunks)
+
+    @synchronized
+    def persist_values(self, values):
+        """Append several values, return their DiskAddress. Out of block mode their
+           records are written by a single write
+        """
+        if self._block_size is not None:
+            return [self.persist_value(value) for value in values]
+        disk_addresses, chunks = [], []
+        self._roll_over_if_full()
+        address = self._offset
+        for value in values:
+            if self._segment_size is not None and address >= self._segment_size:
+                # records encoded so far are written before full segment is sealed
+                self._write_chunks([b"".join(chunks)])
+                self._offset = address
+                self._roll_over()
+                chunks, address = [], self._offset
+            record_chunks, record_size = self._encode_record(
+                *self._codec_registry.encode(value)
+            )
+            disk_addresses.append(
+                DiskAddress(address, size=record_size, segment=self._segment)
+            )
+            chunks.extend(record_chunks)
+            address += record_size
+        self._write_chunks([b"".join(chunks)])
+        self._offset = address
+        return disk_addresses
+
+    @synchronized
+    def append_record(self, tag, chunks):
+        """Append encoded chunks as a new record, return its DiskAddress"""
+        if self._block_size is None:
+            self._roll_over_if_full()
+            return self._write_record(tag, chunks)
+        # pending block will be written at current offset, a block never spans segments
+        if not self._pending_block:
+            self._roll_over_if_full()
+        address = DiskAddress(
+            self._offset, len(self._pending_block), segment=self._segment
+        )
+        data = b"".join(chunks)
+        self._pending_block.append((tag, data))
+        self._pending_addresses.append(address)
+        self._pending_size += len(data)
+        if self._pending_size >= self._block_size:
+            self.flush_block()
+        return address
+
+    @synchronized
+    def flush_block(self):
+        """Write pending records as one block, it's a no-op out of block mode"""
+        if not self._pending_block:
+            return
+        chunks = [_BLOCK_COUNT.pack(len(self._pending_block))]
+        chunks.extend(
+            _BLOCK_ENTRY.pack(tag, len(data)) for tag, data in self._pending_block
+        )
+        chunks.extend(data for _, data in self._pending_block)
+        block_size = self._write_record(0, chunks, BLOCK_FLAG).size
+        # block size is shared by its records in proportion to their data length
+        data_size = max(self._pending_size, 1)
+        for (_, data), address in zip(self._pending_block, self._pending_addresses):
+            address.size = block_size * len(data) // data_size
+        for address in self._pending_released:
+            self._count_garbage(address, address.size)
+        self._reset_block()
+
+    @synchronized
+    def release(self, disk_address):
+        """Record at disk_address is no longer referenced, count it as garbage"""
+        if disk_address.size is None:
+            # record is in pending block, its size is unknown yet
+            self._pending_released.append(disk_address)
+        else:
+            self._count_garbage(disk_address, disk_address.size)
+
+    @synchronized
+    def retain(self, disk_address):
+        """Record at disk_address of a reopened file is referenced again"""
+        self._count_garbage(disk_address, -disk_address.size)
+
+    @synchronized
+    def persist_checkpoint(self, checkpoint):
+        """Append checkpoint record. The previous checkpoint is dead, but it's not
+           counted as garbage, since compaction writes checkpoints and would be woken
+           by them again. It's reclaimed once bucket file is rewritten, or counted once
+           its segment is sealed
+        """
+        previous_address = self._checkpoint_address
+        if previous_address is not None and self._segment_size is not None:
+            if previous_address.segment == self._segment:
+                self._stale_checkpoints.append(previous_address)
+            else:
+                self.release(previous_address)
+        self._checkpoint_address = self.persist_value(checkpoint)
+        return self._checkpoint_address
+
+    def load_checkpoint(self, disk_address):
+        """Load checkpoint record of a reopened file, it's kept until next checkpoint"""
+        checkpoint = self.load_value(disk_address)
+        self.retain(disk_address)
+        self._checkpoint_address = disk_address
+        return checkpoint
+
+    def load_value(self, disk_address):
+        if disk_address.index is None and self._use_mmap:
+            # decode directly from mapped pages, no intermediate bytes copy
+            address = disk_address.address
+            with memoryview(self._mapping(disk_address.segment)) as view:
+                header_size, data_length, tag, flags, checksum = self._parse_header(
+                    view[address : address + MAX_HEADER_SIZE], address
+                )
+                start = address + header_size
+                with view[start : start + data_length] as record:
+                    self._check_record(
+                        address, tag, flags, record, checksum, data_length
+                    )
+                    return self._codec_registry.decode(
+                        tag, decompress(flags & ~BLOCK_FLAG, record)
+                    )
+        else:
+            return self._codec_registry.decode(*self.read_record(disk_address))
+
+    def load_values(self, disk_addresses):
+        """Load several records in file order, return values in the given order. Nearby
+           records of a segment are read by one sweep, block records go through block
+           cache and mapped segments are decoded in place
+        """
+        values = [None] * len(disk_addresses)
+        # positions of records read by the current sweep
+        sweep = []
+        for position in sorted(
+            range(len(disk_addresses)),
+            key=lambda position: (
+                disk_addresses[position].segment,
+                disk_addresses[position].address,
+                disk_addresses[position].index or 0,
+            ),
+        ):
+            disk_address = disk_addresses[position]
+            if (
+                disk_address.index is not None
+                or disk_address.size is None
+                or self._use_mmap
+            ):
+                values[position] = self.load_value(disk_address)
+                continue
+            if sweep and not self._extends_sweep(
+                disk_addresses[sweep[0]], disk_addresses[sweep[-1]], disk_address
+            ):
+                self._load_sweep(disk_addresses, sweep, values)
+                sweep = []
+            sweep.append(position)
+        if sweep:
+            self._load_sweep(disk_addresses, sweep, values)
+        return values
+
+    def _extends_sweep(self, first, last, disk_address):
+        return (
+            disk_address.segment == first.segment
+            and disk_address.address - (last.address + last.size) <= _READ_AHEAD
+            and disk_address.address + disk_address.size - first.address <= _SWEEP_SIZE
+        )
+
+    def _load_sweep(self, disk_addresses, sweep, values):
+        """Read records at positions of sweep at once and decode them into values"""
+        first = disk_addresses[sweep[0]]
+        end = max(
+            disk_addresses[position].address + disk_addresses[position].size
+            for position in sweep
+        )
+        buffer = self._pread(first.segment, first.address, end - first.address)
+        for position in sweep:
+            address = disk_addresses[position].address
+            offset = address - first.address
+            header_size, data_length, tag, flags, checksum = self._parse_header(
+                buffer[offset : offset + MAX_HEADER_SIZE], address
+            )
+            start = offset + header_size
+            data = buffer[start : start + data_length]
+            self._check_record(address, tag, flags, data, checksum, data_length)
+            values[position] = self._codec_registry.decode(
+                tag, decompress(flags & ~BLOCK_FLAG, data)
+            )
+
+    @synchronized
+    def stream_values(self, disk_addresses, buffer_size=1024 * 1024):
+        """Return an iterator of values of records at disk_addresses, which should be
+           sorted by segment and address. Segments are opened right now and read front
+           to back through dedicated handles with a large buffer, so a later swap or
+           compaction doesn't affect them. Pooled handles, mappings and block cache are
+           left untouched, records should be flushed before, see `flush`
+        """
+        files = {
+            segment: open(
+                segment_filepath(self._filepath, segment), "rb", buffering=buffer_size
+            )
+            for segment in set(disk_address.segment for disk_address in disk_addresses)
+        }
+        return self._stream_values(
+            files,
+            disk_addresses,
+            (self._segment, self._offset),
+            list(self._pending_block),
+        )
+
+    def _stream_values(self, files, disk_addresses, pending_address, pending_records):
+        try:
+            block_address, block_records = None, None
+            for disk_address in disk_addresses:
+                f = files[disk_address.segment]
+                address = (disk_address.segment, disk_address.address)
+                if disk_address.index is not None and address != block_address:
+                    block_address = address
+                    if pending_records and address == pending_address:
+                        block_records = pending_records
+                    else:
+                        _, flags, data = self._read_stream(f, disk_address.address)
+                        block_records = self._parse_block(flags, data)
+                if disk_address.index is not None:
+                    tag, data = block_records[disk_address.index]
+                else:
+                    tag, flags, data = self._read_stream(f, disk_address.address)
+                    data = decompress(flags & ~BLOCK_FLAG, data)
+                yield self._codec_registry.decode(tag, data)
+        finally:
+            for f in files.values():
+                f.close()
+
+    @synchronized
+    def flush(self):
+        """Make written records visible to other handles of bucket file, sealed
+           segments are flushed when they are sealed
+        """
+        filepath = segment_filepath(self._filepath, self._segment)
+        if not self._positional_io and filepath in self._file_handle_pool:
+            self._file_handle().flush()
+
+    def sync(self):
+        """Write pending block and fsync bucket file, records written so far survive a
+           crash of operating system. Records are flushed with bucket locked, but fsync
+           runs on leased handles outside of the lock, so that appends don't wait for it
+        """
+        with ExitStack() as leases:
+            with self._lock:
+                self.flush_block()
+                segments = sorted(self._unsynced_segments) + [self._segment]
+                handles = []
+                for segment in segments:
+                    f = leases.enter_context(
+                        self._file_handle_pool.lease(
+                            segment_filepath(self._filepath, segment)
+                        )
+                    )
+                    f.flush()
+                    handles.append(f)
+                self._unsynced_segments.difference_update(segments)
+            try:
+                for f in handles:
+                    os.fsync(f.fileno())
+            except BaseException:
+                with self._lock:
+                    # sealed segments are synced again next time, unless they're gone
+                    self._unsynced_segments.update(
+                        segment for segment in segments if segment in self._sealed_sizes
+                    )
+                raise
+
+    @synchronized
+    def seal(self):
+        """Seal active segment unless it's empty, following records go to a new one"""
+        self.flush_block()
+        if self._offset > 0:
+            self._roll_over()
+
+    @synchronized
+    def compactable_segments(self, garbage_ratio):
+        """Return sealed segments holding garbage whose ratio reaches garbage_ratio"""
+        return [
+            segment
+            for segment in sorted(self._sealed_sizes)
+            if self._segment_garbage[segment] > 0
+            and self._segment_garbage_ratio(segment) >= garbage_ratio
+        ]
+
+    @synchronized
+    def retire_segments(self, segments):
+        """Live records of segments have been appended again, segments are no longer
+           counted but stay readable until `drop_retired_segments`
+        """
+        for segment in segments:
+            del self._sealed_sizes[segment]
+            self._garbage_size -= self._segment_garbage.pop(segment)
+            self._retired_segments.append(segment)
+            if (
+                self._checkpoint_address is not None
+                and self._checkpoint_address.segment == segment
+            ):
+                self._checkpoint_address = None
+
+    @synchronized
+    def drop_retired_segments(self):
+        """Delete retired segments once no checkpoint refers to them"""
+        for segment in self._retired_segments:
+            self._remove_segment(segment)
+        self._retired_segments = []
+
+    def read_record(self, disk_address):
+        """Return codec tag and encoded bytes of record at disk_address, only the record
+           or block it belongs to is decompressed
+        """
+        if disk_address.index is not None:
+            return self._read_block(disk_address.segment, disk_address.address)[
+                disk_address.index
+            ]
+        tag, flags, data = self._read_raw(disk_address.segment, disk_address.address)
+        return tag, decompress(flags & ~BLOCK_FLAG, data)
+
+    def record_addresses(self):
+        """Scan record headers segment by segment from beginning, yield DiskAddress of
+           complete records, every record in a block has its own address
+        """
+        for segment in self._segments():
+            end = self._segment_end(segment)
+            address = 0
+            while address < end:
+                try:
+                    header_size, data_length, _, flags, _ = self._parse_header(
+                        self._pread(segment, address, MAX_HEADER_SIZE), address
+                    )
+                except CorruptRecordError:
+                    break
+                record_size = header_size + data_length
+                if address + record_size > end:
+                    # torn record at the tail
+                    break
+                if flags & BLOCK_FLAG:
+                    records = self._read_block(segment, address)
+                    data_size = max(sum(len(data) for _, data in records), 1)
+                    for index, (_, data) in enumerate(records):
+                        yield DiskAddress(
+                            address,
+                            index,
+                            record_size * len(data) // data_size,
+                            segment,
+                        )
+                else:
+                    yield DiskAddress(address, size=record_size, segment=segment)
+                address += record_size
+
+    @synchronized
+    def verify(self, truncate=False):
+        """Check records segment by segment from beginning, return (segment, address)
+           of the first torn or corrupt record, None if all of them are intact. With
+           truncate, segment is cut there and becomes active one, so that new records
+           follow the last intact one. Records after it are lost, later segments as
+           well, they must not be referenced
+        """
+        self.flush_block()
+        for segment in self._segments():
+            end = self._segment_end(segment)
+            address = 0
+            while address < end:
+                try:
+                    address += self._read_record_at(segment, address)[3]
+                except CorruptRecordError:
+                    break
+            if address < end:
+                break
+        else:
+            return None
+        if truncate:
+            self._unmap()
+            self._block_cache = None
+            for later_segment in self._segments():
+                if later_segment > segment:
+                    self._remove_segment(later_segment)
+                    self._garbage_size -= self._segment_garbage.pop(later_segment)
+                    self._sealed_sizes.pop(later_segment, None)
+            self._sealed_sizes.pop(segment, None)
+            self._segment = segment
+            f = self._file_handle()
+            f.seek(address)
+            f.truncate()
+            f.flush()
+            self._offset = address
+            garbage_size = min(self._segment_garbage[segment], address)
+            self._garbage_size += garbage_size - self._segment_garbage[segment]
+            self._segment_garbage[segment] = garbage_size
+        return segment, address
+
+    @synchronized
+    def swap(self, other):
+        """Replace records of this bucket with records of other bucket, other bucket's
+           file is moved to filepath of this bucket and other segments are deleted
+        """
+        other.flush_block()
+        other.close()
+        self._reset_block()
+        self._unmap()
+        # file is replaced before its pooled handle is closed, a lock-free reader
+        # reopening it meanwhile gets the new file instead of pinning the old one
+        os.replace(other.filepath, self._filepath)
+        self._file_handle_pool.close(self._filepath)
+        for segment in self._segments() + self._retired_segments:
+            if segment != 0:
+                self._remove_segment(segment)
+        self._reset_segments(other._offset, other._garbage_size)
+        self._checkpoint_address = other._checkpoint_address
 
+    @synchronized
+    def close(self):
+        """Release opened file handles, they will be reopened lazily on next access"""
+        self.flush_block()
+        self._unmap()
+        for segment in self._segments() + self._retired_segments:
+            self._file_handle_pool.close(segment_filepath(self._filepath, segment))
+
+    @synchronized
     def clear(self):
-        open(self._filepath, "wb").close()
-        self._offset = 0
+        # mapped pages must not outlive the truncated file
+        self._unmap()
+        self._reset_block()
+        for segment in set(self._segments() + self._retired_segments + [0]):
+            self._remove_segment(segment)
+        self._reset_segments(0, 0)
+        self._checkpoint_address = None
         self._linked_list.clear()
 
-    def _integer_to_byte_array(self, length):
-        byte_array = bytearray(4)
-        byte_array[0] = (length >> 24) & ((1 << 8) - 1)
-        byte_array[1] = (length >> 16) & ((1 << 8) - 1)
-        byte_array[2] = (length >> 8) & ((1 << 8) - 1)
-        byte_array[3] = length & ((1 << 8) - 1)
-        return bytes(byte_array)
+    def _write_record(self, tag, chunks, flags=NO_COMPRESSION):
+        chunks, record_size = self._encode_record(tag, chunks, flags)
+        self._write_chunks(chunks)
+        address = self._offset
+        self._offset += record_size
+        return DiskAddress(address, size=record_size, segment=self._segment)
+
+    def _encode_record(self, tag, chunks, flags=NO_COMPRESSION):
+        """Return header and data chunks of a record, and its size in file"""
+        data_length = sum(memoryview(chunk).nbytes for chunk in chunks)
+        if (
+            self._compression != NO_COMPRESSION
+            and data_length >= self._compression_threshold
+        ):
+            compressed = compress(self._compression, b"".join(chunks))
+            # incompressible data is kept raw
+            if len(compressed) < data_length:
+                chunks, data_length = [compressed], len(compressed)
+                flags |= self._compression
+        checksum = zlib.crc32(bytes((tag, flags)))
+        for chunk in chunks:
+            checksum = zlib.crc32(chunk, checksum)
+        header = self._record_header(data_length, tag, flags, checksum)
+        return [header] + chunks, len(header) + data_length
+
+    def _write_chunks(self, chunks):
+        """Write chunks at offset, offset is left for caller to advance"""
+        # chunks are written one by one, large buffers are never concatenated
+        if self._positional_io:
+            with self._file_handle_pool.lease(
+                segment_filepath(self._filepath, self._segment)
+            ) as f:
+                position = self._offset
+                for chunk in chunks:
+                    position += os.pwrite(f.fileno(), chunk, position)
+        else:
+            f = self._file_handle()
+            f.seek(self._offset)
+            for chunk in chunks:
+                f.write(chunk)
+
+    def _read_raw(self, segment, address):
+        """Return codec tag, flags and data of record at address of segment"""
+        return self._read_record_at(segment, address)[:3]
+
+    def _read_record_at(self, segment, address):
+        """Return codec tag, flags, data and size of record at address of segment,
+           checksum is verified. Header and beginning of data are read at once
+        """
+        buffer = self._pread(segment, address, _READ_AHEAD)
+        header_size, data_length, tag, flags, checksum = self._parse_header(
+            buffer, address
+        )
+        data = buffer[header_size : header_size + data_length]
+        if len(data) < data_length:
+            # large record is read again as a whole instead of being concatenated
+            data = self._pread(segment, address + header_size, data_length)
+        self._check_record(address, tag, flags, data, checksum, data_length)
+        return tag, flags, data, header_size + data_length
+
+    def _read_stream(self, f, address):
+        # forward seek within buffered region doesn't hit the disk
+        if f.tell() != address:
+            f.seek(address)
+        buffer = f.read(MAX_HEADER_SIZE)
+        header_size, data_length, tag, flags, checksum = self._parse_header(
+            buffer, address
+        )
+        data = buffer[header_size : header_size + data_length]
+        if len(data) < data_length:
+            f.seek(address + header_size)
+            data = f.read(data_length)
+        self._check_record(address, tag, flags, data, checksum, data_length)
+        return tag, flags, data
+
+    def _pread(self, segment, address, length):
+        filepath = segment_filepath(self._filepath, segment)
+        if self._positional_io:
+            # no shared file position, concurrent reads don't interfere
+            with self._file_handle_pool.lease(filepath) as f:
+                return os.pread(f.fileno(), length, address)
+        else:
+            f = self._file_handle_pool.get(filepath)
+            f.seek(address)
+            return f.read(length)
+
+    @synchronized
+    def _read_block(self, segment, address):
+        """Return list of (codec tag, data) of block at address of segment"""
+        if self._pending_block and segment == self._segment and address == self._offset:
+            return self._pending_block
+        if self._block_cache is not None and self._block_cache[0] == (segment, address):
+            return self._block_cache[1]
+        _, flags, data = self._read_raw(segment, address)
+        records = self._parse_block(flags, data)
+        self._block_cache = ((segment, address), records)
+        return records
+
+    def _parse_block(self, flags, data):
+        view = memoryview(decompress(flags & ~BLOCK_FLAG, data))
+        record_num = _BLOCK_COUNT.unpack_from(view, 0)[0]
+        offset = _BLOCK_COUNT.size
+        start = offset + record_num * _BLOCK_ENTRY.size
+        records = []
+        for _ in range(record_num):
+            tag, data_length = _BLOCK_ENTRY.unpack_from(view, offset)
+            offset += _BLOCK_ENTRY.size
+            records.append((tag, view[start : start + data_length]))
+            start += data_length
+        return records
+
+    def _reset_block(self):
+        self._pending_block = []
+        self._pending_size = 0
+        self._pending_addresses = []
+        self._pending_released = []
+        self._block_cache = None
+
+    def _file_handle(self):
+        """Handle of active segment"""
+        return self._file_handle_pool.get(
+            segment_filepath(self._filepath, self._segment)
+        )
+
+    def _mapping(self, segment):
+        """Return a read-only mapping covering all persisted records of segment, remap
+           lazily once offset grows past mapped region
+        """
+        mapping = self._mmaps.get(segment)
+        if mapping is None or len(mapping) < self._segment_end(segment):
+            if mapping is not None:
+                mapping.close()
+            f = self._file_handle_pool.get(segment_filepath(self._filepath, segment))
+            # pending writes should be visible in mapping
+            f.flush()
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mmaps[segment] = mapping
+        return mapping
+
+    def _unmap(self):
+        for mapping in self._mmaps.values():
+            mapping.close()
+        self._mmaps = {}
+
+    def _existing_segments(self):
+        directory = os.path.dirname(self._filepath)
+        return existing_segments(directory).get(self._filepath, [0])
+
+    def _segments(self):
+        """Sealed segments and active one in order"""
+        return sorted(self._sealed_sizes) + [self._segment]
+
+    def _segment_end(self, segment):
+        return self._offset if segment == self._segment else self._sealed_sizes[segment]
+
+    def _segment_garbage_ratio(self, segment):
+        size = self._segment_end(segment)
+        return self._segment_garbage[segment] / size if size > 0 else 0.0
+
+    def _count_garbage(self, disk_address, size):
+        # records of retired segments are no longer counted
+        if disk_address.segment in self._segment_garbage:
+            self._segment_garbage[disk_address.segment] += size
+            self._garbage_size += size
+
+    def _roll_over_if_full(self):
+        if self._segment_size is not None and self._offset >= self._segment_size:
+            self._roll_over()
+
+    def _roll_over(self):
+        """Seal active segment and start an empty one, segment numbers are never
+           reused while a segment could still be read
+        """
+        if not self._positional_io:
+            # sealed records should be visible to other handles
+            self._file_handle().flush()
+        self._sealed_sizes[self._segment] = self._offset
+        self._unsynced_segments.add(self._segment)
+        for disk_address in self._stale_checkpoints:
+            self.release(disk_address)
+        self._stale_checkpoints = []
+        self._segment = max(self._segments() + self._retired_segments) + 1
+        open(segment_filepath(self._filepath, self._segment), "wb").close()
+        self._offset = 0
+        self._segment_garbage[self._segment] = 0
+
+    def _remove_segment(self, segment):
+        """Release segment and delete its file, file of segment 0 is replaced by an
+           empty one instead since it tells bucket exists. Either way, handles opened by
+           streaming scans keep reading the old file. File is deleted before its pooled
+           handle is closed, so that a lock-free reader never reopens it into pool
+        """
+        mapping = self._mmaps.pop(segment, None)
+        if mapping is not None:
+            mapping.close()
+        if self._block_cache is not None and self._block_cache[0][0] == segment:
+            self._block_cache = None
+        self._unsynced_segments.discard(segment)
+        filepath = segment_filepath(self._filepath, segment)
+        if segment == 0:
+            open(filepath + ".tmp", "wb").close()
+            os.replace(filepath + ".tmp", filepath)
+        else:
+            os.remove(filepath)
+        self._file_handle_pool.close(filepath)
+
+    def _reset_segments(self, offset, garbage_size):
+        """Bucket is a single segment again, other segments are removed already"""
+        self._sealed_sizes = {}
+        self._retired_segments = []
+        self._unsynced_segments = set()
+        self._segment = 0
+        self._offset = offset
+        self._segment_garbage = {0: garbage_size}
+        self._garbage_size = garbage_size
+        self._stale_checkpoints = []
+
+    def _record_header(self, data_length, tag, flags, checksum):
+        varint = bytearray()
+        while data_length >= 0x80:
+            varint.append(data_length & 0x7F | 0x80)
+            data_length >>= 7
+        varint.append(data_length)
+        return _HEADER.pack(RECORD_MAGIC, tag, flags, checksum) + varint
+
+    def _parse_header(self, buffer, address):
+        """Return header size, data length, codec tag, flags and checksum of record at
+           the beginning of buffer
+        """
+        if len(buffer) > 0 and buffer[0] != RECORD_MAGIC:
+            raise CorruptRecordError("Bad record magic at {}".format(address))
+        if len(buffer) < _HEADER.size + 1:
+            raise CorruptRecordError("Torn header at {}".format(address))
+        _, tag, flags, checksum = _HEADER.unpack_from(buffer)
+        data_length, shift, position = 0, 0, _HEADER.size
+        while True:
+            if position >= min(len(buffer), MAX_HEADER_SIZE):
+                raise CorruptRecordError("Torn header at {}".format(address))
+            byte = buffer[position]
+            data_length |= (byte & 0x7F) << shift
+            shift += 7
+            position += 1
+            if byte < 0x80:
+                return position, data_length, tag, flags, checksum
+
+    def _check_record(self, address, tag, flags, data, checksum, data_length):
+        if len(data) != data_length:
+            raise CorruptRecordError("Torn record at {}".format(address))
+        if zlib.crc32(data, zlib.crc32(bytes((tag, flags)))) != checksum:
+            raise CorruptRecordError(
+                "Checksum mismatch of record at {} in {}".format(
+                    address, self._filepath
+                )
+            )
+
+
+class BucketEntry(object):
+    """Key-value pair stored in bucket linked list. Key and value are tracked as a single
+       LRU unit, both of them are either in memory or on disk, except that a pinned key
+       stays in memory. Value tells where entry is
+    """
+
+    __slots__ = ("key_hash", "key", "value", "lru_node", "policy_data", "access_tick")
+
+    def __init__(self, key_hash, key, value):
+        self.key_hash = key_hash
+        # key and value are BucketObject
+        self.key = key
+        self.value = value
+        # node in eviction policy's or disk linked list, its owner tells which one
+        self.lru_node = DoublyLinkedList.create_new_node(self)
+        # state owned by eviction policy, such as reference bit or access frequency
+        self.policy_data = None
+        # last use stamped by eviction policy's clock, entries of maps sharing a memory
+        # budget are compared by it
+        self.access_tick = 0
+
+    def is_in_memory(self):
+        return self.value.is_in_memory()
+
+    def __str__(self):
+        return "({}: {})".format(self.key, self.value)
 
 
 class BucketObject(object):
     def __init__(self, value, bucket):
         self.value = value
         self.bucket = bucket
+        # estimated memory size of loaded value, should be reset once value is replaced
+        self.size = None
+        # record a loaded value was read from, it's dropped once value is replaced, so
+        # a clean value is evicted again without writing it
+        self.disk_address = None
 
     def load_value(self):
         if isinstance(self.value, DiskAddress):
-            with open(self.bucket.filepath, "rb") as f:
-                f.seek(self.value.address)
-                data_length = self._byte_array_to_integer(f.read(4))
-                value_byte_array = f.read(data_length)
-                assert len(value_byte_array) == data_length
-                return pickle.loads(value_byte_array)
+            return self.bucket.load_value(self.value)
         else:
             return self.value
 
-    def _byte_array_to_integer(self, byte_array):
-        ans = 0
-        for b in byte_array:
-            ans = (ans << 8) + int(b)
-        return ans
-
     def is_in_memory(self):
         return not isinstance(self.value, DiskAddress)
 
+    def is_dirty(self):
+        """Loaded value has no up to date record"""
+        return self.is_in_memory() and self.disk_address is None
+
+    def record_address(self):
+        """Address of the record holding value, None if value has no record"""
+        return self.disk_address if self.is_in_memory() else self.value
+
     def __str__(self):
         # load could be a costly operation, just print value object itself without loading
         return str(self.value)
 
 
+class BucketCheckpoint(object):
+    """Snapshot of a bucket linked list, appended to bucket file when a persistent map
+       is closed. Each entry is a (key hash, key, value) triple, key and value are
+       references, reference is either (True, in-memory object) or
+       (False, (bucket index, disk address, index in block, size, segment))
+    """
+
+    def __init__(self, entries, hash_probe):
+        self.entries = entries
+        # hash of a fixed string, tells if key hashes were made by the same hash
+        # function as the reading map's, builtin hash of string varies per process
+        self.hash_probe = hash_probe
+
+
 class DiskAddress(object):
-    def __init__(self, address):
+    """Address of a record in a segment of bucket file, index is set if record is in a
+       block at address. Size is the number of bytes record takes in file, it's None
+       until pending block is written
+    """
+
+    def __init__(self, address, index=None, size=None, segment=0):
         self.address = address
+        self.index = index
+        self.size = size
+        self.segment = segment
 
     def __str__(self):
-        return "(address: {})".format(self.address)
+        if self.index is None:
+            return "(segment: {}, address: {})".format(self.segment, self.address)
+        return "(segment: {}, address: {}, index: {})".format(
+            self.segment, self.address, self.index
+        )
@@ -0,0 +1,216 @@
+import hashlib
+import numbers
+import pickle
+import struct
+
+# kind byte -> struct of packed number
+_NUMBER_STRUCTS = {
+    b"q": struct.Struct("<q"),
+    b"d": struct.Struct("<d"),
+    b"?": struct.Struct("<?"),
+}
+_NUMBER_KINDS = {int: b"q", float: b"d", bool: b"?"}
+# hash of number doesn't depend on process, unlike hash of str and bytes
+_STABLE_HASH_TYPES = (int, float, bool, complex)
+# stable hash of None, its builtin hash is its address before python 3.12
+_NONE_HASH = 0x5DEECE66D
+
+
+class Codec(object):
+    """Encode value into byte chunks and decode it back. Every codec has a unique one
+       byte tag, which is written in record header so that record could be decoded by
+       the same codec which encoded it
+
+       `decode` may receive a transient memoryview, codec should not keep reference to it
+    """
+
+    tag = None
+
+    def can_encode(self, value):
+        raise NotImplementedError
+
+    def encode(self, value):
+        """Return a list of bytes-like chunks, they are written one after another"""
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    """Fallback codec, it works for all picklable values"""
+
+    tag = 0
+
+    def __init__(self, protocol=pickle.DEFAULT_PROTOCOL):
+        self._protocol = protocol
+
+    def can_encode(self, value):
+        return True
+
+    def encode(self, value):
+        return [pickle.dumps(value, self._protocol)]
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class BytesCodec(Codec):
+    """Raw bytes passthrough, bytes read from file are returned without another copy"""
+
+    tag = 1
+
+    def can_encode(self, value):
+        return type(value) is bytes
+
+    def encode(self, value):
+        return [value]
+
+    def decode(self, data):
+        return data if type(data) is bytes else bytes(data)
+
+
+class StrCodec(Codec):
+    tag = 2
+
+    def can_encode(self, value):
+        return type(value) is str
+
+    def encode(self, value):
+        return [value.encode("utf-8", "surrogatepass")]
+
+    def decode(self, data):
+        return str(data, "utf-8", "surrogatepass")
+
+
+class NumberCodec(Codec):
+    """Struct packed int, float and bool, one kind byte followed by packed number"""
+
+    tag = 3
+
+    def can_encode(self, value):
+        if type(value) is int:
+            return -(1 << 63) <= value < (1 << 63)
+        else:
+            return type(value) in (float, bool)
+
+    def encode(self, value):
+        kind = _NUMBER_KINDS[type(value)]
+        return [kind + _NUMBER_STRUCTS[kind].pack(value)]
+
+    def decode(self, data):
+        return _NUMBER_STRUCTS[bytes(data[:1])].unpack_from(data, 1)[0]
+
+
+class Pickle5Codec(Codec):
+    """Pickle protocol 5, large binary payloads such as bytearray are written as out-of-band
+       buffers instead of being copied into pickle stream. Record layout is buffer number,
+       buffer lengths, pickle stream and buffers
+    """
+
+    tag = 4
+
+    _COUNT = struct.Struct("<I")
+    _LENGTH = struct.Struct("<Q")
+
+    def can_encode(self, value):
+        return True
+
+    def encode(self, value):
+        buffers = []
+        pickle_value = pickle.dumps(value, 5, buffer_callback=buffers.append)
+        try:
+            raw_buffers = [buffer.raw() for buffer in buffers]
+        except BufferError:
+            # non-contiguous buffer has to be copied into pickle stream
+            pickle_value, raw_buffers = pickle.dumps(value, 5), []
+        chunks = [self._COUNT.pack(len(raw_buffers))]
+        chunks.extend(self._LENGTH.pack(raw.nbytes) for raw in raw_buffers)
+        chunks.append(pickle_value)
+        chunks.extend(raw_buffers)
+        return chunks
+
+    def decode(self, data):
+        # buffers could refer to bytes read from file, but never to a transient view
+        view = memoryview(data)
+        buffer_num = self._COUNT.unpack_from(view, 0)[0]
+        offset = self._COUNT.size
+        lengths = []
+        for _ in range(buffer_num):
+            lengths.append(self._LENGTH.unpack_from(view, offset)[0])
+            offset += self._LENGTH.size
+        end = len(view) - sum(lengths)
+        pickle_value, buffers = view[offset:end], []
+        for length in lengths:
+            buffer = view[end : end + length]
+            buffers.append(buffer if type(data) is bytes else bytearray(buffer))
+            end += length
+        return pickle.loads(pickle_value, buffers=buffers)
+
+
+def default_codecs():
+    fallback = Pickle5Codec() if pickle.HIGHEST_PROTOCOL >= 5 else PickleCodec()
+    return [BytesCodec(), StrCodec(), NumberCodec(), fallback]
+
+
+class CodecRegistry(object):
+    """Pick the first codec which is able to encode value, user codecs take priority
+       over default ones. Records written by any registered codec could be decoded
+    """
+
+    def __init__(self, codecs=None):
+        self._codecs = list(codecs or []) + default_codecs()
+        self._tag_to_codec = {}
+        for codec in self._codecs:
+            if not 0 <= codec.tag < 256:
+                raise ValueError("Codec tag `{}` is not a byte".format(codec.tag))
+            if codec.tag in self._tag_to_codec:
+                raise ValueError("Codec tag `{}` is duplicated".format(codec.tag))
+            self._tag_to_codec[codec.tag] = codec
+        # records of pickle codec are always readable, even it's not the fallback
+        self._tag_to_codec.setdefault(PickleCodec.tag, PickleCodec())
+
+    def encode(self, value):
+        """Return (codec tag, chunks)"""
+        for codec in self._codecs:
+            if codec.can_encode(value):
+                return codec.tag, codec.encode(value)
+        raise ValueError("No codec is able to encode `{}`".format(type(value)))
+
+    def decode(self, tag, data):
+        return self._tag_to_codec[tag].decode(data)
+
+    def stable_hash(self, value):
+        """Hash of value which is the same in every process, unlike builtin hash of str
+           and bytes. Equal numbers, str, bytes, and tuples or frozensets of them hash
+           alike as they do by builtin hash. Other values are hashed by their encoding,
+           so equal keys of other types should be encoded alike
+        """
+        value_type = type(value)
+        if value_type is str:
+            return _digest(b"s", value.encode("utf-8", "surrogatepass"))
+        if value_type in _STABLE_HASH_TYPES:
+            return hash(value)
+        if value_type is bytes:
+            return _digest(b"b", value)
+        if value is None:
+            return _NONE_HASH
+        if isinstance(value, tuple):
+            return hash(tuple(self.stable_hash(item) for item in value))
+        if isinstance(value, frozenset):
+            return hash(frozenset(self.stable_hash(item) for item in value))
+        if isinstance(value, str):
+            return self.stable_hash(str(value))
+        if isinstance(value, bytes):
+            return self.stable_hash(bytes(value))
+        if isinstance(value, numbers.Number):
+            return hash(value)
+        tag, chunks = self.encode(value)
+        return _digest(bytes([tag]), b"".join(chunks))
+
+
+def _digest(prefix, data):
+    """64 bits signed hash of bytes, prefix keeps values of different kinds apart"""
+    digest = hashlib.blake2b(prefix, digest_size=8)
+    digest.update(data)
+    return int.from_bytes(digest.digest(), "little", signed=True)
@@ -0,0 +1,69 @@
+import logging
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundCompactor(object):
+    """Daemon thread which compacts buckets once their garbage ratio crosses threshold,
+       the worst bucket first. `compact_once` is called repeatedly until it returns
+       False, it should lock the map for one bucket only, so that gets and sets wait for
+       at most one bucket rewrite. Thread is started lazily on first wakeup, a failed
+       compaction is logged and retried on next wakeup
+
+       `compact_once` is a bound method of map, it's weakly referenced so that thread
+       never keeps map alive. Thread exits once map is garbage collected
+    """
+
+    def __init__(self, compact_once):
+        self._compact_once = weakref.WeakMethod(compact_once, self._on_collected)
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        # wake could be called by several threads at the same time
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped = False
+                self._thread = threading.Thread(
+                    target=self._run, name="DiskBasedHashMapCompactor", daemon=True
+                )
+                self._thread.start()
+            self._wakeup.set()
+
+    def stop(self):
+        """Stop thread after current bucket is done, it must not be called with map
+           locked, otherwise thread could never finish current bucket
+        """
+        with self._lock:
+            self._stopped = True
+            self._wakeup.set()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait()
+            if self._stopped:
+                return
+            self._wakeup.clear()
+            try:
+                while not self._stopped and self._compact():
+                    pass
+            except Exception:
+                # thread keeps running, bucket is compacted again on next wakeup
+                logger.exception("Background compaction failed")
+
+    def _compact(self):
+        # map is referenced only while a bucket is compacted
+        compact_once = self._compact_once()
+        return compact_once is not None and compact_once()
+
+    def _on_collected(self, _):
+        # called by garbage collector, which could run with lock held by this thread
+        self._stopped = True
+        self._wakeup.set()
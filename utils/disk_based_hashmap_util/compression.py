@@ -0,0 +1,53 @@
+import zlib
+
+# bz2 and lzma are optional modules, python could be built without them
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# compression id 0 means record is stored raw
+NO_COMPRESSION = 0
+
+# compression name -> (compression id, compress, decompress), id is written in record header
+COMPRESSIONS = {"zlib": (1, zlib.compress, zlib.decompress)}
+if bz2 is not None:
+    COMPRESSIONS["bz2"] = (2, bz2.compress, bz2.decompress)
+if lzma is not None:
+    COMPRESSIONS["lzma"] = (3, lzma.compress, lzma.decompress)
+
+_COMPRESSORS = {
+    compression_id: compress for compression_id, compress, _ in COMPRESSIONS.values()
+}
+_DECOMPRESSORS = {
+    compression_id: decompress
+    for compression_id, _, decompress in COMPRESSIONS.values()
+}
+
+
+def resolve_compression(compression):
+    """Compression could be None (raw records) or a name in COMPRESSIONS, return its id"""
+    if compression is None:
+        return NO_COMPRESSION
+    elif compression in COMPRESSIONS:
+        return COMPRESSIONS[compression][0]
+    else:
+        raise ValueError(
+            "Unknown compression `{}`, choose one of {}".format(
+                compression, sorted(COMPRESSIONS)
+            )
+        )
+
+
+def compress(compression_id, data):
+    return _COMPRESSORS[compression_id](data)
+
+
+def decompress(compression_id, data):
+    if compression_id == NO_COMPRESSION:
+        return data
+    return _DECOMPRESSORS[compression_id](data)
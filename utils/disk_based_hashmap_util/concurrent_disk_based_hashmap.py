@@ -0,0 +1,701 @@
+from contextlib import contextmanager
+import threading
+
+from bucket import BucketEntry, BucketObject, DiskAddress
+from disk_based_hashmap import _DELETE, _SET, _SET_MANY, DiskBasedHashMap
+from doubly_linkedlist import DoublyLinkedList
+from synchronization import MultiLock
+
+
+class ConcurrentDiskBasedHashMap(DiskBasedHashMap):
+    """Thread safe DiskBasedHashMap. Buckets are guarded by striped locks picked by
+       bucket index, eviction policy and disk LRU list are guarded by a short LRU lock
+       which is never held during disk I/O. Lock order is stripe before LRU lock
+
+       Disk records are read by os.pread outside of all locks and validated afterwards,
+       so threads waiting for disk never stall in-memory hits. Bucket split, clear,
+       compact and close lock all stripes. Memory mapped reads are not supported
+    """
+
+    POSITIONAL_IO = True
+
+    def __init__(self, work_dir=None, lock_stripes=16, **kwargs):
+        if kwargs.get("use_mmap"):
+            raise ValueError("Memory mapped reads are not supported by concurrent map")
+        self._stripes = [threading.Lock() for _ in range(max(lock_stripes, 1))]
+        # reentrant since map length is read while all locks are held
+        self._lru_lock = threading.RLock()
+        super().__init__(work_dir=work_dir, **kwargs)
+
+    def __getitem__(self, item):
+        return self._lookup(item)
+
+    def __contains__(self, key):
+        """Compare keys only, value is neither loaded nor promoted"""
+        try:
+            self._lookup(key, promote=False, with_value=False)
+        except KeyError:
+            return False
+        return True
+
+    def peek(self, key, default=None):
+        """Return value of key without promoting it, default if it doesn't exist"""
+        try:
+            return self._lookup(key, promote=False)
+        except KeyError:
+            return default
+
+    def _lookup(self, item, promote=True, with_value=True):
+        """Find item optimistically, records are read without locks and validated
+           afterwards. Promoting lookup is a hit or miss of eviction policy and balances
+           memory usage, otherwise policy is untouched
+        """
+        key_hash = self._key_hash(item)
+        if not self._might_contain(key_hash):
+            raise KeyError("Key `{}` is not exists".format(item))
+        while True:
+            with self._locked_bucket(key_hash) as bucket:
+                # (entry, key address, value address) of disk entries with same hash
+                candidates = []
+                for node in bucket.linked_list:
+                    bucket_entry = node.value
+                    if bucket_entry.key_hash != key_hash or (
+                        bucket_entry.key.is_in_memory()
+                        and bucket_entry.key.value != item
+                    ):
+                        continue
+                    if not bucket_entry.is_in_memory():
+                        candidates.append(
+                            (
+                                bucket_entry,
+                                bucket_entry.key.value,
+                                bucket_entry.value.value,
+                            )
+                        )
+                    else:
+                        if promote:
+                            with self._lru_lock:
+                                self._in_memory_objects.access(bucket_entry)
+                        return bucket_entry.value.value
+                if not candidates:
+                    raise KeyError("Key `{}` is not exists".format(item))
+            # read candidates without lock, records could be moved meanwhile
+            found, error = None, None
+            try:
+                for bucket_entry, key_address, value_address in candidates:
+                    # pinned key has been compared already
+                    if (
+                        not isinstance(key_address, DiskAddress)
+                        or bucket.load_value(key_address) == item
+                    ):
+                        found = (
+                            bucket_entry,
+                            bucket.load_value(value_address) if with_value else None,
+                        )
+                        break
+            except Exception as e:
+                error = e
+            with self._locked_bucket(key_hash) as locked_bucket:
+                if locked_bucket is not bucket or not all(
+                    bucket_entry.lru_node.owner is self._disk_objects
+                    and bucket_entry.key.value is key_address
+                    and bucket_entry.value.value is value_address
+                    for bucket_entry, key_address, value_address in candidates
+                ):
+                    continue
+                if error is not None:
+                    raise error
+                if found is None:
+                    raise KeyError("Key `{}` is not exists".format(item))
+                bucket_entry, value = found
+                if not promote:
+                    return value
+                with self._lru_lock:
+                    self._in_memory_objects.miss(bucket_entry)
+                    self._disk_objects.move_to_end(bucket_entry.lru_node)
+            self._balance()
+            return value
+
+    def __setitem__(self, key, value):
+        key_hash = self._key_hash(key)
+        with self._locked_keys(key_hash) as (bucket, bucket_keys):
+            # updates of a key are logged in order under its stripe
+            sequence = self._append_log((_SET, key, value))
+            for node, bucket_key in bucket_keys.items():
+                bucket_entry = node.value
+                if bucket_key == key:
+                    if bucket_entry.is_in_memory():
+                        self._release(bucket_entry.value)
+                        with self._lru_lock:
+                            self._in_memory_objects.replace_value(bucket_entry, value)
+                    else:
+                        self._release(bucket_entry.key)
+                        self._release(bucket_entry.value)
+                        bucket_entry.key.value = bucket_key
+                        bucket_entry.value.value = value
+                        bucket_entry.value.size = None
+                        with self._lru_lock:
+                            self._disk_objects.remove(bucket_entry.lru_node)
+                            self._in_memory_objects.add(bucket_entry)
+                    break
+            else:
+                bucket_entry = BucketEntry(
+                    key_hash, BucketObject(key, bucket), BucketObject(value, bucket)
+                )
+                bucket.linked_list.append(
+                    DoublyLinkedList.create_new_node(bucket_entry)
+                )
+                with self._lru_lock:
+                    self._in_memory_objects.add(bucket_entry)
+                self._remember_key(key_hash)
+        # concurrent writers join the same fsync once their stripes are released
+        self._commit_log(sequence)
+        self._checkpoint_full_log()
+        self._grow_and_balance()
+
+    def __delitem__(self, key):
+        key_hash = self._key_hash(key)
+        if not self._might_contain(key_hash):
+            raise KeyError("Key `{}` is not exists".format(key))
+        with self._locked_keys(key_hash) as (bucket, bucket_keys):
+            for node, bucket_key in bucket_keys.items():
+                bucket_entry = node.value
+                if bucket_key == key:
+                    sequence = self._append_log((_DELETE, key))
+                    with self._lru_lock:
+                        self._in_memory_objects.remove(bucket_entry)
+                        self._disk_objects.remove(bucket_entry.lru_node)
+                    self._release(bucket_entry.key)
+                    self._release(bucket_entry.value)
+                    assert bucket.linked_list.remove(node) == True
+                    # filter is updated under stripe, same as adding the key again
+                    self._forget_key(bucket, key_hash)
+                    break
+            else:
+                raise KeyError("Key `{}` is not exists".format(key))
+        self._commit_log(sequence)
+        self._checkpoint_full_log()
+        self._balance()
+
+    def get_many(self, keys, default=None):
+        """Return values of keys in order, default for missing ones. Candidates are
+           collected with their stripes locked, then records are read bucket by bucket
+           in file order without locks and validated afterwards, like `_lookup`. Keys
+           whose records moved meanwhile or failed to be read are looked up again one
+           by one
+        """
+        keys = list(keys)
+        values = [default] * len(keys)
+        # key position -> (key hash, bucket, [(entry, key address, value address)])
+        disk_candidates = {}
+        # bucket -> addresses of records to read, dict keeps them unique and ordered
+        reads = {}
+        for position, key in enumerate(keys):
+            key_hash = self._key_hash(key)
+            if not self._might_contain(key_hash):
+                continue
+            with self._locked_bucket(key_hash) as bucket:
+                candidates = []
+                for node in bucket.linked_list:
+                    bucket_entry = node.value
+                    if bucket_entry.key_hash != key_hash or (
+                        bucket_entry.key.is_in_memory()
+                        and bucket_entry.key.value != key
+                    ):
+                        continue
+                    if bucket_entry.is_in_memory():
+                        with self._lru_lock:
+                            self._in_memory_objects.access(bucket_entry)
+                        values[position] = bucket_entry.value.value
+                        break
+                    candidates.append(
+                        (bucket_entry, bucket_entry.key.value, bucket_entry.value.value)
+                    )
+                else:
+                    if candidates:
+                        disk_candidates[position] = (key_hash, bucket, candidates)
+                    for _, key_address, value_address in candidates:
+                        # pinned key has been compared already
+                        for disk_address in (key_address, value_address):
+                            if isinstance(disk_address, DiskAddress):
+                                reads.setdefault(bucket, {})[disk_address] = None
+        # key and value records of an entry are adjacent, read them in the same sweep
+        loaded_records = self._read_in_file_order(reads)
+        # (entry, key address, value address, key, value) of validated hits
+        hits, moved_positions = [], []
+        for position, (key_hash, bucket, candidates) in disk_candidates.items():
+            with self._locked_bucket(key_hash) as locked_bucket:
+                if (
+                    locked_bucket is not bucket
+                    or not all(
+                        bucket_entry.lru_node.owner is self._disk_objects
+                        and bucket_entry.key.value is key_address
+                        and bucket_entry.value.value is value_address
+                        for bucket_entry, key_address, value_address in candidates
+                    )
+                    # lookup raises the error itself if record is still unreadable
+                    or any(
+                        loaded_records[disk_address][1] is not None
+                        for _, key_address, value_address in candidates
+                        for disk_address in (key_address, value_address)
+                        if isinstance(disk_address, DiskAddress)
+                    )
+                ):
+                    moved_positions.append(position)
+                    continue
+                for bucket_entry, key_address, value_address in candidates:
+                    bucket_key = self._loaded_record(loaded_records, key_address)
+                    if bucket_key == keys[position]:
+                        value = self._loaded_record(loaded_records, value_address)
+                        values[position] = value
+                        with self._lru_lock:
+                            self._in_memory_objects.miss(bucket_entry)
+                            self._disk_objects.move_to_end(bucket_entry.lru_node)
+                        hits.append(
+                            (
+                                bucket_entry,
+                                key_address,
+                                value_address,
+                                bucket_key,
+                                value,
+                            )
+                        )
+                        break
+        for position in moved_positions:
+            values[position] = self.get(keys[position], default)
+        self._promote(hits)
+        self._balance()
+        return values
+
+    def set_many(self, items):
+        """Keys of disk entries are read in file order without locks, then batch is
+           written with all stripes locked once none of them has moved since, like
+           `_locked_keys`. Memory usage is balanced after it
+        """
+        items = dict(items)
+        # key address -> (key, error) read so far
+        disk_keys = {}
+        while True:
+            with self._lock:
+                # key bucket object -> key, and bucket -> key addresses to read
+                loaded_keys, reads = {}, {}
+                for key in items:
+                    key_hash = self._key_hash(key)
+                    if not self._might_contain(key_hash):
+                        continue
+                    bucket = self._buckets[self._index(key_hash)]
+                    for node in bucket.linked_list:
+                        bucket_entry = node.value
+                        if (
+                            bucket_entry.key_hash != key_hash
+                            or bucket_entry.is_in_memory()
+                        ):
+                            continue
+                        bucket_object = bucket_entry.key
+                        if not isinstance(bucket_object.value, DiskAddress):
+                            loaded_keys[bucket_object] = bucket_object.value
+                        elif bucket_object.value in disk_keys:
+                            loaded_keys[bucket_object] = self._loaded_record(
+                                disk_keys, bucket_object.value
+                            )
+                        else:
+                            reads.setdefault(bucket, {})[bucket_object.value] = None
+                if not reads:
+                    sequence = self._append_log((_SET_MANY, items))
+                    self._set_many(items, loaded_keys)
+                    break
+            disk_keys.update(self._read_in_file_order(reads))
+        self._commit_log(sequence)
+        self._checkpoint_full_log()
+        self._grow_and_balance()
+
+    def __len__(self):
+        with self._lru_lock:
+            return len(self._in_memory_objects) + len(self._disk_objects)
+
+    def _get_in_memory(self, item):
+        """Look item up without disk I/O and without waiting for a busy stripe or LRU
+           lock, return (found, value). Found is None if answer needs disk I/O or a lock
+           is busy
+        """
+        key_hash = self._key_hash(item)
+        if not self._might_contain(key_hash):
+            return False, None
+        with self._locked_bucket(key_hash, blocking=False) as bucket:
+            if bucket is None:
+                return None, None
+            has_disk_candidate = False
+            for node in bucket.linked_list:
+                bucket_entry = node.value
+                if bucket_entry.key_hash != key_hash or (
+                    bucket_entry.key.is_in_memory() and bucket_entry.key.value != item
+                ):
+                    continue
+                if not bucket_entry.is_in_memory():
+                    has_disk_candidate = True
+                else:
+                    if not self._lru_lock.acquire(blocking=False):
+                        return None, None
+                    try:
+                        self._in_memory_objects.access(bucket_entry)
+                    finally:
+                        self._lru_lock.release()
+                    return True, bucket_entry.value.value
+            return (None if has_disk_candidate else False), None
+
+    def _set_in_memory(self, key, value):
+        """Update or add key without disk I/O and without balancing memory usage, return
+           False if it needs disk I/O or stripe or LRU lock is busy. Logged updates
+           append to write-ahead log, and wait for its fsync with group commit, which
+           never happens on event loop
+        """
+        if self._write_ahead_log is not None:
+            return False
+        key_hash = self._key_hash(key)
+        with self._locked_bucket(key_hash, blocking=False) as bucket:
+            if bucket is None:
+                return False
+            matched_entry = None
+            nodes = bucket.linked_list if self._might_contain(key_hash) else ()
+            for node in nodes:
+                bucket_entry = node.value
+                if bucket_entry.key_hash != key_hash:
+                    continue
+                if not bucket_entry.is_in_memory():
+                    return False
+                if bucket_entry.key.value == key:
+                    matched_entry = bucket_entry
+            if not self._lru_lock.acquire(blocking=False):
+                return False
+            try:
+                if matched_entry is not None:
+                    self._release(matched_entry.value)
+                    self._in_memory_objects.replace_value(matched_entry, value)
+                else:
+                    bucket_entry = BucketEntry(
+                        key_hash, BucketObject(key, bucket), BucketObject(value, bucket)
+                    )
+                    bucket.linked_list.append(
+                        DoublyLinkedList.create_new_node(bucket_entry)
+                    )
+                    self._in_memory_objects.add(bucket_entry)
+            finally:
+                self._lru_lock.release()
+            if matched_entry is None:
+                self._remember_key(key_hash)
+            return True
+
+    def _needs_balance(self):
+        """Hint for event loop, it never waits for LRU lock. A busy lock means others
+           are changing memory usage, balance is needed then to be sure
+        """
+        if not self._lru_lock.acquire(blocking=False):
+            return True
+        try:
+            memory_usage = self._memory_usage()
+            return (
+                memory_usage > self._high_watermark()
+                or (
+                    memory_usage < self._low_watermark() and len(self._disk_objects) > 0
+                )
+                or self._is_overloaded()
+            )
+        finally:
+            self._lru_lock.release()
+
+    def _grow_and_balance(self):
+        # split needs all stripes, it must not be done with a stripe locked
+        if self._is_overloaded():
+            with self._lock:
+                while self._is_overloaded():
+                    self._split()
+        self._balance()
+
+    @contextmanager
+    def _locked_keys(self, key_hash):
+        """Lock bucket of key_hash, yield it with keys of its entries of the same hash,
+           chain node -> key. Keys on disk are read by os.pread without locks, stripe is
+           locked again until none of them has moved since
+        """
+        # chain node -> (key address, key, error) read so far
+        disk_keys = {}
+        while True:
+            with self._locked_bucket(key_hash) as bucket:
+                bucket_keys, unread_nodes = {}, []
+                # a new key needs no chain walk
+                nodes = bucket.linked_list if self._might_contain(key_hash) else ()
+                for node in nodes:
+                    if node.value.key_hash != key_hash:
+                        continue
+                    bucket_object = node.value.key
+                    if bucket_object.is_in_memory():
+                        bucket_keys[node] = bucket_object.value
+                    elif (
+                        node in disk_keys and disk_keys[node][0] is bucket_object.value
+                    ):
+                        _, bucket_key, error = disk_keys[node]
+                        if error is not None:
+                            raise error
+                        bucket_keys[node] = bucket_key
+                    else:
+                        unread_nodes.append((node, bucket_object.value))
+                if not unread_nodes:
+                    yield bucket, bucket_keys
+                    return
+            for node, key_address in unread_nodes:
+                try:
+                    disk_keys[node] = (
+                        key_address,
+                        bucket.load_value(key_address),
+                        None,
+                    )
+                except Exception as e:
+                    disk_keys[node] = (key_address, None, e)
+
+    def _read_in_file_order(self, reads):
+        """Read records of bucket -> disk addresses without locks, records of a bucket
+           in file order. Return dict of disk address -> (value, error). Records of a
+           failed batch are read again one by one, so that an error belongs to its own
+           record only. Caller validates them once stripes are locked again
+        """
+        loaded_records = {}
+        for bucket, disk_addresses in reads.items():
+            disk_addresses = list(disk_addresses)
+            try:
+                values = bucket.load_values(disk_addresses)
+            except Exception:
+                for disk_address in disk_addresses:
+                    try:
+                        loaded_records[disk_address] = (
+                            bucket.load_value(disk_address),
+                            None,
+                        )
+                    except Exception as e:
+                        loaded_records[disk_address] = (None, e)
+            else:
+                loaded_records.update(
+                    (disk_address, (value, None))
+                    for disk_address, value in zip(disk_addresses, values)
+                )
+        return loaded_records
+
+    def _loaded_record(self, loaded_records, disk_address):
+        """Value read at a validated disk_address, pinned key is its own value. Error of
+           reading it is raised now
+        """
+        if not isinstance(disk_address, DiskAddress):
+            return disk_address
+        value, error = loaded_records[disk_address]
+        if error is not None:
+            raise error
+        return value
+
+    def _promote(self, hits):
+        """Load validated get_many hits with values already read, up to low watermark.
+           They are the first entries balance would load, so the last hit goes first
+        """
+        for bucket_entry, key_address, value_address, key, value in reversed(hits):
+            with self._locked_bucket(bucket_entry.key_hash):
+                if (
+                    bucket_entry.lru_node.owner is not self._disk_objects
+                    or bucket_entry.key.value is not key_address
+                    or bucket_entry.value.value is not value_address
+                ):
+                    continue
+                with self._lru_lock:
+                    if self._memory_usage() >= self._low_watermark():
+                        return
+                    self._disk_objects.remove(bucket_entry.lru_node)
+                    for bucket_object, disk_address, loaded_value in (
+                        (bucket_entry.key, key_address, key),
+                        (bucket_entry.value, value_address, value),
+                    ):
+                        if isinstance(disk_address, DiskAddress):
+                            bucket_object.value = loaded_value
+                            bucket_object.disk_address = disk_address
+                    self._in_memory_objects.add(bucket_entry, hot=False)
+
+    def _lock_bucket_at(self, index):
+        return self._stripes[index % len(self._stripes)]
+
+    @contextmanager
+    def _locked_bucket(self, key_hash, blocking=True):
+        """Lock stripe of the bucket which key_hash belongs to, bucket index is checked
+           again once stripe is locked, since a concurrent split could change it. Yield
+           None if it's not blocking and stripe is busy
+        """
+        while True:
+            index = self._index(key_hash)
+            stripe = self._stripes[index % len(self._stripes)]
+            if not stripe.acquire(blocking):
+                yield None
+                return
+            try:
+                # split locks all stripes, index is stable now
+                if self._index(key_hash) == index:
+                    yield self._buckets[index]
+                    return
+            finally:
+                stripe.release()
+
+    def _compact_garbage(self):
+        if self._persistent:
+            # checkpoints and manifest cover the whole map, bucket is picked with
+            # everything locked
+            return super()._compact_garbage()
+        # ratios are read with their buckets locked, the worst bucket is checked again
+        # with its stripe locked, since writers change it meanwhile
+        index, bucket = max(
+            enumerate(list(self._buckets)), key=lambda item: item[1].garbage_ratio
+        )
+        with self._lock_bucket_at(index):
+            if (
+                bucket.garbage_size == 0
+                or bucket.garbage_ratio < self._compaction_garbage_ratio
+            ):
+                return False
+            self._compact_buckets([bucket], self._compaction_garbage_ratio)
+            return True
+
+    def _balance(self):
+        """Entries are loaded one at a time with their stripe locked, LRU lock is
+           released during disk I/O, so candidates are checked again after it. Like
+           single threaded map, loading is done before spilling. Victims are spilled in
+           runs, each run is guarded by one stripe and written as one batch
+        """
+        self._sample_memory_pressure()
+        while True:
+            with self._lru_lock:
+                if (
+                    self._memory_usage() >= self._low_watermark()
+                    or len(self._disk_objects) == 0
+                ):
+                    break
+                bucket_entry = self._disk_objects.peek_last().value
+            self._load(bucket_entry)
+        if self._memory_budget is not None:
+            self._memory_budget.balance(self)
+            return
+        with self._lru_lock:
+            if self._in_memory_objects.memory_usage <= self._memory_threshold:
+                return
+        self._spill_coldest(self._low_watermark(), None)
+
+    def _create_lock(self):
+        # whole map operations, such as clear and compact, lock everything
+        return MultiLock(self._stripes + [self._lru_lock])
+
+    def _rebalance(self):
+        self._balance()
+
+    def _victim_tick(self, blocking=True):
+        if not self._lru_lock.acquire(blocking):
+            return None
+        try:
+            if len(self._in_memory_objects) == 0:
+                return None
+            return self._in_memory_objects.victim().access_tick
+        finally:
+            self._lru_lock.release()
+
+    def _spill_coldest(self, memory_floor, until_tick, blocking=True):
+        """Spill runs of victims until memory usage drops to floor, or until next
+           victim was accessed after until_tick. Return freed bytes
+        """
+        freed = 0
+        while True:
+            if not self._lru_lock.acquire(blocking):
+                break
+            try:
+                if self._in_memory_objects.memory_usage <= memory_floor:
+                    break
+                bucket_entry = self._in_memory_objects.victim()
+                if (
+                    until_tick is not None
+                    and freed > 0
+                    and bucket_entry.access_tick > until_tick
+                ):
+                    break
+                key_hash = bucket_entry.key_hash
+            finally:
+                self._lru_lock.release()
+            with self._locked_bucket(key_hash, blocking) as bucket:
+                if bucket is None:
+                    break
+                freed += self._spill(
+                    self._lock_bucket_at(self._index(key_hash)),
+                    memory_floor,
+                    until_tick,
+                )
+        return freed
+
+    def _spill(self, stripe, memory_floor, until_tick=None):
+        """Evict victims one after another while they are guarded by the locked stripe,
+           then write them together. Victim could have changed since stripe was picked.
+           Victims join disk list as they are evicted, so that map length never misses
+           them, and they are only touched with their stripe locked until written.
+           Return freed bytes
+        """
+        bucket_entries = []
+        with self._lru_lock:
+            memory_usage = self._in_memory_objects.memory_usage
+            while self._in_memory_objects.memory_usage > memory_floor:
+                bucket_entry = self._in_memory_objects.victim()
+                if (
+                    self._lock_bucket_at(self._index(bucket_entry.key_hash))
+                    is not stripe
+                ) or (
+                    until_tick is not None
+                    and len(bucket_entries) > 0
+                    and bucket_entry.access_tick > until_tick
+                ):
+                    break
+                self._in_memory_objects.evict(bucket_entry)
+                self._disk_objects.append(bucket_entry.lru_node)
+                bucket_entries.append(bucket_entry)
+            freed = memory_usage - self._in_memory_objects.memory_usage
+        self._spill_entries(bucket_entries)
+        return freed
+
+    def _load(self, bucket_entry):
+        """Load the coldest disk entry, its records are read by os.pread without locks.
+           It's loaded only if it's still the coldest one and its records haven't moved
+        """
+        with self._locked_bucket(bucket_entry.key_hash) as bucket:
+            if bucket_entry.lru_node.owner is not self._disk_objects:
+                return
+            disk_addresses = (bucket_entry.key.value, bucket_entry.value.value)
+        values, error = None, None
+        try:
+            # pinned key stays in memory
+            values = [
+                bucket.load_value(disk_address)
+                if isinstance(disk_address, DiskAddress)
+                else disk_address
+                for disk_address in disk_addresses
+            ]
+        except Exception as e:
+            error = e
+        with self._locked_bucket(bucket_entry.key_hash) as locked_bucket:
+            if (
+                locked_bucket is not bucket
+                or bucket_entry.key.value is not disk_addresses[0]
+                or bucket_entry.value.value is not disk_addresses[1]
+            ):
+                return
+            if error is not None:
+                raise error
+            with self._lru_lock:
+                if (
+                    self._memory_usage() >= self._low_watermark()
+                    or self._disk_objects.peek_last() is not bucket_entry.lru_node
+                ):
+                    return
+                self._disk_objects.remove(bucket_entry.lru_node)
+                for bucket_object, disk_address, value in zip(
+                    (bucket_entry.key, bucket_entry.value), disk_addresses, values
+                ):
+                    if isinstance(disk_address, DiskAddress):
+                        bucket_object.value = value
+                        bucket_object.disk_address = disk_address
+                self._in_memory_objects.add(bucket_entry, hot=False)
@@ -1,232 +1,1338 @@
-from collections import MutableMapping
+from collections.abc import ItemsView, MutableMapping, ValuesView
 import os
+import pickle
 import shutil
+import threading
 
 from doubly_linkedlist import DoublyLinkedList
-from bucket_memory_doubly_linkedlist import BucketMemoryDoublyLinkedList
-from bucket import Bucket, BucketObject
+from bucket import (
+    Bucket,
+    BucketEntry,
+    BucketObject,
+    BucketCheckpoint,
+    DiskAddress,
+    existing_segments,
+    segment_filepath,
+)
+from codec import CodecRegistry
+from compactor import BackgroundCompactor
+from eviction_policy import create_eviction_policy
+from file_handle_pool import FileHandlePool
+from key_filter import KeyFilter
+from memory_pressure import AdaptiveThreshold
+from synchronization import synchronized
+from write_ahead_log import WriteAheadLog
+
+# update records of write-ahead log
+_SET, _DELETE, _SET_MANY = 0, 1, 2
 
 
 class DiskBasedHashMap(MutableMapping):
-    """Disk Based Hash Map, spill data to disk when exceeding memory threshold. Non thread safe implementation"""
+    """Disk Based Hash Map, spill data to disk when exceeding memory threshold. Non thread safe implementation,
+       use ConcurrentDiskBasedHashMap for concurrent access
+    """
+
+    MANIFEST_FILENAME = "manifest"
+    LOG_FILENAME = "wal"
+    DURABILITIES = ("none", "close", "periodic", "group")
+    HASH_PROBE = "DiskBasedHashMap"
+    # buckets read and write records through os.pread and os.pwrite
+    POSITIONAL_IO = False
 
-    def __init__(self, work_dir=None, bucket_num=4, memory_threshold=64 * 1024):
+    def __init__(
+        self,
+        work_dir=None,
+        bucket_num=4,
+        memory_threshold=64 * 1024,
+        low_watermark=None,
+        max_open_files=64,
+        use_mmap=False,
+        persistent=False,
+        max_load_factor=None,
+        sizer=None,
+        eviction_policy=None,
+        codecs=None,
+        compression=None,
+        compression_threshold=256,
+        compression_block_size=None,
+        compaction_garbage_ratio=None,
+        pin_keys=False,
+        key_filter_capacity=None,
+        durability=None,
+        sync_interval=0.1,
+        max_log_size=16 * 1024 * 1024,
+        segment_size=None,
+        memory_budget=None,
+        memory_reservation=0,
+        memory_ceiling=None,
+        memory_sample_interval=1.0,
+    ):
+        # none: nothing is fsynced. close: checkpoints are fsynced, so are close and
+        # clear. periodic: updates are also logged and log is fsynced every
+        # sync_interval seconds. group: every update returns once its log record is
+        # fsynced, concurrent writers share one fsync
+        durability = "none" if durability is None else durability
+        if durability not in self.DURABILITIES:
+            raise ValueError("Unknown durability `{}`".format(durability))
+        if durability != "none" and not persistent:
+            raise ValueError(
+                "Durability `{}` needs a persistent map".format(durability)
+            )
+        self._durability = durability
+        # logged updates are saved by a full checkpoint once log exceeds this size in
+        # bytes, which resets it. `None` means log is reset by close, clear and
+        # compaction only
+        self._max_log_size = max_log_size
+        if memory_ceiling is not None and memory_budget is not None:
+            raise ValueError("Memory ceiling can't be used with a shared memory budget")
         if not work_dir:
             work_dir = os.path.join(os.curdir, "buckets")
-        # force cleanup
-        if os.path.exists(work_dir):
-            shutil.rmtree(work_dir)
-        os.mkdir(work_dir)
         # all buckets stored here
         self._work_dir = work_dir
+        # persistent map writes a manifest on close and reopens existing work_dir
+        self._persistent = persistent
+        manifest = self._read_manifest() if persistent else None
+        existing_bucket_num = self._existing_bucket_num() if persistent else 0
+        reopen = manifest is not None or existing_bucket_num > 0
+        if not reopen:
+            # force cleanup
+            if os.path.exists(work_dir):
+                shutil.rmtree(work_dir)
+            os.mkdir(work_dir)
+        else:
+            # bucket number must be the same as before, otherwise keys are misplaced
+            existing_bucket_num = (
+                manifest["bucket_num"] if manifest is not None else existing_bucket_num
+            )
         # data spilling threshold, default is 64M. `0` means it works in absolutely disk mode
         self._memory_threshold = (
             64 * 1024 if memory_threshold is None else max(memory_threshold, 0)
         )
-        # total number of bucket, it should always be power of two
-        self._bucket_num = self._power_of_two_ceiling(
-            4 if bucket_num is None else max(bucket_num, 1)
+        # threshold is the high watermark, once it's exceeded entries are spilled in a
+        # batch until memory usage drops to this ratio of it, entries are loaded back
+        # up to it as well. `None` means no hysteresis
+        self._low_watermark_ratio = (
+            1.0 if low_watermark is None else min(max(low_watermark, 0.0), 1.0)
+        )
+        # adaptive mode, threshold follows host memory pressure sampled every interval
+        # between memory_threshold as floor and the ceiling. `None` means static
+        self._adaptive_threshold = (
+            None
+            if memory_ceiling is None
+            else AdaptiveThreshold(
+                self._memory_threshold,
+                max(memory_ceiling, self._memory_threshold),
+                self._adapt_threshold,
+                sample_interval=memory_sample_interval,
+            )
         )
-        # buckets
+        # number of buckets at the beginning of current linear hashing round, it should
+        # always be power of two. Buckets before split index are split in this round
+        if reopen:
+            self._bucket_num = self._power_of_two_ceiling(existing_bucket_num + 1) >> 1
+            self._split_index = existing_bucket_num - self._bucket_num
+        else:
+            self._bucket_num = self._power_of_two_ceiling(
+                4 if bucket_num is None else max(bucket_num, 1)
+            )
+            self._split_index = 0
+        # split a bucket once average chain length exceeds it, `None` means never split
+        self._max_load_factor = max_load_factor
+        self._use_mmap = use_mmap
+        # user codecs take priority over raw bytes, str, number and pickle codecs
+        self._codec_registry = CodecRegistry(codecs)
+        # key hashes of a persistent map are saved by checkpoints and place keys in
+        # buckets, they must not change with process, builtin hash of str does
+        self._key_hash = self._codec_registry.stable_hash if persistent else hash
+        # optional zlib, bz2 or lzma compression of records longer than threshold. With
+        # block size, evicted records are buffered per bucket and compressed together
+        # once buffered data exceeds it
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._compression_block_size = compression_block_size
+        # bucket file handles are kept opened and shared by all buckets, bounded by LRU
+        self._file_handle_pool = FileHandlePool(max_open_files=max_open_files)
+        # a background thread compacts buckets whose dead bytes exceed this ratio of
+        # file size, `None` means compaction is manual only
+        self._compaction_garbage_ratio = compaction_garbage_ratio
+        # bucket files roll over to a new segment once they exceed this many bytes,
+        # compaction merges mostly dead segments instead of rewriting the whole bucket.
+        # `None` means a single file per bucket
+        self._segment_size = segment_size
+        # compactor is created once map is restored, see the end
+        self._compactor = None
+        # buckets whose entries moved by splits since their checkpoints, they're saved
+        # together by the next checkpoint, before any bucket file is rewritten
+        self._unsaved_buckets = set()
+        # key directory mode, keys of spilled entries stay in memory and only values
+        # are written to disk, so that key lookups never read disk
+        self._pin_keys = pin_keys
+        # cuckoo filter sized for this many keys, most lookups and deletes of missing
+        # keys return without walking bucket chain. `None` means no filter
+        self._key_filter = (
+            None if key_filter_capacity is None else KeyFilter(key_filter_capacity)
+        )
+        self._lock = self._create_lock()
+        # buckets, work_dir is listed once for segments of reopened bucket files
+        segments = existing_segments(os.path.abspath(work_dir)) if reopen else {}
         self._buckets = [
-            Bucket(
-                os.path.abspath(os.path.join(work_dir, "bucket_{}.txt".format(index)))
+            self._create_bucket(
+                self._bucket_filepath(index),
+                truncate=not reopen,
+                segments=segments.get(self._bucket_filepath(index), [0]),
             )
-            for index in range(self._bucket_num)
+            for index in range(self._bucket_num + self._split_index)
         ]
-        # bucket memory doubly linked list for BucketObject
-        self._in_memory_objects = BucketMemoryDoublyLinkedList()
-        # all disk objects' memory usage are same
+        # in-memory BucketEntry are ordered by eviction policy, LRU by default
+        self._in_memory_objects = create_eviction_policy(eviction_policy, sizer=sizer)
+        # a budget shared with other maps replaces threshold and low watermark of this
+        # map, at least reservation bytes of this map stay in memory
+        self._memory_budget = memory_budget
+        # LRU linked list of disk BucketEntry, all disk entries' memory usage are same
         self._disk_objects = DoublyLinkedList()
-        # object -> in_memory list_node or disk list_node
-        self._object_to_list_node = {}
+        # other maps sharing budget could spill entries of this map from now on
+        if memory_budget is not None:
+            memory_budget.register(self, memory_reservation)
+        # updates since the last full checkpoint are logged, log is replayed on reopen
+        self._write_ahead_log = None
+        if reopen:
+            self._restore(manifest)
+            self._rebalance()
+            self._replay_log()
+        if durability in ("periodic", "group"):
+            self._write_ahead_log = WriteAheadLog(
+                self._log_filepath(),
+                group_commit=durability == "group",
+                sync_interval=sync_interval if durability == "periodic" else None,
+            )
+            self._sync_directory()
+        # compactor must not rewrite buckets whose entries are still being restored,
+        # garbage of reopened files is compacted from now on
+        if compaction_garbage_ratio is not None:
+            self._compactor = BackgroundCompactor(self._compact_garbage)
+            for bucket in self._buckets:
+                self._wake_compactor(bucket)
 
+    @synchronized
     def __getitem__(self, item):
         """Get corresponding value for given key, one thing need to be mentioned here is
            value's update outside of this dict may not come into effect inside this dict
            since that value could be a disk object, you need to use `set` to guarantee your
            update is persisted
         """
-        bucket = self._buckets[self._index(item)]
+        key_hash = self._key_hash(item)
+        if not self._might_contain(key_hash):
+            raise KeyError("Key `{}` is not exists".format(item))
+        bucket = self._buckets[self._index(key_hash)]
         for node in bucket.linked_list:
-            bucket_object_key, bucket_object_value = node.value
-            assert isinstance(bucket_object_key, BucketObject)
-            assert isinstance(bucket_object_value, BucketObject)
-            if bucket_object_key.load_value() == item:
-                key_list_node, value_list_node = (
-                    self._object_to_list_node[bucket_object_key],
-                    self._object_to_list_node[bucket_object_value],
-                )
-                # update in-memory and disk linked list
-                self._in_memory_objects.remove_and_append(key_list_node)
-                self._in_memory_objects.remove_and_append(value_list_node)
-                self._disk_objects.remove_and_append(key_list_node)
-                self._disk_objects.remove_and_append(value_list_node)
-                # balance memory usage
-                self._balance()
-                return bucket_object_value.load_value()
+            bucket_entry = node.value
+            # compare hash first, only true hash match need to load key
+            if (
+                bucket_entry.key_hash == key_hash
+                and bucket_entry.key.load_value() == item
+            ):
+                # memory usage is unchanged by in-memory hit, nothing to balance
+                if bucket_entry.is_in_memory():
+                    self._in_memory_objects.access(bucket_entry)
+                else:
+                    self._in_memory_objects.miss(bucket_entry)
+                    self._disk_objects.move_to_end(bucket_entry.lru_node)
+                    self._balance()
+                return bucket_entry.value.load_value()
         raise KeyError("Key `{}` is not exists".format(item))
 
     def __setitem__(self, key, value):
         """Update key-value pair if key existing, otherwise add a new key-value pair"""
-        bucket = self._buckets[self._index(key)]
-        for node in bucket.linked_list:
-            # key, value pair stored in bucket linked list
-            bucket_object_key, bucket_object_value = node.value
-            assert isinstance(bucket_object_key, BucketObject)
-            assert isinstance(bucket_object_value, BucketObject)
-            if bucket_object_key.load_value() == key:
-                key_list_node, value_list_node = (
-                    self._object_to_list_node[bucket_object_key],
-                    self._object_to_list_node[bucket_object_value],
-                )
-                # update key_list_node and remove value_list_node
-                self._in_memory_objects.remove_and_append(key_list_node)
-                self._disk_objects.remove_and_append(key_list_node)
-                self._in_memory_objects.remove(value_list_node)
-                self._disk_objects.remove(value_list_node)
-                self._object_to_list_node.pop(bucket_object_value)
-                # append value list node to in-memory linked list
-                bucket_object_value.value = value
-                self._object_to_list_node[
-                    bucket_object_value
-                ] = DoublyLinkedList.create_new_node(bucket_object_value)
-                self._in_memory_objects.append(
-                    self._object_to_list_node[bucket_object_value]
-                )
-                # balance memory usage
-                self._balance()
-                return
+        # concurrent writers join the same fsync once map is unlocked
+        self._commit_log(self._logged_set(key, value))
+        self._checkpoint_full_log()
+
+    @synchronized
+    def _logged_set(self, key, value):
+        """Log and apply update with map locked, return sequence number of its log
+           record
+        """
+        sequence = self._append_log((_SET, key, value))
+        key_hash = self._key_hash(key)
+        bucket = self._buckets[self._index(key_hash)]
+        # a new key needs no chain walk
+        nodes = bucket.linked_list if self._might_contain(key_hash) else ()
+        for node in nodes:
+            bucket_entry = node.value
+            if bucket_entry.key_hash == key_hash:
+                bucket_key = bucket_entry.key.load_value()
+                if bucket_key == key:
+                    if bucket_entry.is_in_memory():
+                        self._release(bucket_entry.value)
+                        self._in_memory_objects.replace_value(bucket_entry, value)
+                    else:
+                        self._replace_disk_entry(bucket_entry, bucket_key, value)
+                    # balance memory usage
+                    self._balance()
+                    return sequence
         # append key-value pair to current bucket
-        bucket_object_key, bucket_object_value = (
-            BucketObject(key, bucket),
-            BucketObject(value, bucket),
-        )
-        bucket.linked_list.append(
-            DoublyLinkedList.create_new_node((bucket_object_key, bucket_object_value))
-        )
-        # append key_object and value_object to in_memory_objects
-        key_list_node = DoublyLinkedList.create_new_node(bucket_object_key)
-        self._in_memory_objects.append(key_list_node)
-        value_list_node = DoublyLinkedList.create_new_node(bucket_object_value)
-        self._in_memory_objects.append(value_list_node)
-        # update object -> list node dict
-        self._object_to_list_node[bucket_object_key] = key_list_node
-        self._object_to_list_node[bucket_object_value] = value_list_node
+        self._append_entry(bucket, key_hash, key, value)
+        # grow bucket number online, one bucket at a time
+        while self._is_overloaded():
+            self._split()
         # balance memory usage
         self._balance()
+        return sequence
 
     def __delitem__(self, key):
         """Del key-value pair from dict"""
-        bucket = self._buckets[self._index(key)]
+        self._commit_log(self._logged_delete(key))
+        self._checkpoint_full_log()
+
+    @synchronized
+    def _logged_delete(self, key):
+        """Log and apply delete with map locked, return sequence number of its log
+           record
+        """
+        key_hash = self._key_hash(key)
+        if not self._might_contain(key_hash):
+            raise KeyError("Key `{}` is not exists".format(key))
+        bucket = self._buckets[self._index(key_hash)]
         for node in bucket.linked_list:
-            bucket_object_key, bucket_object_value = node.value
-            if bucket_object_key.load_value() == key:
-                # remove objects from object -> list_node dict
-                key_list_node = self._object_to_list_node.pop(bucket_object_key)
-                value_list_node = self._object_to_list_node.pop(bucket_object_value)
-                # remove list_node from in_memory and disk objects
-                self._in_memory_objects.remove(key_list_node)
-                self._in_memory_objects.remove(value_list_node)
-                self._disk_objects.remove(key_list_node)
-                self._disk_objects.remove(value_list_node)
+            bucket_entry = node.value
+            if (
+                bucket_entry.key_hash == key_hash
+                and bucket_entry.key.load_value() == key
+            ):
+                sequence = self._append_log((_DELETE, key))
+                # remove entry from eviction policy or disk linked list
+                self._in_memory_objects.remove(bucket_entry)
+                self._disk_objects.remove(bucket_entry.lru_node)
+                # records of spilled entry or disk copies of loaded one are dead
+                self._release(bucket_entry.key)
+                self._release(bucket_entry.value)
                 # remove node from bucket linked list
                 assert bucket.linked_list.remove(node) == True
+                self._forget_key(bucket, key_hash)
                 self._balance()
-                return
+                return sequence
         raise KeyError("Key `{}` is not exists".format(key))
 
+    @synchronized
+    def get_many(self, keys, default=None):
+        """Return values of keys in order, default for missing ones. In-memory hits are
+           resolved first, remaining records are read bucket by bucket in file order.
+           Memory usage is balanced once per batch
+        """
+        values = self._get_many(keys, default)
+        self._balance()
+        return values
+
+    def set_many(self, items):
+        """Update or add all key-value pairs of a mapping or an iterable of pairs, keys
+           of disk entries are read bucket by bucket in file order. Memory usage is
+           balanced once per batch
+        """
+        self._commit_log(self._logged_set_many(dict(items)))
+        self._checkpoint_full_log()
+
+    @synchronized
+    def _logged_set_many(self, items):
+        """Log and apply batch with map locked, return sequence number of its log
+           record
+        """
+        sequence = self._append_log((_SET_MANY, items))
+        self._set_many(items)
+        while self._is_overloaded():
+            self._split()
+        self._balance()
+        return sequence
+
+    @synchronized
+    def __contains__(self, key):
+        """Compare keys only, value is neither loaded nor promoted and eviction policy
+           doesn't see the lookup
+        """
+        return self._find_entry(key) is not None
+
+    @synchronized
+    def peek(self, key, default=None):
+        """Return value of key, default if it doesn't exist. A spilled value is read from
+           disk but left there, eviction policy and disk LRU list are untouched
+        """
+        bucket_entry = self._find_entry(key)
+        if bucket_entry is None:
+            return default
+        return bucket_entry.value.load_value()
+
     def __iter__(self):
-        """Return all keys"""
-        for bucket in self._buckets:
-            for node in bucket.linked_list:
-                bucket_key_object, _ = node.value
-                yield bucket_key_object.load_value()
+        """Return all keys, spilled keys are streamed in file order, pinned keys are
+           never read from disk
+        """
+        return self._scan(True, False)
+
+    def values(self):
+        """Streaming view, values are never promoted into memory by iterating it"""
+        return _StreamingValuesView(self)
+
+    def items(self):
+        """Streaming view, items are never promoted into memory by iterating it"""
+        return _StreamingItemsView(self)
 
     def __str__(self):
         return str(list(self))
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @synchronized
     def __len__(self):
-        # Since we store key-value pair both, it means the total amount of objects is even
-        assert len(self._object_to_list_node) % 2 == 0
-        return len(self._object_to_list_node) // 2
+        # every entry is either in memory or on disk
+        return len(self._in_memory_objects) + len(self._disk_objects)
+
+    @property
+    def eviction_policy(self):
+        """Eviction policy of in-memory entries, it exposes hit and miss counters"""
+        return self._in_memory_objects
 
+    @synchronized
     def clear(self):
         """Default implementation is inefficient"""
         self._in_memory_objects.clear()
         self._disk_objects.clear()
-        self._object_to_list_node.clear()
         for bucket in self._buckets:
             bucket.clear()
+        if self._key_filter is not None:
+            self._key_filter.clear()
+        # old manifest points to truncated records
+        if self._persistent:
+            self._checkpoint()
 
+    def close(self):
+        """Release all opened bucket file handles, map is still usable afterwards
+           since handles will be reopened lazily. Persistent map writes a manifest here
+           so that it could be reopened later
+        """
+        # compactor thread is restarted by next wakeup
+        if self._compactor is not None:
+            self._compactor.stop()
+        # sampling thread is restarted by next balance
+        if self._adaptive_threshold is not None:
+            self._adaptive_threshold.stop()
+        with self._lock:
+            if self._persistent:
+                self._checkpoint()
+            for bucket in self._buckets:
+                bucket.close()
+            if self._write_ahead_log is not None:
+                self._write_ahead_log.close()
+
+    @synchronized
     def compact(self):
         """Compact all disk buckets, save disk space and speed up disk data lookup"""
+        self._compact_buckets(self._buckets)
+
+    @synchronized
+    def verify(self):
+        """Check every record of bucket files against its checksum, return dict of
+           bucket index -> (segment, address) of its first torn or corrupt record, which
+           is empty if all records are intact. Corrupt tails left by a crash are truncated when a
+           persistent map is reopened without manifest
+        """
+        corrupt_addresses = {}
+        for index, bucket in enumerate(self._buckets):
+            address = bucket.verify()
+            if address is not None:
+                corrupt_addresses[index] = address
+        return corrupt_addresses
+
+    def _scan(self, with_keys, with_values):
+        """Yield keys, values or (key, value) pairs bucket by bucket without touching
+           eviction policy. In-memory entries come first, then spilled records of the
+           bucket are streamed in file order. Memory overhead is bounded by one bucket
+        """
+        for index in range(len(self._buckets)):
+            # entry position -> number of its records not streamed yet
+            missing_nums = {}
+            # (disk address, entry position, 0 for key or 1 for value)
+            reads = []
+            with self._lock_bucket_at(index):
+                bucket = self._buckets[index]
+                # raw value of BucketObject, either loaded value or DiskAddress
+                snapshot = [
+                    [node.value.key.value, node.value.value.value]
+                    for node in bucket.linked_list
+                ]
+                for position, entry_values in enumerate(snapshot):
+                    for slot, wanted in enumerate((with_keys, with_values)):
+                        if wanted and isinstance(entry_values[slot], DiskAddress):
+                            reads.append((entry_values[slot], position, slot))
+                            missing_nums[position] = missing_nums.get(position, 0) + 1
+                reads.sort(
+                    key=lambda read: (
+                        read[0].segment,
+                        read[0].address,
+                        read[0].index or 0,
+                    )
+                )
+                # file is opened before any compaction could replace it, pinned keys
+                # need no file at all
+                values = ()
+                if reads:
+                    bucket.flush()
+                    values = bucket.stream_values([read[0] for read in reads])
+            for position, entry_values in enumerate(snapshot):
+                if position not in missing_nums:
+                    yield self._scanned(entry_values, with_keys, with_values)
+            for (_, position, slot), value in zip(reads, values):
+                snapshot[position][slot] = value
+                missing_nums[position] -= 1
+                if missing_nums[position] == 0:
+                    del missing_nums[position]
+                    yield self._scanned(snapshot[position], with_keys, with_values)
+
+    def _scanned(self, entry_values, with_keys, with_values):
+        if with_keys and with_values:
+            return tuple(entry_values)
+        return entry_values[0] if with_keys else entry_values[1]
+
+    def _lock_bucket_at(self, index):
+        """Lock guarding bucket at index"""
+        return self._lock
+
+    def _find_entry(self, key):
+        """Return BucketEntry of key without touching eviction policy, None if key
+           doesn't exist. Only keys are loaded
+        """
+        key_hash = self._key_hash(key)
+        if not self._might_contain(key_hash):
+            return None
+        bucket = self._buckets[self._index(key_hash)]
+        for node in bucket.linked_list:
+            bucket_entry = node.value
+            if (
+                bucket_entry.key_hash == key_hash
+                and bucket_entry.key.load_value() == key
+            ):
+                return bucket_entry
+        return None
+
+    def _get_many(self, keys, default):
+        keys = list(keys)
+        values = [default] * len(keys)
+        # key position -> disk entries with the same key hash
+        disk_candidates = {}
+        for position, key in enumerate(keys):
+            key_hash = self._key_hash(key)
+            if not self._might_contain(key_hash):
+                continue
+            bucket = self._buckets[self._index(key_hash)]
+            candidates = []
+            for node in bucket.linked_list:
+                bucket_entry = node.value
+                if bucket_entry.key_hash != key_hash or (
+                    bucket_entry.key.is_in_memory() and bucket_entry.key.value != key
+                ):
+                    continue
+                if not bucket_entry.is_in_memory():
+                    candidates.append(bucket_entry)
+                else:
+                    self._in_memory_objects.access(bucket_entry)
+                    values[position] = bucket_entry.value.value
+                    break
+            else:
+                if candidates:
+                    disk_candidates[position] = candidates
+        # key and value records of an entry are adjacent, read them in the same sweep
+        loaded_values = self._load_in_file_order(
+            bucket_object
+            for candidates in disk_candidates.values()
+            for bucket_entry in candidates
+            for bucket_object in (bucket_entry.key, bucket_entry.value)
+        )
+        hits = []
+        for position, candidates in disk_candidates.items():
+            for bucket_entry in candidates:
+                if loaded_values[bucket_entry.key] == keys[position]:
+                    values[position] = loaded_values[bucket_entry.value]
+                    self._in_memory_objects.miss(bucket_entry)
+                    self._disk_objects.move_to_end(bucket_entry.lru_node)
+                    hits.append(bucket_entry)
+                    break
+        # hits are the first entries balance would load, promote them with values
+        # already read instead of reading their records again
+        for bucket_entry in reversed(hits):
+            if self._memory_usage() >= self._low_watermark():
+                break
+            if bucket_entry.is_in_memory():
+                continue
+            self._disk_objects.remove(bucket_entry.lru_node)
+            for bucket_object in (bucket_entry.key, bucket_entry.value):
+                self._load_object(bucket_object, loaded_values)
+            self._in_memory_objects.add(bucket_entry, hot=False)
+        return values
+
+    def _set_many(self, items, loaded_keys=None):
+        """Keys of disk entries are read unless loaded_keys maps them already, key
+           bucket object -> key
+        """
+        # the last value of a duplicated key wins
+        items = dict(items)
+        # (key, key hash, bucket, value, disk entries with the same key hash)
+        pending_items = []
+        for key, value in items.items():
+            key_hash = self._key_hash(key)
+            bucket = self._buckets[self._index(key_hash)]
+            candidates = []
+            nodes = bucket.linked_list if self._might_contain(key_hash) else ()
+            for node in nodes:
+                bucket_entry = node.value
+                if bucket_entry.key_hash != key_hash:
+                    continue
+                if not bucket_entry.is_in_memory():
+                    candidates.append(bucket_entry)
+                elif bucket_entry.key.value == key:
+                    self._release(bucket_entry.value)
+                    self._in_memory_objects.replace_value(bucket_entry, value)
+                    break
+            else:
+                pending_items.append((key, key_hash, bucket, value, candidates))
+        if loaded_keys is None:
+            loaded_keys = self._load_in_file_order(
+                bucket_entry.key
+                for _, _, _, _, candidates in pending_items
+                for bucket_entry in candidates
+            )
+        for key, key_hash, bucket, value, candidates in pending_items:
+            for bucket_entry in candidates:
+                if loaded_keys[bucket_entry.key] == key:
+                    self._replace_disk_entry(
+                        bucket_entry, loaded_keys[bucket_entry.key], value
+                    )
+                    break
+            else:
+                self._append_entry(bucket, key_hash, key, value)
+
+    def _load_in_file_order(self, bucket_objects):
+        """Load disk objects bucket by bucket, records of a bucket are read in file
+           order. Return dict of bucket object -> loaded value, in-memory objects such as
+           pinned keys are mapped to their own value
+        """
+        loaded_values = {}
+        # bucket -> its disk objects, dict keeps them unique and ordered
+        bucket_objects_per_bucket = {}
+        for bucket_object in bucket_objects:
+            if bucket_object.is_in_memory():
+                loaded_values[bucket_object] = bucket_object.value
+                continue
+            bucket_objects_per_bucket.setdefault(bucket_object.bucket, {})[
+                bucket_object
+            ] = None
+        for bucket, bucket_object_dict in bucket_objects_per_bucket.items():
+            disk_objects = list(bucket_object_dict)
+            loaded_values.update(
+                zip(
+                    disk_objects,
+                    bucket.load_values(
+                        [bucket_object.value for bucket_object in disk_objects]
+                    ),
+                )
+            )
+        return loaded_values
+
+    def _append_entry(self, bucket, key_hash, key, value):
+        bucket_entry = BucketEntry(
+            key_hash, BucketObject(key, bucket), BucketObject(value, bucket)
+        )
+        bucket.linked_list.append(DoublyLinkedList.create_new_node(bucket_entry))
+        self._in_memory_objects.add(bucket_entry)
+        self._remember_key(key_hash)
+
+    def _replace_disk_entry(self, bucket_entry, key, value):
+        """Entry is loaded into memory as a whole with its new value"""
+        self._disk_objects.remove(bucket_entry.lru_node)
+        self._release(bucket_entry.key)
+        self._release(bucket_entry.value)
+        bucket_entry.key.value = key
+        bucket_entry.value.value = value
+        bucket_entry.value.size = None
+        self._in_memory_objects.add(bucket_entry)
 
-        # create a collection list for each bucket
-        bucket_to_list_node_dict = {}
-        # we need to ensure all buckets should have a collection list
+    def _compact_buckets(self, buckets, garbage_ratio=None):
+        """Compact buckets, then save them by checkpoints. Map is recoverable from its
+           bucket files at any point of it
+        """
+        if self._write_ahead_log is not None and self._segment_size is None:
+            # manifest is dropped while files are swapped, a scan must find checkpoints
+            # of the same moment in all bucket files, then log is replayed on top
+            self._checkpoint()
+        elif self._unsaved_buckets:
+            # a scan would find moved entries in both or neither of split buckets
+            self._save_checkpoints([])
+        for bucket in buckets:
+            self._compact_bucket(bucket, garbage_ratio)
+        if self._persistent and self._segment_size is None:
+            # swapped files carry their checkpoints already
+            self._save_checkpoints([])
+        else:
+            self._checkpoint_rewritten(buckets)
+
+    def _compact_bucket(self, bucket, garbage_ratio=None):
+        """Rewrite bucket file with live records only, every disk object lives in the
+           bucket file of its own bucket linked list. Segmented bucket only compacts
+           sealed segments whose garbage reaches garbage_ratio, all of them if it's None
+        """
+        if self._segment_size is not None:
+            self._compact_segments(bucket, garbage_ratio)
+            return
+        # disk objects and loaded objects with clean disk copies
+        disk_objects = self._disk_objects_of(bucket)
+        # copy records to a tmp bucket, compressed records and blocks are rebuilt
+        tmp_bucket = self._create_bucket(bucket.filepath + ".tmp")
+        tmp_addresses = [
+            tmp_bucket.append_record(*self._record_chunks(bucket_object))
+            for bucket_object in disk_objects
+        ]
+        # update disk address, object's hash doesn't depend on it. Objects aren't read
+        # before swap, bucket is locked
+        for bucket_object, address in zip(disk_objects, tmp_addresses):
+            if bucket_object.is_in_memory():
+                bucket_object.disk_address = address
+            else:
+                bucket_object.value = address
+        if self._persistent:
+            # swapped file carries its checkpoint, so that a crash right after swap
+            # still recovers bucket. Manifest points to old file, it's dropped first
+            bucket_indexes = {
+                bucket: index for index, bucket in enumerate(self._buckets)
+            }
+            tmp_bucket.flush_block()
+            tmp_bucket.persist_checkpoint(
+                self._bucket_checkpoint(bucket, bucket_indexes)
+            )
+            if self._durability != "none":
+                tmp_bucket.sync()
+            self._drop_manifest()
+        # swap files in physical disk, bucket's offset is updated as well
+        bucket.swap(tmp_bucket)
+        if self._persistent and self._durability != "none":
+            self._sync_directory()
+
+    def _compact_segments(self, bucket, garbage_ratio):
+        """Append live records of compacted segments to active segment, then retire
+           them. They are dropped once a checkpoint no longer refers to them
+        """
+        if garbage_ratio is None:
+            # records of active segment are compacted as well
+            bucket.seal()
+        segments = set(
+            bucket.compactable_segments(0.0 if garbage_ratio is None else garbage_ratio)
+        )
+        if not segments:
+            return
+        disk_objects = [
+            bucket_object
+            for bucket_object in self._disk_objects_of(bucket)
+            if bucket_object.record_address().segment in segments
+        ]
+        # old segments are read in file order
+        disk_objects.sort(
+            key=lambda bucket_object: (
+                bucket_object.record_address().segment,
+                bucket_object.record_address().address,
+                bucket_object.record_address().index or 0,
+            )
+        )
+        addresses = [
+            bucket.append_record(*self._record_chunks(bucket_object))
+            for bucket_object in disk_objects
+        ]
+        bucket.retire_segments(segments)
+        for bucket_object, address in zip(disk_objects, addresses):
+            if bucket_object.is_in_memory():
+                bucket_object.disk_address = address
+            else:
+                bucket_object.value = address
+
+    def _disk_objects_of(self, bucket):
+        """Return disk objects and loaded objects with clean disk copies of bucket"""
+        disk_objects = []
+        for node in bucket.linked_list:
+            bucket_entry = node.value
+            for bucket_object in (bucket_entry.key, bucket_entry.value):
+                if bucket_object.record_address() is not None:
+                    assert bucket_object.bucket is bucket
+                    disk_objects.append(bucket_object)
+        return disk_objects
+
+    def _compact_garbage(self):
+        """Compact the bucket with the highest garbage ratio, it's called by background
+           compactor. Return False if no bucket crosses compaction garbage ratio
+        """
+        with self._lock:
+            bucket = max(self._buckets, key=lambda bucket: bucket.garbage_ratio)
+            if (
+                bucket.garbage_size == 0
+                or bucket.garbage_ratio < self._compaction_garbage_ratio
+            ):
+                return False
+            self._compact_buckets([bucket], self._compaction_garbage_ratio)
+            return True
+
+    def _release(self, bucket_object):
+        """Record of bucket_object is dead, either the one it's spilled to or the disk
+           copy of its loaded value. Wake compactor once bucket is worth it
+        """
+        disk_address = bucket_object.record_address()
+        # dirty value or pinned key has no record
+        if disk_address is None:
+            return
+        bucket_object.disk_address = None
+        bucket = bucket_object.bucket
+        bucket.release(disk_address)
+        self._wake_compactor(bucket)
+
+    def _wake_compactor(self, bucket):
+        if (
+            self._compactor is not None
+            and bucket.garbage_ratio >= self._compaction_garbage_ratio
+        ):
+            self._compactor.wake()
+
+    def _split(self):
+        """Linear hashing, split the bucket at split index into itself and a new bucket
+           at the end. Only the split bucket's file of a non-persistent map is
+           rewritten
+        """
+        bucket = self._buckets[self._split_index]
+        new_bucket = self._create_bucket(self._bucket_filepath(len(self._buckets)))
+        self._buckets.append(new_bucket)
+        # a round finishes once all buckets at the beginning of it have been split
+        self._split_index += 1
+        if self._split_index == self._bucket_num:
+            self._bucket_num <<= 1
+            self._split_index = 0
+        has_moved_disk_object = False
+        for node in list(bucket.linked_list):
+            bucket_entry = node.value
+            if self._buckets[self._index(bucket_entry.key_hash)] is new_bucket:
+                bucket.linked_list.remove(node)
+                new_bucket.linked_list.append(node)
+                for bucket_object in (bucket_entry.key, bucket_entry.value):
+                    has_moved_disk_object |= not bucket_object.is_in_memory()
+                    self._move_bucket_object(bucket_object, new_bucket)
+        # moved entries must be saved by checkpoints of both buckets at once, otherwise
+        # a crash could leave them in neither or both of them. It's deferred to the next
+        # checkpoint, manifest stays valid meanwhile since split bucket keeps records
+        # of moved objects. Logged updates are replayed on top of manifest anyway
+        if self._persistent and self._write_ahead_log is None:
+            self._unsaved_buckets.update((bucket, new_bucket))
+        # drop records of moved objects from split bucket. Persistent map leaves them
+        # to compactor, same as records of segmented buckets
+        if (
+            has_moved_disk_object
+            and not self._persistent
+            and self._segment_size is None
+        ):
+            self._compact_buckets([bucket])
+
+    def _is_overloaded(self):
+        if self._max_load_factor is None:
+            return False
+        else:
+            return len(self) > self._max_load_factor * len(self._buckets)
+
+    def _move_bucket_object(self, bucket_object, target_bucket):
+        """Let bucket_object belong to target_bucket, copy its record if it's on disk"""
+        if bucket_object.bucket is target_bucket:
+            return
+        if not bucket_object.is_in_memory():
+            disk_address = target_bucket.append_record(
+                *self._record_chunks(bucket_object)
+            )
+            self._release(bucket_object)
+            bucket_object.value = disk_address
+        else:
+            # disk copy stays behind, value is written again on next eviction
+            self._release(bucket_object)
+        bucket_object.bucket = target_bucket
+
+    def _record_chunks(self, bucket_object):
+        """Return codec tag and chunks of a disk object, ready to be appended again"""
+        tag, data = bucket_object.bucket.read_record(bucket_object.record_address())
+        return tag, [data]
+
+    def _checkpoint(self):
+        """Append a checkpoint record to every bucket, then write a manifest pointing to
+           them. Bucket files are append-only between checkpoints, so the manifest stays
+           valid until next clear or compaction, both of them write a new one
+        """
+        self._persist_checkpoints(self._buckets)
+        for bucket in self._buckets:
+            bucket.close()
+        self._write_manifest()
+        self._unsaved_buckets = set()
+        # logged updates are saved by manifest now
+        if self._write_ahead_log is not None:
+            self._write_ahead_log.reset()
+
+    def _persist_checkpoints(self, buckets):
+        """Append checkpoint records to buckets, they are on disk once it returns"""
+        # pending blocks are written first, so that references carry record sizes
         for bucket in self._buckets:
-            bucket_to_list_node_dict[bucket] = []
-        for node in self._disk_objects:
-            bucket_object = node.value
-            assert not bucket_object.is_in_memory()
-            bucket_to_list_node_dict[bucket_object.bucket].append(node)
-        # bucket by bucket processing
-        for bucket, node_list in bucket_to_list_node_dict.items():
-            with open(bucket.filepath, "rb") as source_file:
-                tmp_filepath = bucket.filepath + ".tmp"
-                tmp_offset, tmp_addresses = 0, []
-                with open(tmp_filepath, "wb") as target_file:
-                    # copy bytes from filepath to tmp_filepath
-                    for node in node_list:
-                        bucket_object = node.value
-                        source_file.seek(bucket_object.value.address)
-                        header = source_file.read(4)
-                        data_length = self._byte_array_to_integer(header)
-                        data = source_file.read(data_length)
-                        target_file.write(header + data)
-                        tmp_addresses.append(tmp_offset)
-                        tmp_offset += len(header + data)
-                # swap files in physical disk
-                os.rename(tmp_filepath, bucket.filepath)
-                # remove all bucket_object from object_to_list_node dict
-                for node in node_list:
-                    self._object_to_list_node.pop(node.value)
-                # update disk address and object_to_list_node dict
-                for node, address in zip(node_list, tmp_addresses):
-                    bucket_object = node.value
-                    bucket_object.value.address = address
-                    self._object_to_list_node[bucket_object] = node
-                # update bucket's offset, very important in compaction
-                bucket._offset = tmp_offset
+            bucket.flush_block()
+        bucket_indexes = {bucket: index for index, bucket in enumerate(self._buckets)}
+        for bucket in buckets:
+            bucket.persist_checkpoint(self._bucket_checkpoint(bucket, bucket_indexes))
+        # flush checkpoints before manifest becomes visible
+        for bucket in self._buckets:
+            if self._durability != "none" and bucket in buckets:
+                bucket.sync()
+            else:
+                bucket.flush_block()
+                bucket.flush()
+
+    def _write_manifest(self):
+        """Replace manifest atomically, it points to the latest checkpoint of every
+           bucket
+        """
+        manifest = {
+            "bucket_num": len(self._buckets),
+            "offsets": [bucket._offset for bucket in self._buckets],
+            # active segments which offsets belong to
+            "segments": [bucket._segment for bucket in self._buckets],
+            "checkpoints": [
+                (
+                    disk_address.address,
+                    disk_address.index,
+                    disk_address.size,
+                    disk_address.segment,
+                )
+                for disk_address in (
+                    bucket.checkpoint_address for bucket in self._buckets
+                )
+            ],
+        }
+        manifest_path = os.path.join(self._work_dir, self.MANIFEST_FILENAME)
+        with open(manifest_path + ".tmp", "wb") as f:
+            pickle.dump(manifest, f)
+            if self._durability != "none":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(manifest_path + ".tmp", manifest_path)
+        if self._durability != "none":
+            self._sync_directory()
+
+    def _checkpoint_rewritten(self, buckets):
+        """Buckets files are rewritten or entries are moved between them, save them by
+           new checkpoints. Checkpoints of other buckets are still valid, no entry has
+           left them since. Retired segments of buckets are dropped afterwards
+        """
+        if self._write_ahead_log is not None:
+            # log is replayed on top of manifest, a full checkpoint resets it
+            self._checkpoint()
+        elif self._persistent:
+            self._save_checkpoints(buckets)
+        for bucket in buckets:
+            bucket.drop_retired_segments()
+
+    def _save_checkpoints(self, buckets):
+        """Append checkpoints to buckets, to buckets which have none and to buckets
+           changed by splits, then write a manifest. Checkpoints must be on disk before
+           segments they replace are dropped
+        """
+        self._persist_checkpoints(
+            [
+                bucket
+                for bucket in self._buckets
+                if bucket in buckets
+                or bucket in self._unsaved_buckets
+                or bucket.checkpoint_address is None
+            ]
+        )
+        self._write_manifest()
+        self._unsaved_buckets = set()
+
+    def _drop_manifest(self):
+        """Remove manifest once it no longer matches bucket files, reopen falls back to
+           scan latest checkpoints of them
+        """
+        manifest_path = os.path.join(self._work_dir, self.MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+            if self._durability != "none":
+                self._sync_directory()
+
+    def _bucket_checkpoint(self, bucket, bucket_indexes):
+        entries = []
+        for node in bucket.linked_list:
+            bucket_entry = node.value
+            entries.append(
+                (
+                    bucket_entry.key_hash,
+                    self._reference(bucket_entry.key, bucket_indexes),
+                    self._reference(bucket_entry.value, bucket_indexes),
+                )
+            )
+        return BucketCheckpoint(entries, self._key_hash(self.HASH_PROBE))
+
+    @synchronized
+    def _restore(self, manifest):
+        """Rebuild bucket linked lists and LRU lists from checkpoints of existing bucket
+           files, fallback to scan them for latest checkpoints if manifest is missing
+        """
+        if manifest is None:
+            # a crash could leave torn records at the tails, new records must not
+            # follow them, otherwise scan would never reach new records
+            for bucket in self._buckets:
+                bucket.verify(truncate=True)
+        for bucket, checkpoint_address in zip(
+            self._buckets,
+            manifest["checkpoints"] if manifest else [None] * len(self._buckets),
+        ):
+            if checkpoint_address is None:
+                checkpoint = self._recover_checkpoint(bucket)
+            else:
+                checkpoint = bucket.load_checkpoint(DiskAddress(*checkpoint_address))
+            if checkpoint is None:
+                continue
+            # checkpoints written by builtin hash, which is randomized per process for
+            # strings, need their keys rehashed
+            stable_hash = checkpoint.hash_probe == self._key_hash(self.HASH_PROBE)
+            for key_hash, key_reference, value_reference in checkpoint.entries:
+                bucket_object_key, bucket_object_value = (
+                    self._dereference(key_reference, bucket),
+                    self._dereference(value_reference, bucket),
+                )
+                if not stable_hash:
+                    key_hash = self._key_hash(bucket_object_key.load_value())
+                target_bucket = self._buckets[self._index(key_hash)]
+                # rehashed objects should live in their new bucket
+                self._move_bucket_object(bucket_object_key, target_bucket)
+                self._move_bucket_object(bucket_object_value, target_bucket)
+                # checkpoint could be written without key directory mode
+                if self._pin_keys and not bucket_object_key.is_in_memory():
+                    key = bucket_object_key.load_value()
+                    self._release(bucket_object_key)
+                    bucket_object_key.value = key
+                bucket_entry = BucketEntry(
+                    key_hash, bucket_object_key, bucket_object_value
+                )
+                target_bucket.linked_list.append(
+                    DoublyLinkedList.create_new_node(bucket_entry)
+                )
+                if bucket_entry.is_in_memory():
+                    self._in_memory_objects.add(bucket_entry)
+                else:
+                    self._disk_objects.append(bucket_entry.lru_node)
+                self._remember_key(key_hash)
+
+    def _replay_log(self):
+        """Apply updates logged since the last full checkpoint, then save them by a new
+           checkpoint and drop the log
+        """
+        log_filepath = self._log_filepath()
+        if not os.path.exists(log_filepath):
+            return
+        write_ahead_log = WriteAheadLog(log_filepath)
+        records = write_ahead_log.records()
+        write_ahead_log.close()
+        for record in records:
+            if record[0] == _SET:
+                self[record[1]] = record[2]
+            elif record[0] == _DELETE:
+                # delete is logged before it's applied, key could be missing
+                try:
+                    del self[record[1]]
+                except KeyError:
+                    pass
+            else:
+                self.set_many(record[1])
+        if records:
+            with self._lock:
+                self._checkpoint()
+        os.remove(log_filepath)
+
+    def _append_log(self, record):
+        """Log an update ahead of applying it, return its sequence number, None if
+           updates are not logged
+        """
+        if self._write_ahead_log is None:
+            return None
+        return self._write_ahead_log.append(record)
+
+    def _commit_log(self, sequence):
+        """Wait until logged update is durable if every update should be"""
+        if sequence is not None:
+            self._write_ahead_log.commit(sequence)
+
+    def _checkpoint_full_log(self):
+        """Save logged updates by a full checkpoint once log exceeds max log size, so
+           that log and its replay on reopen stay bounded. Map should be unlocked
+        """
+        if (
+            self._write_ahead_log is None
+            or self._max_log_size is None
+            or self._write_ahead_log.size < self._max_log_size
+        ):
+            return
+        with self._lock:
+            # another writer could have reset it meanwhile
+            if self._write_ahead_log.size >= self._max_log_size:
+                self._checkpoint()
+
+    def _sync_directory(self):
+        """Fsync work_dir, so that created and replaced files survive a crash"""
+        fd = os.open(self._work_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _recover_checkpoint(self, bucket):
+        """Find the latest checkpoint record in bucket file, usually the last record"""
+        for disk_address in reversed(list(bucket.record_addresses())):
+            try:
+                record = bucket.load_value(disk_address)
+            except Exception:
+                continue
+            if isinstance(record, BucketCheckpoint):
+                return bucket.load_checkpoint(disk_address)
+        return None
+
+    def _reference(self, bucket_object, bucket_indexes):
+        if bucket_object.is_in_memory():
+            return True, bucket_object.value
+        else:
+            return (
+                False,
+                (
+                    bucket_indexes[bucket_object.bucket],
+                    bucket_object.value.address,
+                    bucket_object.value.index,
+                    bucket_object.value.size,
+                    bucket_object.value.segment,
+                ),
+            )
+
+    def _dereference(self, reference, bucket):
+        is_in_memory, payload = reference
+        if is_in_memory:
+            return BucketObject(payload, bucket)
+        else:
+            # references written before segments carry no segment
+            bucket_index, address_fields = payload[0], payload[1:]
+            bucket = self._buckets[bucket_index]
+            disk_address = DiskAddress(*address_fields)
+            # record is referenced again, it's no longer garbage
+            bucket.retain(disk_address)
+            return BucketObject(disk_address, bucket)
+
+    def _read_manifest(self):
+        """Return manifest dict, None if it's missing or doesn't match bucket files"""
+        manifest_path = os.path.join(self._work_dir, self.MANIFEST_FILENAME)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, "rb") as f:
+                manifest = pickle.load(f)
+        except Exception:
+            return None
+        # manifest written before segments has offsets of segment 0
+        segments = manifest.get("segments", [0] * len(manifest["offsets"]))
+        for index, (segment, offset) in enumerate(zip(segments, manifest["offsets"])):
+            filepath = segment_filepath(self._bucket_filepath(index), segment)
+            if not os.path.exists(filepath) or os.path.getsize(filepath) < offset:
+                return None
+        return manifest
+
+    def _existing_bucket_num(self):
+        bucket_num = 0
+        while os.path.exists(self._bucket_filepath(bucket_num)):
+            bucket_num += 1
+        return bucket_num
+
+    def _create_lock(self):
+        return threading.RLock()
+
+    def _create_bucket(self, filepath, truncate=True, segments=None):
+        return Bucket(
+            filepath,
+            file_handle_pool=self._file_handle_pool,
+            use_mmap=self._use_mmap,
+            truncate=truncate,
+            codec_registry=self._codec_registry,
+            compression=self._compression,
+            compression_threshold=self._compression_threshold,
+            block_size=self._compression_block_size,
+            positional_io=self.POSITIONAL_IO,
+            segment_size=self._segment_size,
+            segments=segments,
+        )
+
+    def _log_filepath(self):
+        return os.path.abspath(os.path.join(self._work_dir, self.LOG_FILENAME))
+
+    def _bucket_filepath(self, index):
+        return os.path.abspath(
+            os.path.join(self._work_dir, "bucket_{}.txt".format(index))
+        )
 
     def _balance(self):
         """Maintain a sliding windows, ensure memory usage is under threshold"""
+        self._sample_memory_pressure()
 
-        # first try to load disk object to memory
+        # first try to load disk entry to memory
         while (
-            self._in_memory_objects.memory_usage < self._memory_threshold
-            and len(self._disk_objects) > 0
+            self._memory_usage() < self._low_watermark() and len(self._disk_objects) > 0
         ):
             node = self._disk_objects.pop_last()
-            bucket_object = node.value
-            # remove object from inverted dict
-            self._object_to_list_node.pop(bucket_object)
-            # load object from memory
-            bucket_object.value = bucket_object.load_value()
-            self._object_to_list_node[bucket_object] = node
-            self._in_memory_objects.add_first(node)
-        # then persist extra objects to disk based on LRU rule
-        while self._in_memory_objects.memory_usage > self._memory_threshold:
-            node = self._in_memory_objects.pop_first()
-            bucket_object = node.value
-            # remove object from inverted dict
-            self._object_to_list_node.pop(bucket_object)
-            # persist object to disk, update bucket_object's value
-            disk_value = bucket_object.bucket.persist_value(bucket_object.value)
-            bucket_object.value = disk_value
-            self._object_to_list_node[bucket_object] = node
-            self._disk_objects.append(node)
+            bucket_entry = node.value
+            for bucket_object in (bucket_entry.key, bucket_entry.value):
+                self._load_object(bucket_object)
+            self._in_memory_objects.add(bucket_entry, hot=False)
+        # then persist extra entries to disk, eviction policy picks the victims
+        if self._memory_budget is not None:
+            self._memory_budget.balance(self)
+        elif self._in_memory_objects.memory_usage > self._memory_threshold:
+            self._spill_victims(self._low_watermark())
+
+    def _sample_memory_pressure(self):
+        if self._adaptive_threshold is not None:
+            self._adaptive_threshold.start()
+
+    def _adapt_threshold(self):
+        """Called by sampling thread of adaptive threshold, entries are spilled at once
+           if threshold shrinks below memory usage
+        """
+        self._memory_threshold = self._adaptive_threshold.update(
+            self._in_memory_objects.memory_usage
+        )
+        if self._in_memory_objects.memory_usage > self._memory_threshold:
+            self._rebalance()
+
+    @synchronized
+    def _rebalance(self):
+        self._balance()
+
+    def _spill_victims(self, memory_floor, until_tick=None):
+        """Spill victims in a batch until memory usage drops to floor, or until next
+           victim was accessed after until_tick. Return freed bytes
+        """
+        memory_usage = self._in_memory_objects.memory_usage
+        bucket_entries = []
+        while self._in_memory_objects.memory_usage > memory_floor:
+            bucket_entry = self._in_memory_objects.victim()
+            if (
+                until_tick is not None
+                and len(bucket_entries) > 0
+                and bucket_entry.access_tick > until_tick
+            ):
+                break
+            self._in_memory_objects.evict(bucket_entry)
+            bucket_entries.append(bucket_entry)
+        self._spill_entries(bucket_entries)
+        for bucket_entry in bucket_entries:
+            self._disk_objects.append(bucket_entry.lru_node)
+        return memory_usage - self._in_memory_objects.memory_usage
+
+    def _victim_tick(self, blocking=True):
+        """Access tick of next victim, it's compared with other maps sharing memory
+           budget. `None` if nothing is in memory or map is busy
+        """
+        if not self._lock.acquire(blocking):
+            return None
+        try:
+            if len(self._in_memory_objects) == 0:
+                return None
+            return self._in_memory_objects.victim().access_tick
+        finally:
+            self._lock.release()
+
+    def _spill_coldest(self, memory_floor, until_tick, blocking=True):
+        """Spill victims on behalf of memory budget, return freed bytes, `0` if map is
+           busy
+        """
+        if not self._lock.acquire(blocking):
+            return 0
+        try:
+            return self._spill_victims(memory_floor, until_tick)
+        finally:
+            self._lock.release()
+
+    def _load_object(self, bucket_object, loaded_values=None):
+        """Load value of a disk object, its record is kept as a clean disk copy. Value
+           is taken from loaded_values if it was read already. Pinned key is already in
+           memory
+        """
+        if not bucket_object.is_in_memory():
+            disk_address = bucket_object.value
+            if loaded_values is not None:
+                bucket_object.value = loaded_values[bucket_object]
+            else:
+                bucket_object.value = bucket_object.bucket.load_value(disk_address)
+            bucket_object.disk_address = disk_address
+
+    def _spill_entries(self, bucket_entries):
+        """Write evicted entries to disk, dirty objects are grouped per bucket and each
+           group is written at once. Clean objects go back to their disk copies
+        """
+        # bucket -> its dirty objects in eviction order
+        dirty_objects = {}
+        for bucket_entry in bucket_entries:
+            for bucket_object in self._spilled_objects(bucket_entry):
+                if bucket_object.is_dirty():
+                    dirty_objects.setdefault(bucket_object.bucket, []).append(
+                        bucket_object
+                    )
+                else:
+                    bucket_object.value = bucket_object.disk_address
+                    bucket_object.disk_address = None
+        for bucket, bucket_objects in dirty_objects.items():
+            disk_addresses = bucket.persist_values(
+                [bucket_object.value for bucket_object in bucket_objects]
+            )
+            for bucket_object, disk_address in zip(bucket_objects, disk_addresses):
+                bucket_object.value = disk_address
+
+    def _spilled_objects(self, bucket_entry):
+        """Objects written to disk once entry is evicted"""
+        if self._pin_keys:
+            return (bucket_entry.value,)
+        return bucket_entry.key, bucket_entry.value
+
+    def _might_contain(self, key_hash):
+        """False means key of hash surely doesn't exist"""
+        return self._key_filter is None or self._key_filter.might_contain(key_hash)
+
+    def _remember_key(self, key_hash):
+        if self._key_filter is not None:
+            self._key_filter.add(key_hash)
+
+    def _forget_key(self, bucket, key_hash):
+        """Key is removed from bucket, filter forgets its hash unless another key of
+           the same hash is left
+        """
+        if self._key_filter is not None and all(
+            node.value.key_hash != key_hash for node in bucket.linked_list
+        ):
+            self._key_filter.remove(key_hash)
+
+    def _memory_usage(self):
+        """Memory usage compared with watermarks, it's aggregated over maps sharing
+           memory budget
+        """
+        if self._memory_budget is not None:
+            return self._memory_budget.memory_usage
+        return self._in_memory_objects.memory_usage
+
+    def _high_watermark(self):
+        if self._memory_budget is not None:
+            return self._memory_budget.memory_threshold
+        return self._memory_threshold
+
+    def _low_watermark(self):
+        if self._memory_budget is not None:
+            return self._memory_budget.low_watermark
+        return self._memory_threshold * self._low_watermark_ratio
 
     def _power_of_two_ceiling(self, number):
         ans = 1
@@ -234,12 +1340,20 @@ class DiskBasedHashMap(MutableMapping):
             ans <<= 1
         return ans
 
-    def _byte_array_to_integer(self, byte_array):
-        ans = 0
-        for b in byte_array:
-            ans = (ans << 8) + int(b)
-        return ans
-
-    def _index(self, obj):
+    def _index(self, key_hash):
         """since bucket_num is power of two, bit operation could benefit us here"""
-        return hash(obj) & (self._bucket_num - 1)
+        index = key_hash & (self._bucket_num - 1)
+        # bucket has been split in current round, one more bit is needed
+        if index < self._split_index:
+            index = key_hash & ((self._bucket_num << 1) - 1)
+        return index
+
+
+class _StreamingValuesView(ValuesView):
+    def __iter__(self):
+        return self._mapping._scan(False, True)
+
+
+class _StreamingItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping._scan(True, True)
@@ -7,12 +7,14 @@ class DoublyLinkedList(object):
 
     class LinkedListNode(object):
 
-        __slots__ = ("prev", "next", "value")
+        __slots__ = ("prev", "next", "value", "owner")
 
         def __init__(self, value, prev=None, next=None):
             self.prev = prev
             self.next = next
             self.value = value
+            # linked list which node belongs to, membership test is O(1) without hashing
+            self.owner = None
 
         def __str__(self):
             return "(value: {})".format(str(self.value))
@@ -20,8 +22,7 @@ class DoublyLinkedList(object):
     def __init__(self):
         self._head = self.LinkedListNode(None)
         self._tail = self._head
-        # avoid duplication and incorrect update
-        self._node_set = set()
+        self._size = 0
 
     def __iter__(self):
         node = self._head
@@ -30,7 +31,7 @@ class DoublyLinkedList(object):
             node = node.next
 
     def __len__(self):
-        return len(self._node_set)
+        return self._size
 
     def __str__(self):
         return str(list(map(str, self)))
@@ -57,6 +58,15 @@ class DoublyLinkedList(object):
         else:
             return False
 
+    def move_to_end(self, list_node):
+        """Move list_node to the tail in O(1), remove and insert hooks are bypassed"""
+        if list_node.owner is not self:
+            return False
+        if list_node is not self._tail:
+            self._unlink(list_node)
+            self._link_after(self._tail, list_node)
+        return True
+
     def pop_first(self):
         list_node = self._head.next
         self.remove(list_node)
@@ -80,36 +90,46 @@ class DoublyLinkedList(object):
             return self._tail
 
     def clear(self):
+        for list_node in self:
+            list_node.owner = None
         self._head = self.LinkedListNode(None)
         self._tail = self._head
-        self._node_set.clear()
+        self._size = 0
 
     def remove(self, list_node):
         """remove list_node from linked list"""
-        if list_node not in self._node_set:
+        if list_node is None or list_node.owner is not self:
             return False
         else:
-            assert isinstance(list_node, DoublyLinkedList.LinkedListNode)
-            if list_node == self._tail:
-                self._tail = self._tail.prev
-                self._tail.next = None
-            else:
-                list_node.prev.next = list_node.next
-                list_node.next.prev = list_node.prev
-            self._node_set.remove(list_node)
+            self._unlink(list_node)
+            list_node.owner = None
+            self._size -= 1
             return True
 
     def _insert_after(self, target_node, list_node):
-        if list_node in self._node_set:
+        # node could only belong to one linked list at the same time
+        if list_node.owner is not None:
             return False
         else:
             assert isinstance(list_node, DoublyLinkedList.LinkedListNode)
-            list_node.next = target_node.next
-            list_node.prev = target_node
-            list_node.prev.next = list_node
-            if list_node.next:
-                list_node.next.prev = list_node
-            else:
-                self._tail = list_node
-            self._node_set.add(list_node)
+            self._link_after(target_node, list_node)
+            list_node.owner = self
+            self._size += 1
             return True
+
+    def _unlink(self, list_node):
+        if list_node is self._tail:
+            self._tail = self._tail.prev
+            self._tail.next = None
+        else:
+            list_node.prev.next = list_node.next
+            list_node.next.prev = list_node.prev
+
+    def _link_after(self, target_node, list_node):
+        list_node.next = target_node.next
+        list_node.prev = target_node
+        list_node.prev.next = list_node
+        if list_node.next:
+            list_node.next.prev = list_node
+        else:
+            self._tail = list_node
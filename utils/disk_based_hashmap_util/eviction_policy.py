@@ -0,0 +1,389 @@
+from collections import OrderedDict
+
+from doubly_linkedlist import DoublyLinkedList
+from sizer import resolve_sizer
+
+
+class EvictionPolicy(object):
+    """Decide which in-memory BucketEntry is spilled next, and monitor memory usage of
+       all in-memory entries. Subclass only need to maintain its own ordering through
+       hooks, key and value sizes are cached on BucketObject
+
+       `add` an entry once it's loaded into memory, `access` it on every in-memory hit,
+       `miss` it on every access while it's on disk, `victim` picks next entry to spill,
+       `evict` it right before it's spilled, `remove` it once it's deleted from map
+
+       With a clock, entries are stamped with a tick on every use, so that victims of
+       several maps sharing a memory budget could be compared
+    """
+
+    def __init__(self, sizer=None):
+        self._sizer = resolve_sizer(sizer)
+        self._total_memory_usage = 0
+        self._size = 0
+        # hit and miss counters, used to compare policies on real traces
+        self.hits = 0
+        self.misses = 0
+        # global access counter set by MemoryBudget, `None` means entries aren't stamped
+        self.clock = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def memory_usage(self):
+        return self._total_memory_usage
+
+    def add(self, entry, hot=True):
+        """Track a newly in-memory entry, entry reloaded from disk by balance is not hot"""
+        # size is cached on object, it's computed once per value
+        for bucket_object in (entry.key, entry.value):
+            if bucket_object.size is None:
+                bucket_object.size = self._sizer(bucket_object.value)
+            self._total_memory_usage += bucket_object.size
+        self._size += 1
+        # reloaded entry keeps tick of its last use
+        if hot:
+            self._stamp(entry)
+        self._add(entry, hot)
+
+    def access(self, entry):
+        self.hits += 1
+        self._stamp(entry)
+        self._access(entry)
+
+    def miss(self, entry):
+        self.misses += 1
+        self._stamp(entry)
+        self._miss(entry)
+
+    def replace_value(self, entry, value):
+        """Update value of an in-memory entry, it counts as an access but not a hit"""
+        self._total_memory_usage -= entry.value.size
+        entry.value.value = value
+        entry.value.size = self._sizer(value)
+        self._total_memory_usage += entry.value.size
+        self._stamp(entry)
+        self._access(entry)
+
+    def victim(self):
+        return self._victim()
+
+    def evict(self, entry):
+        self._evict(entry)
+        self._discard(entry)
+
+    def remove(self, entry):
+        if entry.is_in_memory():
+            self._discard(entry)
+        self._forget(entry)
+
+    def clear(self):
+        self._total_memory_usage = 0
+        self._size = 0
+        self._clear()
+
+    def _stamp(self, entry):
+        if self.clock is not None:
+            entry.access_tick = next(self.clock)
+
+    def _discard(self, entry):
+        self._total_memory_usage -= entry.key.size + entry.value.size
+        self._size -= 1
+        self._remove(entry)
+
+    def _add(self, entry, hot):
+        raise NotImplementedError
+
+    def _access(self, entry):
+        raise NotImplementedError
+
+    def _victim(self):
+        raise NotImplementedError
+
+    def _remove(self, entry):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _miss(self, entry):
+        """Entry is accessed while it's on disk"""
+        pass
+
+    def _evict(self, entry):
+        """Entry is going to be spilled, it's still tracked by policy now"""
+        pass
+
+    def _forget(self, entry):
+        """Entry is deleted from map, drop all history of it"""
+        pass
+
+
+class LRUPolicy(EvictionPolicy):
+    """Least recently used, a hit is one move to the tail"""
+
+    def __init__(self, sizer=None):
+        super().__init__(sizer=sizer)
+        self._lru_list = DoublyLinkedList()
+
+    def _add(self, entry, hot):
+        if hot:
+            self._lru_list.append(entry.lru_node)
+        else:
+            self._lru_list.add_first(entry.lru_node)
+
+    def _access(self, entry):
+        self._lru_list.move_to_end(entry.lru_node)
+
+    def _victim(self):
+        return self._lru_list.peek_first().value
+
+    def _remove(self, entry):
+        self._lru_list.remove(entry.lru_node)
+
+    def _clear(self):
+        self._lru_list.clear()
+
+
+class ClockPolicy(EvictionPolicy):
+    """CLOCK approximation of LRU, a hit only sets the reference bit of entry without
+       any list move. Hand sweeps entries circularly and gives referenced ones a second
+       chance
+    """
+
+    def __init__(self, sizer=None):
+        super().__init__(sizer=sizer)
+        self._ring = DoublyLinkedList()
+        self._hand = None
+
+    def _add(self, entry, hot):
+        # reference bit
+        entry.policy_data = hot
+        self._ring.append(entry.lru_node)
+
+    def _access(self, entry):
+        entry.policy_data = True
+
+    def _victim(self):
+        while True:
+            if self._hand is None:
+                self._hand = self._ring.peek_first()
+            entry = self._hand.value
+            if not entry.policy_data:
+                return entry
+            entry.policy_data = False
+            self._hand = self._hand.next
+
+    def _remove(self, entry):
+        if self._hand is entry.lru_node:
+            self._hand = self._hand.next
+        self._ring.remove(entry.lru_node)
+
+    def _clear(self):
+        self._ring.clear()
+        self._hand = None
+
+
+class TwoQueuePolicy(EvictionPolicy):
+    """2Q, newcomers stay in FIFO queue a1in, entries evicted from a1in are remembered
+       in ghost queue a1out. Only an entry missed while it's in a1out enters main LRU
+       queue am, so a one-off scan never flushes am
+    """
+
+    def __init__(self, sizer=None, in_ratio=0.25, out_ratio=0.5):
+        super().__init__(sizer=sizer)
+        self._in_ratio = in_ratio
+        self._out_ratio = out_ratio
+        self._a1in = DoublyLinkedList()
+        self._am = DoublyLinkedList()
+        # evicted entries from a1in, they are on disk now
+        self._a1out = OrderedDict()
+
+    def _add(self, entry, hot):
+        # entry is re-referenced after being evicted from a1in
+        target = self._am if entry.policy_data else self._a1in
+        entry.policy_data = False
+        if hot:
+            target.append(entry.lru_node)
+        else:
+            target.add_first(entry.lru_node)
+
+    def _access(self, entry):
+        # hit in a1in doesn't change anything, it's a FIFO queue
+        self._am.move_to_end(entry.lru_node)
+
+    def _miss(self, entry):
+        if entry in self._a1out:
+            del self._a1out[entry]
+            entry.policy_data = True
+
+    def _victim(self):
+        if len(self._am) == 0 or len(self._a1in) > max(1, self._in_ratio * len(self)):
+            return self._a1in.peek_first().value
+        else:
+            return self._am.peek_first().value
+
+    def _remove(self, entry):
+        self._a1in.remove(entry.lru_node) or self._am.remove(entry.lru_node)
+
+    def _evict(self, entry):
+        if entry.lru_node.owner is self._a1in:
+            self._a1out[entry] = None
+            while len(self._a1out) > max(1, self._out_ratio * len(self)):
+                self._a1out.popitem(last=False)
+
+    def _forget(self, entry):
+        self._a1out.pop(entry, None)
+
+    def _clear(self):
+        self._a1in.clear()
+        self._am.clear()
+        self._a1out.clear()
+
+
+class ARCPolicy(EvictionPolicy):
+    """Adaptive replacement cache, t1 holds entries seen once recently and t2 holds
+       entries seen at least twice. Ghost lists b1 and b2 remember entries evicted from
+       t1 and t2, a miss on them adapts target size of t1 towards recency or frequency
+    """
+
+    def __init__(self, sizer=None):
+        super().__init__(sizer=sizer)
+        # target number of entries in t1
+        self._target = 0
+        self._t1 = DoublyLinkedList()
+        self._t2 = DoublyLinkedList()
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+
+    def _add(self, entry, hot):
+        # entry was missed while it's remembered in ghost lists
+        target = self._t2 if entry.policy_data else self._t1
+        entry.policy_data = False
+        if hot:
+            target.append(entry.lru_node)
+        else:
+            target.add_first(entry.lru_node)
+
+    def _access(self, entry):
+        if entry.lru_node.owner is self._t1:
+            self._t1.remove(entry.lru_node)
+            self._t2.append(entry.lru_node)
+        else:
+            self._t2.move_to_end(entry.lru_node)
+
+    def _miss(self, entry):
+        if entry in self._b1:
+            delta = max(len(self._b2) // len(self._b1), 1)
+            self._target = min(self._target + delta, len(self))
+            del self._b1[entry]
+            entry.policy_data = True
+        elif entry in self._b2:
+            delta = max(len(self._b1) // len(self._b2), 1)
+            self._target = max(self._target - delta, 0)
+            del self._b2[entry]
+            entry.policy_data = True
+
+    def _victim(self):
+        if len(self._t1) > 0 and (len(self._t1) > self._target or len(self._t2) == 0):
+            return self._t1.peek_first().value
+        else:
+            return self._t2.peek_first().value
+
+    def _remove(self, entry):
+        self._t1.remove(entry.lru_node) or self._t2.remove(entry.lru_node)
+
+    def _evict(self, entry):
+        ghost = self._b1 if entry.lru_node.owner is self._t1 else self._b2
+        ghost[entry] = None
+        # each ghost list remembers at most as many entries as the cache holds
+        while len(ghost) > max(1, len(self)):
+            ghost.popitem(last=False)
+
+    def _forget(self, entry):
+        self._b1.pop(entry, None)
+        self._b2.pop(entry, None)
+
+    def _clear(self):
+        self._target = 0
+        self._t1.clear()
+        self._t2.clear()
+        self._b1.clear()
+        self._b2.clear()
+
+
+class LFUPolicy(EvictionPolicy):
+    """Least frequently used, ties are broken by LRU. Access frequency is kept while
+       entry is on disk, so it's restored once entry is loaded again
+    """
+
+    def __init__(self, sizer=None):
+        super().__init__(sizer=sizer)
+        # frequency -> LRU linked list of entries with that frequency
+        self._frequency_lists = {}
+
+    def _add(self, entry, hot):
+        if not entry.policy_data:
+            entry.policy_data = 1
+        frequency_list = self._frequency_list(entry.policy_data)
+        if hot:
+            frequency_list.append(entry.lru_node)
+        else:
+            frequency_list.add_first(entry.lru_node)
+
+    def _access(self, entry):
+        self._remove(entry)
+        entry.policy_data += 1
+        self._frequency_list(entry.policy_data).append(entry.lru_node)
+
+    def _miss(self, entry):
+        entry.policy_data = (entry.policy_data or 0) + 1
+
+    def _victim(self):
+        return self._frequency_lists[min(self._frequency_lists)].peek_first().value
+
+    def _remove(self, entry):
+        frequency_list = entry.lru_node.owner
+        frequency_list.remove(entry.lru_node)
+        if len(frequency_list) == 0:
+            del self._frequency_lists[entry.policy_data]
+
+    def _clear(self):
+        for frequency_list in self._frequency_lists.values():
+            frequency_list.clear()
+        self._frequency_lists.clear()
+
+    def _frequency_list(self, frequency):
+        if frequency not in self._frequency_lists:
+            self._frequency_lists[frequency] = DoublyLinkedList()
+        return self._frequency_lists[frequency]
+
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "clock": ClockPolicy,
+    "2q": TwoQueuePolicy,
+    "arc": ARCPolicy,
+    "lfu": LFUPolicy,
+}
+
+
+def create_eviction_policy(eviction_policy, sizer=None):
+    """Eviction policy could be None (LRU), a name in EVICTION_POLICIES or a subclass
+       of EvictionPolicy
+    """
+    if eviction_policy is None:
+        return LRUPolicy(sizer=sizer)
+    elif isinstance(eviction_policy, type) and issubclass(
+        eviction_policy, EvictionPolicy
+    ):
+        return eviction_policy(sizer=sizer)
+    elif eviction_policy in EVICTION_POLICIES:
+        return EVICTION_POLICIES[eviction_policy](sizer=sizer)
+    else:
+        raise ValueError(
+            "Unknown eviction policy `{}`, choose one of {}".format(
+                eviction_policy, sorted(EVICTION_POLICIES)
+            )
+        )
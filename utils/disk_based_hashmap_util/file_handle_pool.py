@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+
+
+class FileHandlePool(object):
+    """LRU pool of long-lived file handles, at most `max_open_files` handles are opened
+       at the same time, the least recently used one is closed when pool is full
+
+       Pool is thread safe. A leased handle is never closed under its user, closing it
+       is deferred until the last lease is returned
+    """
+
+    def __init__(self, max_open_files=64):
+        self._max_open_files = max(max_open_files, 1)
+        # filepath -> opened file handle, ordered from least to most recently used
+        self._handles = OrderedDict()
+        # handle -> number of leases, and leased handles waiting to be closed
+        self._leases = {}
+        self._retired = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, filepath):
+        return filepath in self._handles
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_all()
+
+    def get(self, filepath):
+        """Return a read-write handle of filepath, file should already exist"""
+        with self._lock:
+            return self._get(filepath)
+
+    @contextmanager
+    def lease(self, filepath):
+        """Borrow handle of filepath, it stays opened until lease is returned even if
+           it's evicted or closed meanwhile
+        """
+        with self._lock:
+            handle = self._get(filepath)
+            self._leases[handle] = self._leases.get(handle, 0) + 1
+        try:
+            yield handle
+        finally:
+            with self._lock:
+                self._leases[handle] -= 1
+                if self._leases[handle] == 0:
+                    del self._leases[handle]
+                    if handle in self._retired:
+                        self._retired.remove(handle)
+                        handle.close()
+
+    def close(self, filepath):
+        """Close handle of filepath if it's opened"""
+        with self._lock:
+            handle = self._handles.pop(filepath, None)
+            if handle is not None:
+                self._close(handle)
+                return True
+            else:
+                return False
+
+    def close_all(self):
+        with self._lock:
+            while self._handles:
+                _, handle = self._handles.popitem(last=False)
+                self._close(handle)
+
+    def _get(self, filepath):
+        handle = self._handles.get(filepath)
+        if handle is None:
+            while len(self._handles) >= self._max_open_files:
+                _, least_recent_handle = self._handles.popitem(last=False)
+                self._close(least_recent_handle)
+            handle = open(filepath, "r+b")
+            self._handles[filepath] = handle
+        else:
+            self._handles.move_to_end(filepath)
+        return handle
+
+    def _close(self, handle):
+        if handle in self._leases:
+            self._retired.add(handle)
+        else:
+            handle.close()
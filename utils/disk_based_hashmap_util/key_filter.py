@@ -0,0 +1,60 @@
+import threading
+
+from cuckoo_filter import CuckooFilter
+
+
+class KeyFilter(object):
+    """Approximate membership of map keys backed by CuckooFilter, a key whose hash is
+       not in filter is surely not in map. Filter holds key hashes rather than keys,
+       since equal keys always share a hash but not a pickled form, such as 1 and 1.0.
+       Filter is disabled once it's too full to add a hash, every key might exist then,
+       until it's cleared
+
+       Filter is thread safe, but adding and removing the same hash should be
+       serialized by caller, since both of them are keyed by the same fingerprint
+    """
+
+    # CuckooFilter bucket holds 4 fingerprints, insertion starts to fail near 95% full
+    BUCKET_SIZE = 4
+    MAX_LOAD_FACTOR = 0.9
+
+    def __init__(self, capacity):
+        self._capacity = max(capacity, 1)
+        self._lock = threading.Lock()
+        self._filter = self._create_filter()
+
+    def __len__(self):
+        with self._lock:
+            return 0 if self._filter is None else len(self._filter)
+
+    @property
+    def enabled(self):
+        return self._filter is not None
+
+    def might_contain(self, key_hash):
+        with self._lock:
+            return self._filter is None or key_hash in self._filter
+
+    def add(self, key_hash):
+        with self._lock:
+            if self._filter is None:
+                return
+            # add returns False if fingerprint exists or filter is full
+            if not self._filter.add(key_hash) and key_hash not in self._filter:
+                self._filter = None
+
+    def remove(self, key_hash):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.remove(key_hash)
+
+    def clear(self):
+        with self._lock:
+            self._filter = self._create_filter()
+
+    def _create_filter(self):
+        return CuckooFilter(
+            bucket_size=self.BUCKET_SIZE,
+            array_size=int(self._capacity / self.BUCKET_SIZE / self.MAX_LOAD_FACTOR)
+            + 1,
+        )
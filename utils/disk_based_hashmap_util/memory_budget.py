@@ -0,0 +1,112 @@
+import itertools
+import threading
+import weakref
+
+
+class MemoryBudget(object):
+    """Memory threshold shared by several maps instead of one threshold per map. Once
+       aggregate memory usage exceeds it, the coldest entries across all maps are
+       spilled until usage drops to low watermark, a map keeps at least its reservation
+       in memory. Maps register themselves through `memory_budget` argument
+
+       Every map nominates its next victim by its own eviction policy, nominees are
+       compared by a global access tick stamped on entries, so the least recently used
+       one is spilled first. Maps other than the balancing one are skipped while they
+       are busy, they are never waited for. Budget is thread safe
+    """
+
+    def __init__(self, memory_threshold, low_watermark=None):
+        self._memory_threshold = max(memory_threshold, 0)
+        # same hysteresis as a single map, `None` means no hysteresis
+        self._low_watermark_ratio = (
+            1.0 if low_watermark is None else min(max(low_watermark, 0.0), 1.0)
+        )
+        # shared by eviction policies of all maps, next() is atomic
+        self._clock = itertools.count(1)
+        # id of map -> (weak reference to map, reservation), a map that's garbage
+        # collected drops out
+        self._members = {}
+        self._lock = threading.Lock()
+
+    @property
+    def memory_threshold(self):
+        return self._memory_threshold
+
+    @property
+    def low_watermark(self):
+        return self._memory_threshold * self._low_watermark_ratio
+
+    @property
+    def memory_usage(self):
+        """Aggregate memory usage of in-memory entries of all maps"""
+        return self._usage_of(self._live_members())
+
+    def register(self, member, reservation=0):
+        """Share budget with map, at least reservation bytes of its entries are kept in
+           memory
+        """
+        member.eviction_policy.clock = self._clock
+        with self._lock:
+            self._members[id(member)] = (weakref.ref(member), max(reservation, 0))
+
+    def unregister(self, member):
+        with self._lock:
+            self._members.pop(id(member), None)
+        member.eviction_policy.clock = None
+
+    def balance(self, requester):
+        """Spill globally coldest entries once budget is exceeded, it's called by
+           requester's balance. Only requester is waited for, it could be locked by the
+           calling thread already
+        """
+        members = self._live_members()
+        if self._usage_of(members) <= self._memory_threshold:
+            return
+        # busy or exhausted maps are skipped for the rest of this round
+        skipped = set()
+        while True:
+            # other maps could change meanwhile, usage is summed again every run
+            memory_usage = self._usage_of(members)
+            if memory_usage <= self.low_watermark:
+                break
+            nominees = []
+            for member, reservation in members:
+                if (
+                    id(member) in skipped
+                    or member.eviction_policy.memory_usage <= reservation
+                ):
+                    continue
+                access_tick = member._victim_tick(blocking=member is requester)
+                if access_tick is None:
+                    skipped.add(id(member))
+                else:
+                    nominees.append((access_tick, len(nominees), member, reservation))
+            if len(nominees) == 0:
+                break
+            nominees.sort(key=lambda nominee: nominee[:2])
+            _, _, member, reservation = nominees[0]
+            # coldest map spills a run of victims until they're no longer the coldest
+            until_tick = nominees[1][0] if len(nominees) > 1 else None
+            memory_floor = max(
+                reservation,
+                member.eviction_policy.memory_usage
+                - (memory_usage - self.low_watermark),
+            )
+            if not member._spill_coldest(
+                memory_floor, until_tick, blocking=member is requester
+            ):
+                skipped.add(id(member))
+
+    def _usage_of(self, members):
+        return sum(member.eviction_policy.memory_usage for member, _ in members)
+
+    def _live_members(self):
+        with self._lock:
+            members = []
+            for key, (reference, reservation) in list(self._members.items()):
+                member = reference()
+                if member is None:
+                    del self._members[key]
+                else:
+                    members.append((member, reservation))
+            return members
@@ -0,0 +1,125 @@
+import sys
+import threading
+import weakref
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def sample_memory():
+    """Return current process RSS, host MemAvailable and MemTotal in bytes, any of them
+       is `None` if it's unknown on this platform
+    """
+    rss = available = total = None
+    try:
+        with open("/proc/self/statm") as statm:
+            rss = int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError, AttributeError):
+        if resource is not None:
+            # peak RSS is the closest, it's in kilobytes except on macOS
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != "darwin":
+                rss *= 1024
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                name, _, value = line.partition(":")
+                if name == "MemAvailable":
+                    available = int(value.split()[0]) * 1024
+                elif name == "MemTotal":
+                    total = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return rss, available, total
+
+
+class AdaptiveThreshold(object):
+    """Spilling threshold which follows host memory pressure between floor and
+       ceiling. Host headroom is MemAvailable above a reserved ratio of MemTotal, map
+       takes the share of it matching its share of process RSS, so threshold grows
+       while host has spare memory and shrinks below memory usage once headroom turns
+       negative, which makes map spill proactively
+
+       A daemon thread calls `on_sample` every interval, where map updates threshold
+       with its memory usage. Thread is started lazily. Threshold is unchanged if host
+       memory is unknown. `on_sample` is a bound method of map, it's weakly referenced
+       so that thread never keeps map alive, thread exits once map is garbage collected
+    """
+
+    def __init__(
+        self,
+        floor,
+        ceiling,
+        on_sample,
+        sample_interval=1.0,
+        reserve_ratio=0.1,
+        sampler=sample_memory,
+    ):
+        self._floor = floor
+        self._ceiling = ceiling
+        self._on_sample = weakref.WeakMethod(on_sample, self._on_collected)
+        self._sample_interval = sample_interval
+        self._reserve_ratio = reserve_ratio
+        self._sampler = sampler
+        self.threshold = floor
+        self._stopped = None
+        self._thread = None
+        # start could be called by several threads at the same time
+        self._lock = threading.Lock()
+
+    def update(self, memory_usage):
+        """Sample memory and return new threshold for memory usage of map"""
+        rss, available, total = self._sampler()
+        if available is None or total is None:
+            return self.threshold
+        headroom = available - total * self._reserve_ratio
+        share = 1.0 if not rss else min(memory_usage / rss, 1.0)
+        self.threshold = min(
+            max(memory_usage + headroom * share, self._floor), self._ceiling
+        )
+        return self.threshold
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                # a thread being stopped keeps its own event
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run,
+                    args=(self._stopped,),
+                    name="DiskBasedHashMapMemorySampler",
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Stop sampling thread, it must not be called with map locked, otherwise
+           thread could never finish current sample
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._stopped.set()
+        if thread is not None:
+            thread.join()
+
+    def _run(self, stopped):
+        while not stopped.wait(self._sample_interval):
+            if not self._sample():
+                return
+
+    def _sample(self):
+        """Return False once map is gone, map is referenced only during a sample"""
+        on_sample = self._on_sample()
+        if on_sample is None:
+            return False
+        on_sample()
+        return True
+
+    def _on_collected(self, _):
+        # called by garbage collector, which could run with lock held by this thread
+        stopped = self._stopped
+        if stopped is not None:
+            stopped.set()
@@ -0,0 +1,56 @@
+import pickle
+import sys
+
+# pympler is imported on first use, it's slow to import and optional
+_asizeof = None
+
+
+def asizeof_sizer(value):
+    """Exact deep size, walks the whole object graph of value"""
+    global _asizeof
+    if _asizeof is None:
+        from pympler.asizeof import asizeof as _asizeof
+    return _asizeof(value)
+
+
+def getsizeof_sizer(value):
+    """Shallow size, referenced objects are not counted"""
+    return sys.getsizeof(value)
+
+
+def pickle_sizer(value):
+    """Pickled length, close to spilled size of value"""
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class FixedCostSizer(object):
+    """Constant size per value type, cheapest estimation if values have similar shapes"""
+
+    def __init__(self, type_costs=None, default_cost=64):
+        self._type_costs = dict(type_costs) if type_costs else {}
+        self._default_cost = default_cost
+
+    def __call__(self, value):
+        return self._type_costs.get(type(value), self._default_cost)
+
+
+SIZERS = {
+    "asizeof": asizeof_sizer,
+    "getsizeof": getsizeof_sizer,
+    "pickle": pickle_sizer,
+    "fixed": FixedCostSizer(),
+}
+
+
+def resolve_sizer(sizer):
+    """Sizer could be None (exact asizeof), a name in SIZERS or a callable value -> size"""
+    if sizer is None:
+        return asizeof_sizer
+    elif callable(sizer):
+        return sizer
+    elif sizer in SIZERS:
+        return SIZERS[sizer]
+    else:
+        raise ValueError(
+            "Unknown sizer `{}`, choose one of {}".format(sizer, sorted(SIZERS))
+        )
@@ -0,0 +1,30 @@
+import functools
+
+
+def synchronized(method):
+    """Run method with `self._lock` held"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class MultiLock(object):
+    """Acquire several locks in a fixed order and release them in reverse order, all
+       users of these locks must follow the same order to avoid deadlock
+    """
+
+    def __init__(self, locks):
+        self._locks = list(locks)
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for lock in reversed(self._locks):
+            lock.release()
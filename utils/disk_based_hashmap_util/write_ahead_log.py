@@ -0,0 +1,129 @@
+import threading
+
+from bucket import Bucket
+
+
+class WriteAheadLog(object):
+    """Append-only log of map updates since the last full checkpoint, it's replayed on
+       top of that checkpoint when map is reopened. Records share bucket record format,
+       so a torn tail left by a crash is detected by checksum and dropped
+
+       Appends are buffered, they are made durable either by a daemon thread every
+       sync interval or by group commit, where writers waiting for their records share
+       one fsync. Log is thread safe
+    """
+
+    def __init__(self, filepath, group_commit=False, sync_interval=None):
+        # a dedicated handle, log is never closed by bucket handle pool eviction
+        self._bucket = Bucket(filepath, truncate=False)
+        self._group_commit = group_commit
+        self._sync_interval = sync_interval
+        # sequence numbers of the last appended record and the last durable one, a
+        # leader fsyncs for everyone while others wait on condition
+        self._appended = 0
+        self._synced = 0
+        # bytes of records appended since last reset
+        self._size = 0
+        self._syncing = False
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def filepath(self):
+        return self._bucket.filepath
+
+    @property
+    def size(self):
+        """Bytes of records appended since log was opened or reset"""
+        return self._size
+
+    def records(self):
+        """Return intact records from the beginning of log, a torn tail is truncated"""
+        self._bucket.verify(truncate=True)
+        return [
+            self._bucket.load_value(disk_address)
+            for disk_address in self._bucket.record_addresses()
+        ]
+
+    def append(self, record):
+        """Append record without waiting for disk, return its sequence number which is
+           passed to `commit`
+        """
+        with self._condition:
+            self._size += self._bucket.persist_value(record).size
+            self._appended += 1
+            if self._sync_interval is not None and self._thread is None:
+                self._start()
+            return self._appended
+
+    def commit(self, sequence):
+        """Wait until record of sequence is durable, it's a no-op without group commit.
+           It must not be called with map locked, otherwise concurrent writers could
+           never join the same fsync
+        """
+        if not self._group_commit:
+            return
+        with self._condition:
+            while self._synced < sequence:
+                if self._syncing:
+                    self._condition.wait()
+                else:
+                    self._sync_locked()
+
+    def sync(self):
+        """Make every appended record durable"""
+        with self._condition:
+            while self._syncing:
+                self._condition.wait()
+            if self._synced < self._appended:
+                self._sync_locked()
+
+    def reset(self):
+        """Drop all records once map state is saved by a durable checkpoint, waiting
+           writers are released since their records are covered by it
+        """
+        with self._condition:
+            while self._syncing:
+                self._condition.wait()
+            self._bucket.clear()
+            self._bucket.sync()
+            self._size = 0
+            self._synced = self._appended
+            self._condition.notify_all()
+
+    def close(self):
+        """Stop sync thread and release log file, log could still be appended to"""
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopped.set()
+        if thread is not None:
+            thread.join()
+        self.sync()
+        self._bucket.close()
+
+    def _sync_locked(self):
+        """Fsync as leader with condition held, condition is released during fsync so
+           that records appended meanwhile join the next group
+        """
+        self._syncing = True
+        target = self._appended
+        self._condition.release()
+        try:
+            self._bucket.sync()
+        finally:
+            self._condition.acquire()
+            self._syncing = False
+            self._condition.notify_all()
+        self._synced = max(self._synced, target)
+
+    def _start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="DiskBasedHashMapLogSync", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._sync_interval):
+            self.sync()